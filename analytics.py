@@ -0,0 +1,219 @@
+import math
+import os
+
+import numpy as np
+from flask import Blueprint, jsonify
+from flask_login import login_required, current_user
+
+from db import get_conn
+import pressure_store
+
+analytics_bp = Blueprint("analytics", __name__)
+
+# =========================
+# 気圧感受性（体調スコア × 気圧変化）
+# =========================
+# ログ1件ごとに「記録時刻までの3時間の気圧変化 dp（hPa）」と「スコア」の組を作り、
+# ユーザーごとに平均・分散・共分散を逐次（Welford 法）で持つ
+#   slope = 共分散 / dp の分散 → 1hPa 変化あたりのスコア変化（下がると悪化なら負）
+#   corr  = 相関係数
+# 新しいログは update_user() で差分だけ反映、全件の作り直しは recompute_all()（NumPy）
+# 気圧がまだ取り込まれていないログ（SENSITIVITY_SETTLE_HOURS 以内）があれば、その手前までしか進めない
+# → 取り込まれた後の更新で拾う。それより古くても値が無いログは、もう埋まらないものとして飛ばす
+
+SENSITIVITY_WINDOW_HOURS = int(os.getenv("SENSITIVITY_WINDOW_HOURS", "3"))
+# これより少ないと傾き・相関は出さない
+SENSITIVITY_MIN_N = int(os.getenv("SENSITIVITY_MIN_N", "5"))
+# 記録からこの時間が過ぎても気圧が無いログは待たずに飛ばす
+SENSITIVITY_SETTLE_HOURS = int(os.getenv("SENSITIVITY_SETTLE_HOURS", "48"))
+
+_STATE_FIELDS = ("n", "mean_dp", "mean_score", "m2_dp", "m2_score", "c_dp_score")
+
+
+def _dp(conn, location_ids, log_ats):
+    """
+    ログ時刻（の正時）とその window 時間前の気圧の差を、地点の毎時データ（pressure_blocks）から引く
+    location_ids / log_ats は同じ長さ。地点が無い（None）・どちらかの値が無いログは NaN
+    """
+    t1 = pressure_store.to_epochs(log_ats)
+    t0 = t1 - SENSITIVITY_WINDOW_HOURS * pressure_store.STEP
+    locs = np.asarray([-1 if i is None else i for i in location_ids], dtype=np.int64)
+    p = pressure_store.values_at(conn, np.concatenate([locs, locs]), np.concatenate([t1, t0]))
+    return np.round(p[:len(t1)] - p[len(t1):], 1)
+
+
+def _pending(location_ids, log_ats, dp, now=None):
+    """
+    気圧を待つログ（地点があり、値がまだ無く、記録から SENSITIVITY_SETTLE_HOURS 以内）の真偽配列
+    """
+    now = pressure_store.now_epoch() if now is None else now
+    located = np.array([i is not None for i in location_ids], dtype=bool)
+    recent = pressure_store.to_epochs(log_ats) > now - SENSITIVITY_SETTLE_HOURS * 3600
+    return located & np.isnan(dp) & recent
+
+
+def _welford(state, pairs):
+    """
+    state（dict）に (dp, score) の並びを1件ずつ足し込む
+    """
+    n, mx, my = state["n"], state["mean_dp"], state["mean_score"]
+    m2x, m2y, cxy = state["m2_dp"], state["m2_score"], state["c_dp_score"]
+    for x, y in pairs:
+        n += 1
+        dx = x - mx
+        mx += dx / n
+        dy = y - my
+        my += dy / n
+        m2x += dx * (x - mx)
+        m2y += dy * (y - my)
+        cxy += dx * (y - my)
+    state.update(n=n, mean_dp=mx, mean_score=my, m2_dp=m2x, m2_score=m2y, c_dp_score=cxy)
+    return state
+
+
+def summarize(state):
+    # 画面・API 用の形（データが少なければ slope / corr は None）
+    n = state["n"] if state else 0
+    out = {"n": n, "slope": None, "corr": None, "mean_score": None, "mean_dp": None,
+           "window_hours": SENSITIVITY_WINDOW_HOURS}
+    if not n:
+        return out
+    out["mean_score"] = round(state["mean_score"], 2)
+    out["mean_dp"] = round(state["mean_dp"], 2)
+    if n >= SENSITIVITY_MIN_N and state["m2_dp"] > 0:
+        out["slope"] = round(state["c_dp_score"] / state["m2_dp"], 3)
+        if state["m2_score"] > 0:
+            out["corr"] = round(state["c_dp_score"] / math.sqrt(state["m2_dp"] * state["m2_score"]), 3)
+    return out
+
+
+# ----------------------------
+# 逐次更新
+# ----------------------------
+def load_state(conn, user_id):
+    row = conn.execute("SELECT * FROM user_sensitivity WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return dict.fromkeys(_STATE_FIELDS, 0), 0
+    return {k: row[k] for k in _STATE_FIELDS}, row["last_log_id"]
+
+
+def save_state(conn, user_id, state, last_log_id):
+    conn.execute("""
+        INSERT INTO user_sensitivity
+            (user_id, n, mean_dp, mean_score, m2_dp, m2_score, c_dp_score, last_log_id, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        ON CONFLICT(user_id) DO UPDATE SET
+            n = excluded.n, mean_dp = excluded.mean_dp, mean_score = excluded.mean_score,
+            m2_dp = excluded.m2_dp, m2_score = excluded.m2_score, c_dp_score = excluded.c_dp_score,
+            last_log_id = excluded.last_log_id, updated_at = excluded.updated_at
+    """, (user_id, *(state[k] for k in _STATE_FIELDS), last_log_id))
+
+
+def update_user(conn, user_id, now=None):
+    """
+    last_log_id より後のログだけを足し込む（記録の直後に呼ぶ）
+    気圧を待つログがあれば、その手前までで止める（last_log_id もそこまで）
+    地点が無い・古いのに気圧が無いログは飛ばす（後で recompute_all すれば拾われる）
+    コミットは呼び出し側。戻り値: 反映したログ数
+    """
+    state, last_log_id = load_state(conn, user_id)
+    rows = conn.execute("""
+        SELECT l.id, l.score, u.location_id, substr(l.log_at, 1, 16) AS log_at
+        FROM logs l
+        JOIN users u ON u.id = l.user_id
+        WHERE l.user_id = ? AND l.id > ?
+        ORDER BY l.id
+    """, (user_id, last_log_id)).fetchall()
+    if not rows:
+        return 0
+
+    location_ids = [r["location_id"] for r in rows]
+    log_ats = [r["log_at"] for r in rows]
+    dp = _dp(conn, location_ids, log_ats)
+    waiting = _pending(location_ids, log_ats, dp, now)
+    stop = int(np.argmax(waiting)) if waiting.any() else len(rows)
+    if stop == 0:
+        return 0
+
+    pairs = [(float(x), r["score"]) for x, r in zip(dp[:stop], rows[:stop]) if not np.isnan(x)]
+    _welford(state, pairs)
+    save_state(conn, user_id, state, rows[stop - 1]["id"])
+    return len(pairs)
+
+
+# ----------------------------
+# 一括再計算
+# ----------------------------
+def recompute_all(conn, now=None):
+    """
+    全ユーザーを NumPy でまとめて計算し直す（気圧の後追い取り込みの後など）
+    bincount でユーザーごとの和を取り、偏差の二乗和は平均を引いてから足す（2パス）
+    戻り値: 更新したユーザー数
+    """
+    cur = conn.cursor()
+    cur.row_factory = None   # タプルのまま受け取る
+    rows = cur.execute("""
+        SELECT l.id, l.user_id, l.score, u.location_id, substr(l.log_at, 1, 16)
+        FROM logs l
+        JOIN users u ON u.id = l.user_id
+        ORDER BY l.id
+    """).fetchall()
+
+    log_ids, user_ids, scores, location_ids, log_ats = zip(*rows) if rows else ((), (), (), (), ())
+    log_ids = np.asarray(log_ids, dtype=np.int64)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    dp = _dp(conn, location_ids, log_ats)
+
+    # ユーザーごとに、気圧を待つ最初のログの手前まで（チェックポイントもそこ）
+    last_ids = dict(conn.execute("SELECT user_id, MAX(id) FROM logs GROUP BY user_id").fetchall())
+    waiting = _pending(location_ids, log_ats, dp, now)
+    for log_id, user_id in zip(log_ids[waiting][::-1].tolist(), user_ids[waiting][::-1].tolist()):
+        last_ids[user_id] = log_id - 1
+    limit = np.array([last_ids.get(int(u), 0) for u in user_ids], dtype=np.int64)
+
+    ok = ~np.isnan(dp) & (log_ids <= limit)
+    user_ids = user_ids[ok]
+    x, y = dp[ok], np.asarray(scores, dtype=np.float64)[ok]
+
+    if len(x):
+        users, idx = np.unique(user_ids, return_inverse=True)
+
+        n = np.bincount(idx)
+        mean_x = np.bincount(idx, weights=x) / n
+        mean_y = np.bincount(idx, weights=y) / n
+        dx = x - mean_x[idx]
+        dy = y - mean_y[idx]
+        m2x = np.bincount(idx, weights=dx * dx)
+        m2y = np.bincount(idx, weights=dy * dy)
+        cxy = np.bincount(idx, weights=dx * dy)
+        computed = {
+            int(u): (int(n[i]), float(mean_x[i]), float(mean_y[i]), float(m2x[i]), float(m2y[i]), float(cxy[i]))
+            for i, u in enumerate(users)
+        }
+    else:
+        computed = {}
+
+    empty = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    conn.execute("DELETE FROM user_sensitivity")
+    conn.executemany("""
+        INSERT INTO user_sensitivity
+            (user_id, n, mean_dp, mean_score, m2_dp, m2_score, c_dp_score, last_log_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, ((user_id, *computed.get(user_id, empty), last_id) for user_id, last_id in last_ids.items()))
+    conn.commit()
+    return len(last_ids)
+
+
+# ----------------------------
+# API
+# ----------------------------
+@analytics_bp.route("/api/sensitivity")
+@login_required
+def api_sensitivity():
+    """
+    自分の気圧感受性（主キー1行を読むだけ）
+    """
+    row = get_conn().execute(
+        "SELECT * FROM user_sensitivity WHERE user_id = ?", (current_user.id,)
+    ).fetchone()
+    return jsonify(summarize(dict(row) if row is not None else None))
@@ -1,20 +1,33 @@
 from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import json
 import urllib.request
-import smtplib
-from email.mime.text import MIMEText
 import click
 
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 
 from user import User
 from auth import auth_bp
 from pressure import pressure_bp
 from settei import settei_bp
+from analytics import analytics_bp
+import migrations
+import ingest
+from mailer import Mail, send_email
+import outbox
+import passwords
+import db
+from db import get_conn
+import metrics
+import risk
+import pressure_store
+from pressure_series import PressureSeries
+import analytics
+import thresholds
+import backfill
+from cache import LRUCache
 
 # =========================
 # App / Config
@@ -30,94 +43,56 @@ login_manager.login_view = "auth.login"
 app.register_blueprint(auth_bp)
 app.register_blueprint(pressure_bp)
 app.register_blueprint(settei_bp)
+app.register_blueprint(analytics_bp)
 
-# DB設定
-DB_PATH = os.path.join(os.path.dirname(__file__), "mvp.db")
-print("APP DB PATH:", DB_PATH)
+# DB設定（パス・プールは db.py に集約）
+db.init_app(app)
+metrics.init_app(app)
+print("APP DB PATH:", db.DB_PATH)
 
 # 気圧取得用設定（メール機能）
-LAT = float(os.getenv("LAT", "34.07"))
-LON = float(os.getenv("LON", "132.99"))
 TIMEZONE = "Asia%2FTokyo"
 
+# 体調記録の1ページの件数
+HEALTH_PAGE_SIZE = int(os.getenv("HEALTH_PAGE_SIZE", "50"))
+
 # =========================
 # DB helpers
 # =========================
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    return conn
-
 def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
+    # スキーマは migrations.py で管理（PRAGMA user_version）
+    with db.connection() as conn:
+        migrations.migrate(conn)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT NOT NULL UNIQUE,
-        pw_hash TEXT NOT NULL,
-        created_at TEXT NOT NULL
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        log_at TEXT NOT NULL,
-        score INTEGER NOT NULL,
-        note TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS pressure_daily (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        pressure_hpa REAL,
-        p_min REAL,
-        p_max REAL,
-        p_range REAL,
-        created_at TEXT NOT NULL DEFAULT (datetime('now')),
-        UNIQUE(user_id, date),
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS alerts_sent (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        kind TEXT NOT NULL,
-        sent_at TEXT NOT NULL DEFAULT (datetime('now')),
-        UNIQUE(user_id, date, kind),
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
+#ユーザー組み込み関数（存在確認はキャッシュ優先。複数ワーカーでは wsgi.post_fork で切る）
+user_cache = LRUCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "300")),
+)
 
-    conn.commit()
-    conn.close()
-
-#ユーザー組み込み関数
 @login_manager.user_loader
 def load_user(user_id):
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
     conn = get_conn()
-    user = conn.execute(
+    row = conn.execute(
         "SELECT id FROM users WHERE id = ?",
         (user_id,)
     ).fetchone()
-    conn.close()
 
-    if user:
-        return User(user["id"])
+    if row:
+        user = User(row["id"])
+        user_cache.set(user_id, user)
+        return user
     return None
 
+@app.route("/api/db/stats")
+@login_required
+def db_stats():
+    return jsonify(db.pool.stats())
+
 @app.route("/health", methods=["GET", "POST"])
 @login_required
 def health():
@@ -141,20 +116,57 @@ def health():
             "INSERT INTO logs (user_id, log_at, score, note) VALUES (?, ?, ?, ?)",
             (current_user.id, datetime.now().isoformat(timespec="seconds"), score_int, note)
         )
+        # 気圧感受性に今の1件を足し込む（同じトランザクション）
+        analytics.update_user(conn, current_user.id)
         conn.commit()
-        conn.close()
 
         flash("記録しました")
         return redirect(url_for("health"))
 
+    # キーセット（カーソル）方式のページ送り：?before=<その画面の最後の id>
+    # idx_logs_user_id(user_id, id) を逆順にたどるだけなので、古いページでも速い
+    before = request.args.get("before", type=int)
     conn = get_conn()
-    logs = conn.execute(
-        "SELECT log_at, score, note FROM logs WHERE user_id = ? ORDER BY id DESC LIMIT 50",
-        (current_user.id,)
+    rows = conn.execute(
+        """
+        SELECT id, log_at, score, note FROM logs
+        WHERE user_id = ? AND id < ?
+        ORDER BY id DESC LIMIT ?
+        """,
+        (current_user.id, before if before is not None else 2 ** 63 - 1, HEALTH_PAGE_SIZE + 1)
     ).fetchall()
-    conn.close()
 
-    return render_template("health.html", logs=logs)
+    logs = rows[:HEALTH_PAGE_SIZE]
+    next_before = logs[-1]["id"] if len(rows) > HEALTH_PAGE_SIZE else None
+
+    return render_template("health.html", logs=logs, before=before, next_before=next_before)
+
+@app.route("/api/health/trend")
+@login_required
+def health_trend():
+    """
+    体調スコアの推移（log_daily / log_weekly の集計だけを読む）
+    ?period=daily|weekly&limit=N（新しい順に N 件を古い順で返す）
+    """
+    period = request.args.get("period", "weekly")
+    if period not in ("daily", "weekly"):
+        return jsonify({"error": "period は daily か weekly です"}), 400
+    limit = max(1, min(request.args.get("limit", 12 if period == "weekly" else 30, type=int), 366))
+
+    table, key = ("log_weekly", "week") if period == "weekly" else ("log_daily", "day")
+    rows = get_conn().execute(f"""
+        SELECT {key} AS period, n, score_sum, high_n FROM {table}
+        WHERE user_id = ? AND n > 0
+        ORDER BY {key} DESC LIMIT ?
+    """, (current_user.id, limit)).fetchall()
+
+    return jsonify({
+        "period": period,
+        "points": [
+            {"start": r["period"], "n": r["n"], "avg": round(r["score_sum"] / r["n"], 2), "high_n": r["high_n"]}
+            for r in reversed(rows)
+        ],
+    })
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -162,14 +174,14 @@ def login():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
-        conn = get_conn()
-        user = conn.execute("SELECT id, pw_hash FROM users WHERE email = ?", (email,)).fetchone()
-        conn.close()
+        with db.connection() as conn:
+            user = conn.execute("SELECT id, pw_hash FROM users WHERE email = ?", (email,)).fetchone()
 
-        if not user or not check_password_hash(user["pw_hash"], password):
+        if not user or not passwords.verify_password(user["pw_hash"], password):
             flash("メールまたはパスワードが違います")
             return redirect(url_for("login"))
 
+        passwords.upgrade(user["id"], user["pw_hash"], password)
         session["user_id"] = user["id"]
         flash("ログインしました")
         return redirect(url_for("index"))
@@ -186,7 +198,7 @@ def register():
             flash("メールとパスワードは必須です")
             return redirect(url_for("register"))
 
-        pw_hash = generate_password_hash(password)
+        pw_hash = passwords.hash_password(password)
 
         try:
             conn = get_conn()
@@ -195,7 +207,6 @@ def register():
                 (email, pw_hash, datetime.now().isoformat(timespec="seconds"))
             )
             conn.commit()
-            conn.close()
         except sqlite3.IntegrityError:
             flash("そのメールは既に登録されています")
             return redirect(url_for("register"))
@@ -211,29 +222,6 @@ def logout():
     flash("ログアウトしました")
     return redirect(url_for("login"))
 
-# =========================
-# SMTP
-# =========================
-SMTP_HOST = os.getenv("SMTP_HOST", "")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_USER = os.getenv("SMTP_USER", "")
-SMTP_PASS = os.getenv("SMTP_PASS", "")
-MAIL_FROM = os.getenv("MAIL_FROM", SMTP_USER)
-
-def send_email(to_addr, subject, body):
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASS):
-        raise RuntimeError("SMTP設定が未設定です（.env を確認してください）")
-
-    msg = MIMEText(body, "plain", "utf-8")
-    msg["Subject"] = subject
-    msg["From"] = MAIL_FROM
-    msg["To"] = to_addr
-
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20) as s:
-        s.starttls()
-        s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
-
 # =========================
 # CLI
 # =========================
@@ -245,169 +233,234 @@ def test_email(to_addr):
     send_email(to_addr, "P-Alert SMTP テスト", "これはP-AlertからのSMTP疎通テストです。")
     click.echo(f"OK: sent to {to_addr}")
 
-@app.cli.command("daily-pressure-check")
-def daily_pressure_check_cmd():
-    today = datetime.now().strftime("%Y-%m-%d")
-    vals = fetch_today_pressures_msl()
+def load_location_series(conn, locations, yyyy_mm_dd, days=1):
+    """
+    取り込み済みの毎時データ（pressure_blocks）を yyyy_mm_dd から days 日分読む
+    スナップショットが古い地点だけ、先に取り込み直す
+    戻り値: PressureSeries（地点 × 時刻、行は locations の順、欠測は NaN）
+    """
+    ingest.ingest_stale(conn, locations)
+    start = pressure_store.day_epoch(yyyy_mm_dd)
+    print(f"[INFO] locations={len(locations)}")
+    return PressureSeries.read(conn, [l["id"] for l in locations], start, start + days * pressure_store.DAY)
 
-    p_min = min(vals)
-    p_max = max(vals)
-    p_range = p_max - p_min
+def enqueue_and_deliver(conn, mails, yyyy_mm_dd, kind):
+    """
+    アラートをアウトボックスに積んでコミットしてから配信ワーカーで送り切る
+    途中で落ちても積んだ分は残り、次の deliver-alerts / ジョブで続きから送られる
+    """
+    queued = outbox.enqueue(conn.cursor(), mails, yyyy_mm_dd, kind)
+    conn.commit()
+    print(f"[INFO] {kind}: queued={queued}")
+    outbox.deliver(label=kind)
 
-    print(f"[INFO] {today} min={p_min:.1f} max={p_max:.1f} range={p_range:.1f}")
+def daily_pressure_check():
+    today = datetime.now().strftime("%Y-%m-%d")
 
     conn = get_conn()
     cur = conn.cursor()
-    users = cur.execute("SELECT id, email FROM users").fetchall()
+    locations = ingest.active_locations(conn)
 
-    if not users:
+    if not locations:
         print("[WARN] users が0件です（送信先なし）")
-        conn.close()
         return
 
-    for u in users:
-        user_id = int(u["id"])
-        email = u["email"]
-
-        cur.execute("""
-            INSERT OR REPLACE INTO pressure_daily
-            (user_id, date, pressure_hpa, p_min, p_max, p_range)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, today, float(vals[-1]), float(p_min), float(p_max), float(p_range)))
-
-        if p_range >= 4.0:
-            cur.execute("""
-                SELECT 1 FROM alerts_sent
-                WHERE user_id=? AND date=? AND kind='daily_range'
-            """, (user_id, today))
-            if cur.fetchone():
-                continue
-
-            send_email(
-                to_addr=email,
-                subject="P-Alert 気圧変動注意",
-                body=f"本日({today})の気圧変動幅は {p_range:.1f} hPa です。体調にご注意ください。"
-            )
+    # 今日の最小・最大と、最後に値のある時刻の値（地点ごとに一度に）
+    series = load_location_series(conn, locations, today).day(today)
+    p_min = series.resample(pressure_store.DAY, "min").values[:, 0]
+    p_max = series.resample(pressure_store.DAY, "max").values[:, 0]
+    last_i, last = series.nearest(series.epochs[-1])
+
+    rows = []
+    for n, loc in enumerate(locations):
+        if last_i[n] < 0:
+            print(f"[WARN] location={loc['id']} 今日のデータが取れませんでした")
+            continue
+
+        p_range = round(float(p_max[n] - p_min[n]), 1)
+        print(f"[INFO] {today} location={loc['id']} min={p_min[n]:.1f} max={p_max[n]:.1f} range={p_range:.1f}")
 
-            cur.execute("""
-                INSERT OR IGNORE INTO alerts_sent (user_id, date, kind)
-                VALUES (?, ?, ?)
-            """, (user_id, today, "daily_range"))
+        rows.append((loc["id"], today, float(last[n]), float(p_min[n]), float(p_max[n]), p_range))
 
-            print(f"[MAIL] sent to {email}")
+    metrics.alert_locations.inc(len(rows), kind="daily_range", outcome="evaluated")
+    metrics.alert_locations.inc(len(locations) - len(rows), kind="daily_range", outcome="no_data")
 
+    # ① 地点ごとに1行だけ保存
+    cur.executemany("""
+        INSERT OR REPLACE INTO location_pressure_daily
+        (location_id, date, pressure_hpa, p_min, p_max, p_range)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
     conn.commit()
-    conn.close()
-    click.echo("daily-pressure-check: done")
 
-@app.cli.command("night-forecast-alert")
-def night_forecast_alert_cmd():
+    # ② 変動幅を各ユーザーのしきい値と一度に比べ、超えた人のうち未送信の人だけ取り出す
+    users = thresholds.load(conn)
+    hits = thresholds.evaluate(users, [r[0] for r in rows], [r[5] for r in rows], direction="rise")
+    thresholds.record("daily_range", users, [r[0] for r in rows], hits)
+    targets = thresholds.unsent_users(cur, hits, today, "daily_range")
+
+    mails = []
+    for t in targets:
+        p_range, _, threshold, _ = hits[t["id"]]
+        mails.append(Mail(
+            to_addr=t["email"],
+            subject="P-Alert 気圧変動注意",
+            body=(
+                f"本日({today})の気圧変動幅は {p_range:.1f} hPa です"
+                f"（あなたのしきい値 {threshold:.1f} hPa）。体調にご注意ください。"
+            ),
+            tag=int(t["id"]),
+        ))
+
+    enqueue_and_deliver(conn, mails, today, "daily_range")
+    print("daily-pressure-check: done")
+
+@app.cli.command("daily-pressure-check")
+def daily_pressure_check_cmd():
+    daily_pressure_check()
+
+def night_forecast_alert():
     """
     前夜アラート：明日の中で危険(3時間低下が閾値以上)が予測されたら、今夜メール通知する
-    判定は pressure_msl（海面更正気圧）ベース
+    判定は pressure_msl（海面更正気圧）ベース、ユーザーの地点（格子セル）ごとに行う
     """
     today = datetime.now().strftime("%Y-%m-%d")
     tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
 
-    # 48hを取得（pressure_msl）
-    labels, values = fetch_pressure_48h_msl()  # 既にある関数（MSLP統一済み前提）
-
-    # 明日分だけ抽出
-    t_labels = []
-    t_values = []
-    for lb, v in zip(labels, values):
-        # labels は "YYYY-MM-DD HH:MM" 形式のはず
-        if str(lb).startswith(tomorrow):
-            t_labels.append(lb)
-            t_values.append(float(v))
-
-    if len(t_values) < 6:
-        print(f"[WARN] 明日のデータが十分に取れませんでした: count={len(t_values)}")
-        return
-
-    # 明日の中で「最も下がる3時間帯」を探す
-    best_i = None
-    best_drop = 0.0  # よりマイナスが危険
-    for i in range(0, len(t_values) - 3):
-        drop = t_values[i + 3] - t_values[i]  # 3時間変化（マイナスが低下）
-        if best_i is None or drop < best_drop:
-            best_i = i
-            best_drop = drop
-
-    danger = {
-        "start": t_labels[best_i],
-        "end": t_labels[best_i + 3],
-        "delta_hpa": round(best_drop, 1),
-    }
-
-    # リスク判定（3時間低下量ベース）
-    drop3_abs = abs(danger["delta_hpa"])
-    if drop3_abs >= 8:
-        risk = "警戒"
-        threshold = 8.0
-    elif drop3_abs >= 4:
-        risk = "注意"
-        threshold = 4.0
-    else:
-        risk = "安定"
-        threshold = 4.0
-
-    print(f"[INFO] tomorrow={tomorrow} danger={danger} risk={risk}")
-
-    # 安定なら通知しない
-    if risk == "安定":
-        print("[INFO] 安定のため通知なし")
-        return
-
     conn = get_conn()
     cur = conn.cursor()
 
-    users = cur.execute("SELECT id, email FROM users").fetchall()
-    if not users:
+    locations = ingest.active_locations(conn)
+    if not locations:
         print("[WARN] users が0件です（送信先なし）")
-        conn.close()
         return
 
-    for u in users:
-        user_id = int(u["id"])
-        email = u["email"]
-
-        # 「今日の夜」に1回だけ送る（date=today, kind='tomorrow_risk'）
-        cur.execute("""
-            SELECT 1 FROM alerts_sent
-            WHERE user_id=? AND date=? AND kind='tomorrow_risk'
-        """, (user_id, today))
-        if cur.fetchone():
-            print(f"[INFO] already sent (tomorrow_risk): {email}")
+    # 取り込み済みの毎時データ（pressure_msl）から明日分だけ読む
+    series = load_location_series(conn, locations, tomorrow).day(tomorrow)
+    counts = series.count()
+    for loc, count in zip(locations, counts):
+        if count < 6:
+            print(f"[WARN] location={loc['id']} 明日のデータが十分に取れませんでした: count={count}")
+    keep = counts >= 6
+    keys = [loc["id"] for loc, k in zip(locations, keep) if k]
+    labels = series.labels
+
+    # 全地点の「最も下がる3時間帯」を一度に求め、各ユーザーのしきい値でまとめて判定
+    scored = risk.score(series.rows(keep).values)
+    metrics.alert_locations.inc(len(keys), kind="tomorrow_risk", outcome="evaluated")
+    metrics.alert_locations.inc(len(locations) - len(keys), kind="tomorrow_risk", outcome="no_data")
+
+    windows = {}
+    for n, key in enumerate(keys):
+        if scored["start"][n] < 0:
             continue
+        windows[key] = (labels[scored["start"][n]], labels[scored["end"][n]])
+        print(f"[INFO] tomorrow={tomorrow} location={key} window={windows[key]} delta={scored['delta'][n]:.1f}")
+
+    users = thresholds.load(conn)
+    hits = thresholds.evaluate(users, keys, scored["delta"])
+    thresholds.record("tomorrow_risk", users, keys, hits)
+
+    # 「今日の夜」に1回だけ送る（date=today, kind='tomorrow_risk'）
+    targets = thresholds.unsent_users(cur, hits, today, "tomorrow_risk")
+    mails = []
+    for t in targets:
+        delta, level, threshold, location_id = hits[t["id"]]
+        start, end = windows[location_id]
+        level_name = risk.RISK_LEVELS[level]
+        mails.append(Mail(
+            to_addr=t["email"],
+            subject=f"P-Alert 予報 {level_name}（明日）",
+            body=(
+                f"明日({tomorrow})に気圧低下リスクが予測されています。\n\n"
+                f"リスク: {level_name}\n"
+                f"最も下がる3時間帯: {start} 〜 {end}\n"
+                f"3時間変化: {round(delta, 1)} hPa\n\n"
+                f"目安: 注意={threshold:.1f}hPa以上 / 警戒={threshold * risk.WARNING_HPA / risk.CAUTION_HPA:.1f}hPa以上"
+                f"（3時間変化・あなたの設定）\n"
+                f"無理のないスケジュールでどうぞ。"
+            ),
+            tag=int(t["id"]),
+        ))
+
+    enqueue_and_deliver(conn, mails, today, "tomorrow_risk")
+    print("night-forecast-alert: done")
 
-        subject = f"P-Alert 予報 {risk}（明日）"
-        body = (
-            f"明日({tomorrow})に気圧低下リスクが予測されています。\n\n"
-            f"リスク: {risk}\n"
-            f"最も下がる3時間帯: {danger['start']} 〜 {danger['end']}\n"
-            f"3時間変化: {danger['delta_hpa']} hPa\n\n"
-            f"目安: 注意=4hPa以上 / 警戒=8hPa以上（3時間変化）\n"
-            f"無理のないスケジュールでどうぞ。"
-        )
-
-        send_email(to_addr=email, subject=subject, body=body)
+@app.cli.command("night-forecast-alert")
+def night_forecast_alert_cmd():
+    night_forecast_alert()
 
-        cur.execute("""
-            INSERT OR IGNORE INTO alerts_sent (user_id, date, kind)
-            VALUES (?, ?, ?)
-        """, (user_id, today, "tomorrow_risk"))
+@app.cli.command("ingest")
+@click.option("--loop", is_flag=True, help="INGEST_INTERVAL ごとに取り込みを続ける")
+def ingest_cmd(loop):
+    """
+    予報の取り込み：地点ごとの毎時予報とダッシュボード文書を更新する
+    """
+    if not loop:
+        ingest.ingest_once(get_conn())
+        return
+    worker = ingest.IngestWorker()
+    worker.start()
+    worker.join()
+
+@app.cli.command("deliver-alerts")
+@click.option("--loop", is_flag=True, help="送るものが無くなっても待ち続ける（常駐ワーカー）")
+@click.option("--workers", default=outbox.OUTBOX_WORKERS, show_default=True, help="配信ワーカー数")
+@click.option("--requeue-dead", is_flag=True, help="dead の行を pending に戻してから送る")
+def deliver_alerts_cmd(loop, workers, requeue_dead):
+    """
+    アウトボックスの未送信アラートを送る
+    """
+    conn = get_conn()
+    if requeue_dead:
+        click.echo(f"requeued: {outbox.requeue_dead(conn)}")
+    outbox.deliver(workers=workers, until_empty=not loop)
+    click.echo(f"outbox: {outbox.stats(conn)}")
 
-        print(f"[MAIL] sent tomorrow_risk to {email}")
+@app.cli.command("recompute-sensitivity")
+def recompute_sensitivity_cmd():
+    """
+    気圧感受性を全ユーザー分作り直す（気圧データを後から取り込んだときなど）
+    """
+    n = analytics.recompute_all(get_conn())
+    click.echo(f"recomputed: {n} users")
+
+@app.cli.command("backfill-pressure")
+@click.option("--years", default=backfill.BACKFILL_YEARS, show_default=True, help="何年分さかのぼるか")
+@click.option("--start", help="開始日 YYYY-MM-DD（指定すると --years より優先）")
+@click.option("--end", help=f"終了日 YYYY-MM-DD（既定: 今日の {backfill.ARCHIVE_LAG_DAYS} 日前）")
+@click.option("--location", "location_ids", type=int, multiple=True, help="地点ID（複数可。既定: ユーザーのいる全地点）")
+@click.option("--restart", is_flag=True, help="チェックポイントを無視して最初から取り直す")
+def backfill_pressure_cmd(years, start, end, location_ids, restart):
+    """
+    過去の毎時気圧を archive API から取り込む（中断しても続きから再開できる）
+    """
+    default_start, default_end = backfill.default_range(years)
+    start = datetime.strptime(start, "%Y-%m-%d").date() if start else default_start
+    end = datetime.strptime(end, "%Y-%m-%d").date() if end else default_end
+    if start > end:
+        raise click.BadParameter("開始日が終了日より後です")
 
-    conn.commit()
-    conn.close()
-    print("night-forecast-alert: done")
+    conn = get_conn()
+    locations = ingest.active_locations(conn)
+    if location_ids:
+        locations = conn.execute(
+            f"SELECT id, lat, lon FROM locations WHERE id IN ({','.join('?' * len(location_ids))})",
+            location_ids,
+        ).fetchall()
+    click.echo(f"backfill: locations={len(locations)} {start} 〜 {end}")
+    result = backfill.backfill(conn, locations, start, end, restart)
+    click.echo(f"backfill: {result}")
+
+    # 履歴が増えたので気圧感受性も作り直す
+    click.echo(f"recomputed sensitivity: {analytics.recompute_all(conn)} users")
 
 # =========================
 # Main
 # =========================
 if __name__ == "__main__":
     init_db()
+    if os.getenv("INGEST_IN_PROCESS", "0") == "1":
+        ingest.IngestWorker().start()
     app.run(debug=True, use_reloader=False)
 
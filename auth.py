@@ -1,20 +1,25 @@
+import os
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 import sqlite3
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user, logout_user
 from user import User
+import db
+from db import get_conn
+import passwords
 
 auth_bp = Blueprint("auth", __name__)
 
-# DB接続（app.pyと同じロジック）
-import os
-DB_PATH = os.path.join(os.path.dirname(__file__), "mvp.db")
+# ハッシュのプールが混んでいる時、何秒後に再試行してもらうか
+LOGIN_RETRY_AFTER = int(os.getenv("LOGIN_RETRY_AFTER", "5"))
+
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+@auth_bp.app_errorhandler(passwords.HashBusy)
+def hash_busy(e):
+    # ハッシュの待ち行列がいっぱい → 計算せずにすぐ 503（フォームはそのまま出し直す）
+    mode = "register" if request.endpoint and request.endpoint.endswith("register") else "login"
+    flash("ただいまログインが混み合っています。少し時間をおいてもう一度お試しください。")
+    return render_template("auth.html", mode=mode), 503, {"Retry-After": str(LOGIN_RETRY_AFTER)}
 
 
 # =============================
@@ -26,17 +31,19 @@ def login():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
-        conn = get_conn()
-        user = conn.execute(
-            "SELECT id, pw_hash FROM users WHERE email = ?",
-            (email,)
-        ).fetchone()
-        conn.close()
+        # ハッシュの照合を待つ間は接続を持たない（読むときだけ借りてすぐ返す）
+        with db.connection() as conn:
+            user = conn.execute(
+                "SELECT id, pw_hash FROM users WHERE email = ?",
+                (email,)
+            ).fetchone()
 
-        if not user or not check_password_hash(user["pw_hash"], password):
+        if not user or not passwords.verify_password(user["pw_hash"], password):
             flash("メールまたはパスワードが違います")
             return redirect(url_for("auth.login"))
 
+        # 古い方式のハッシュなら今の設定で作り直す
+        passwords.upgrade(user["id"], user["pw_hash"], password)
         login_user(User(user["id"]))
         flash("ログインしました")
         return redirect(url_for("pressure.index"))
@@ -57,7 +64,7 @@ def register():
             flash("メールとパスワードは必須です")
             return redirect(url_for("auth.register"))
 
-        pw_hash = generate_password_hash(password)
+        pw_hash = passwords.hash_password(password)
 
         try:
             conn = get_conn()
@@ -66,7 +73,6 @@ def register():
                 (email, pw_hash, datetime.now().isoformat(timespec="seconds"))
             )
             conn.commit()
-            conn.close()
         except sqlite3.IntegrityError:
             flash("そのメールは既に登録されています")
             return redirect(url_for("auth.register"))
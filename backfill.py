@@ -0,0 +1,191 @@
+import os
+import time
+from collections import defaultdict, deque
+from datetime import date, timedelta
+
+import db
+import pressure_store
+from forecast import client
+
+# =========================
+# 過去の毎時気圧の取り込み（backfill-pressure）
+# =========================
+# Open-Meteo の過去データ API（archive）から地点ごとに何年分も読み、pressure_blocks に書く
+#   計画（地点 × 期間のリクエスト）→ 先読みつき取得 → 地点ごとに日ブロックへ詰めて書く
+# を全部ジェネレーターでつなぎ、メモリに載るのは先読み中のレスポンス数件分だけ
+# 書き込みは大きめのトランザクションで、同じトランザクションでチェックポイントも進める
+# → 途中で止まっても、次の実行は各地点の done_through の翌日から
+
+OPEN_METEO_ARCHIVE_URL = os.getenv("OPEN_METEO_ARCHIVE_URL", "https://archive-api.open-meteo.com/v1/archive")
+BACKFILL_YEARS = int(os.getenv("BACKFILL_YEARS", "10"))
+# 1リクエストの期間（日）と地点数。レスポンス1件 ≒ 日数 × 24 × 地点数 の値
+BACKFILL_CHUNK_DAYS = int(os.getenv("BACKFILL_CHUNK_DAYS", "366"))
+BACKFILL_BATCH_LOCATIONS = int(os.getenv("BACKFILL_BATCH_LOCATIONS", "20"))
+# 同時に投げておくリクエスト数（= メモリに載るレスポンスの上限）
+BACKFILL_PREFETCH = int(os.getenv("BACKFILL_PREFETCH", "4"))
+# この値数（時刻 × 地点）を超えたらコミットする
+BACKFILL_COMMIT_VALUES = int(os.getenv("BACKFILL_COMMIT_VALUES", "500000"))
+# archive は数日遅れで確定するので、既定の終了日は今日からこの日数前
+ARCHIVE_LAG_DAYS = int(os.getenv("ARCHIVE_LAG_DAYS", "5"))
+
+
+def default_range(years=BACKFILL_YEARS, today=None):
+    end = (today or date.today()) - timedelta(days=ARCHIVE_LAG_DAYS)
+    return end - timedelta(days=round(365.25 * years) - 1), end
+
+
+# ----------------------------
+# チェックポイント
+# ----------------------------
+def load_progress(conn, location_ids, start, restart=False):
+    """
+    地点ごとに「次に取る日」と、チェックポイントに書く開始日を決める
+    記録済みの範囲が start から途切れずにつながるときだけ続きから、それ以外は start から
+    戻り値: {location_id: (next_date, start_date)}
+    """
+    rows = {} if restart else {
+        r["location_id"]: r
+        for r in conn.execute("SELECT location_id, start_date, done_through FROM backfill_progress")
+    }
+    out = {}
+    for location_id in location_ids:
+        row = rows.get(location_id)
+        if row is not None:
+            row_start = date.fromisoformat(row["start_date"])
+            done = date.fromisoformat(row["done_through"])
+            if row_start <= start <= done + timedelta(days=1):
+                out[location_id] = (done + timedelta(days=1), row_start)
+                continue
+        out[location_id] = (start, start)
+    return out
+
+
+def _save_progress(conn, done):
+    # done: {location_id: (start_date, done_through)}
+    conn.executemany("""
+        INSERT INTO backfill_progress (location_id, start_date, done_through, updated_at)
+        VALUES (?, ?, ?, datetime('now'))
+        ON CONFLICT(location_id) DO UPDATE SET
+            start_date = excluded.start_date,
+            done_through = excluded.done_through,
+            updated_at = excluded.updated_at
+    """, ((i, s.isoformat(), d.isoformat()) for i, (s, d) in done.items()))
+
+
+# ----------------------------
+# パイプライン
+# ----------------------------
+def plan(progress, end, chunk_days=BACKFILL_CHUNK_DAYS, batch=BACKFILL_BATCH_LOCATIONS):
+    """
+    (期間の開始, 期間の終了, [地点, ...]) のリクエストを古い順に出す
+    次に取る日が同じ地点どうしを batch 地点ずつまとめる
+    progress: {location: next_date}（location は id / lat / lon を持つ行）
+    """
+    by_next = defaultdict(list)
+    for loc, next_date in progress.items():
+        if next_date <= end:
+            by_next[next_date].append(loc)
+
+    while by_next:
+        start = min(by_next)
+        locs = by_next.pop(start)
+        stop = min(start + timedelta(days=chunk_days - 1), end)
+        for i in range(0, len(locs), batch):
+            yield start, stop, locs[i:i + batch]
+        if stop < end:
+            by_next[stop + timedelta(days=1)].extend(locs)
+
+
+def fetch_ahead(requests, prefetch=BACKFILL_PREFETCH, base_url=None):
+    """
+    requests を prefetch 件ずつ先に投げておき、投げた順に (リクエスト, 系列) を返す
+    書き込みの間も次の取得が進む。取得に失敗したら残りは取り消して例外
+    """
+    base_url = base_url or OPEN_METEO_ARCHIVE_URL
+    pending = deque()
+
+    def submit(req):
+        start, stop, locs = req
+        coro = client.fetch_chunk(
+            [(l["lat"], l["lon"]) for l in locs], "hourly", base_url,
+            start_date=start.isoformat(), end_date=stop.isoformat(),
+        )
+        pending.append((req, client.submit(coro)))
+
+    requests = iter(requests)
+    try:
+        for req in requests:
+            submit(req)
+            if len(pending) >= prefetch:
+                req, fut = pending.popleft()
+                yield req, fut.result()
+        while pending:
+            req, fut = pending.popleft()
+            yield req, fut.result()
+    finally:
+        for _, fut in pending:
+            fut.cancel()
+
+
+def write(conn, locs, series):
+    # 1レスポンス → 地点ごとに pressure_store.write（戻り値: 書いた値の数）
+    written = 0
+    for loc, (times, pressures) in zip(locs, series):
+        if times:
+            written += pressure_store.write(conn, loc["id"], pressure_store.to_epochs(times), pressures)
+    return written
+
+
+# ----------------------------
+# 実行
+# ----------------------------
+def backfill(conn, locations, start, end, restart=False, base_url=None,
+             chunk_days=BACKFILL_CHUNK_DAYS, batch=BACKFILL_BATCH_LOCATIONS,
+             prefetch=BACKFILL_PREFETCH, commit_values=BACKFILL_COMMIT_VALUES):
+    """
+    locations の [start, end] を取り込む（済んでいる分は飛ばす）
+    戻り値: {"requests", "values", "locations", "elapsed_s"}
+    """
+    locations = list(locations)
+    progress = load_progress(conn, [l["id"] for l in locations], start, restart)
+    starts = {i: s for i, (_, s) in progress.items()}
+    todo = {l: progress[l["id"]][0] for l in locations}
+
+    started = time.perf_counter()
+    n_requests = n_values = pending = 0
+    done = {}
+
+    def commit():
+        _save_progress(conn, done)
+        conn.commit()
+        done.clear()
+
+    for (_, stop, locs), series in fetch_ahead(plan(todo, end, chunk_days, batch), prefetch, base_url):
+        written = write(conn, locs, series)
+        n_requests += 1
+        n_values += written
+        pending += written
+        for loc in locs:
+            done[loc["id"]] = (starts[loc["id"]], stop)
+
+        if pending >= commit_values:
+            commit()
+            pending = 0
+            print(f"[INFO] backfill: requests={n_requests} values={n_values} through={stop} "
+                  f"elapsed={time.perf_counter() - started:.1f}s")
+    commit()
+
+    elapsed = time.perf_counter() - started
+    print(f"[INFO] backfill: done requests={n_requests} values={n_values} elapsed={elapsed:.1f}s")
+    return {"requests": n_requests, "values": n_values, "locations": len(locations), "elapsed_s": round(elapsed, 2)}
+
+
+def backfill_once(locations=None, start=None, end=None, restart=False):
+    # アプリ外（ベンチマーク・スケジューラー）から呼ぶ入口
+    import ingest
+    with db.connection() as conn:
+        if locations is None:
+            locations = ingest.active_locations(conn)
+        if start is None or end is None:
+            start, end = default_range()
+        return backfill(conn, locations, start, end, restart)
@@ -0,0 +1,181 @@
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# =========================
+# 1ジョブを1プロセスで計測する（bench.run から呼ばれる）
+# python -m bench.job <job名>
+# DB_PATH / OPEN_METEO_URL / SMTP_* は呼び出し側が環境変数で渡す
+# =========================
+
+_db_lock = threading.Lock()
+_db = {"time": 0.0, "calls": 0}
+
+
+def _timed(fn, count=True):
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with _db_lock:
+                _db["time"] += elapsed
+                _db["calls"] += count
+    return wrapper
+
+
+class TimedCursor(sqlite3.Cursor):
+    execute = _timed(sqlite3.Cursor.execute)
+    executemany = _timed(sqlite3.Cursor.executemany)
+    fetchone = _timed(sqlite3.Cursor.fetchone)
+    fetchmany = _timed(sqlite3.Cursor.fetchmany)
+    fetchall = _timed(sqlite3.Cursor.fetchall)
+    # for row in cur: の1行ごとの読み出しも DB 時間に入れる
+    __next__ = _timed(sqlite3.Cursor.__next__, count=False)
+
+
+class TimedConnection(sqlite3.Connection):
+    # DB に居た時間（複数スレッドの合計なので wall を超えることがある）
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    commit = _timed(sqlite3.Connection.commit)
+
+
+def _sent_count(conn):
+    return conn.execute("SELECT COUNT(*) FROM alert_outbox WHERE status = 'sent'").fetchone()[0]
+
+
+def _risk(conn):
+    import pressure_store
+    import risk
+
+    locations = [r[0] for r in conn.execute("SELECT id FROM locations")]
+    first, last = conn.execute("SELECT MIN(base_epoch), MAX(base_epoch) FROM pressure_blocks").fetchone()
+    if first is None:
+        return 0, {}
+    epochs, matrix = pressure_store.read_matrix(conn, locations, first, last + pressure_store.DAY)
+    has = ~np.isnan(matrix).all(axis=1)
+    matrix = matrix[has]
+    labels = pressure_store.to_labels(epochs)
+    values = [[None if v != v else v for v in row] for row in matrix[:5000].tolist()]
+
+    started = time.perf_counter()
+    risk.score(matrix)
+    batch = time.perf_counter() - started
+
+    # /api/pressure 相当の1系列ずつの判定（最大 5000 系列）
+    n = min(len(values), 5000)
+    started = time.perf_counter()
+    for i in range(n):
+        risk.danger_window(labels, values[i])
+    single = time.perf_counter() - started
+    return len(matrix), {"batch_s": round(batch, 4), "per_series_us": round(single / max(n, 1) * 1e6, 1)}
+
+
+def _api(web, requests=2000):
+    users = web.get_conn().execute("SELECT MAX(id) FROM users").fetchone()[0]
+    client = web.app.test_client()
+    rnd = random.Random(1)
+    for _ in range(requests):
+        with client.session_transaction() as s:
+            s["_user_id"] = str(rnd.randint(1, users))
+        client.get("/api/pressure", headers={"Accept-Encoding": "gzip"})
+    return requests, {}
+
+
+def _backfill():
+    # BENCH_BACKFILL_YEARS 年分（既定1年）を全地点ぶん
+    import backfill
+    import db
+
+    with db.connection() as conn:
+        locations = conn.execute("SELECT id, lat, lon FROM locations").fetchall()
+    start, end = backfill.default_range(int(os.getenv("BENCH_BACKFILL_YEARS", "1")))
+    r = backfill.backfill_once(locations, start, end, restart=True)
+    return r["values"], {"locations": r["locations"], "requests": r["requests"]}
+
+
+def main(job):
+    import db
+    db.pool.factory = TimedConnection
+
+    started = time.perf_counter()
+    import app as web
+    import ingest
+    import outbox
+    import pressure_job
+    startup = time.perf_counter() - started
+
+    with db.connection() as conn:
+        sent_before = _sent_count(conn)
+
+    extra = {}
+    items = None
+    _db.update(time=0.0, calls=0)
+    started = time.perf_counter()
+    if job == "ingest":
+        items = ingest.ingest_once()
+    elif job == "daily-pressure-check":
+        with web.app.app_context():
+            web.daily_pressure_check()
+    elif job == "night-forecast-alert":
+        with web.app.app_context():
+            web.night_forecast_alert()
+    elif job == "daily-delta-check":
+        pressure_job.run_daily_pressure_check()
+    elif job == "risk":
+        with db.connection() as conn:
+            items, extra = _risk(conn)
+    elif job == "api":
+        with web.app.app_context():
+            items, extra = _api(web)
+    elif job == "backfill":
+        items, extra = _backfill()
+    else:
+        raise SystemExit(f"unknown job: {job}")
+    wall = time.perf_counter() - started
+
+    with db.connection() as conn:
+        messages = _sent_count(conn) - sent_before
+
+    rss = None
+    if resource is not None:
+        rss = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    result = {
+        "startup_s": round(startup, 3),
+        "wall_s": round(wall, 3),
+        "db_s": round(_db["time"], 3),
+        "db_calls": _db["calls"],
+        "peak_rss_mb": rss,
+        "messages": messages,
+        "msg_per_s": round(messages / wall, 1) if messages and wall else None,
+        "items": items,
+        "items_per_s": round(items / wall, 1) if items and wall else None,
+        **extra,
+    }
+    # 最終行に JSON（それ以前の出力はジョブのログ）
+    print("BENCH_RESULT " + json.dumps(result))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
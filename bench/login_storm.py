@@ -0,0 +1,221 @@
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+import click
+
+from bench.stubs import OpenMeteoStub
+
+# =========================
+# ログイン殺到時の応答時間
+# =========================
+# 使い方（リポジトリ直下で）:
+#   python -m bench.login_storm --clients 32 --seconds 10
+#
+# python wsgi.py（1プロセス・スレッド）を別プロセスで立て、
+#   1) ダッシュボード（/api/pressure）だけを叩いて平常時の応答時間を測る
+#   2) clients 本のスレッドで /login を投げ続けながら、同じようにダッシュボードを測る
+# を「その場で計算（PASSWORD_HASH_WORKERS=0）」と「プロセスプール」で比べる
+# ユーザーのハッシュは旧方式（pbkdf2:sha256:600000）で入れておく（ログインで作り直される）
+# DB_POOL_SIZE はクライアント数より小さくしておき、ログインがハッシュを待つ間に接続を持っていないことも見る
+# （持っていればダッシュボードが PoolTimeout で 500 になり、dash_errors に数えられる）
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+PASSWORD = "bench-password"
+LEGACY_METHOD = "pbkdf2:sha256:600000"
+PROBE_INTERVAL = 0.05
+# 503 を受けたクライアントが押し直すまでの平均秒数
+REJECT_BACKOFF = 1.0
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 1)
+
+
+def make_db(path, users):
+    from werkzeug.security import generate_password_hash
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    from migrations import migrate
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    migrate(conn, verbose=False)
+    legacy = generate_password_hash(PASSWORD, LEGACY_METHOD)
+    conn.executemany(
+        "INSERT INTO users (email, pw_hash, created_at) VALUES (?, ?, datetime('now'))",
+        ((f"user{i}@bench.invalid", legacy) for i in range(users)),
+    )
+    conn.commit()
+    conn.close()
+
+
+class Server:
+    def __init__(self, db_path, env):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc = subprocess.Popen(
+            [sys.executable, "wsgi.py"], cwd=ROOT,
+            env={**env, "DB_PATH": db_path, "WEB_HOST": "127.0.0.1", "WEB_PORT": str(self.port)},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(self.url + "/login", timeout=1).read()
+                return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("server did not start")
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def _client():
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+
+def login(opener, url, email):
+    data = urllib.parse.urlencode({"email": email, "password": PASSWORD}).encode()
+    started = time.perf_counter()
+    try:
+        with opener.open(url + "/login", data, timeout=60) as r:
+            r.read()
+            status = r.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+
+def probe(opener, url, stop, out, errors):
+    # ダッシュボードを PROBE_INTERVAL ごとに叩き、応答時間を out に、失敗した応答の状態コードを errors に溜める
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            with opener.open(url + "/api/pressure", timeout=60) as r:
+                r.read()
+            out.append(time.perf_counter() - started)
+        except urllib.error.HTTPError as e:
+            errors.append(e.code)
+        stop.wait(PROBE_INTERVAL)
+
+
+def run_mode(name, db_template, env, users, clients, seconds):
+    db_path = os.path.join(DATA_DIR, f"login_{name}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    shutil.copyfile(db_template, db_path)
+
+    server = Server(db_path, env)
+    try:
+        dashboard = _client()
+        login(dashboard, server.url, "user0@bench.invalid")
+
+        # 平常時
+        quiet, errors = [], []
+        stop = threading.Event()
+        t = threading.Thread(target=probe, args=(dashboard, server.url, stop, quiet, errors))
+        t.start()
+        time.sleep(min(3, seconds))
+        stop.set()
+        t.join()
+
+        # ログイン殺到中
+        busy, logins = [], []
+        stop = threading.Event()
+        lock = threading.Lock()
+
+        def storm(seed):
+            rnd = random.Random(seed)
+            opener = _client()
+            while not stop.is_set():
+                status, elapsed = login(opener, server.url, f"user{rnd.randrange(1, users)}@bench.invalid")
+                with lock:
+                    logins.append((status, elapsed))
+                if status == 503:
+                    # 断られた人は少し待ってから押し直す
+                    stop.wait(rnd.uniform(0.5, 1.5) * REJECT_BACKOFF)
+
+        threads = [threading.Thread(target=storm, args=(i,)) for i in range(clients)]
+        threads.append(threading.Thread(target=probe, args=(dashboard, server.url, stop, busy, errors)))
+        for th in threads:
+            th.start()
+        time.sleep(seconds)
+        stop.set()
+        for th in threads:
+            th.join()
+    finally:
+        server.stop()
+
+    ok = [e for s, e in logins if s == 200]
+    rejected = [e for s, e in logins if s == 503]
+    return {
+        "logins": len(logins),
+        "ok": len(ok),
+        "rejected": len(rejected),
+        "login_p50_ms": _percentile(ok, 0.5),
+        "login_p99_ms": _percentile(ok, 0.99),
+        "reject_p99_ms": _percentile(rejected, 0.99),
+        "dash_quiet_p99_ms": _percentile(quiet, 0.99),
+        "dash_storm_p50_ms": _percentile(busy, 0.5),
+        "dash_storm_p99_ms": _percentile(busy, 0.99),
+        "dash_errors": len(errors),
+    }
+
+
+@click.command()
+@click.option("--users", default=500, show_default=True, help="ユーザー数")
+@click.option("--clients", default=32, show_default=True, help="同時にログインし続けるクライアント数")
+@click.option("--seconds", default=10, show_default=True, help="殺到させる秒数")
+@click.option("--pool-size", default=4, show_default=True, help="サーバーの DB_POOL_SIZE（clients より小さく）")
+def main(users, clients, seconds, pool_size):
+    sys.path.insert(0, ROOT)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    template = os.path.join(DATA_DIR, "login_template.db")
+    make_db(template, users)
+
+    meteo = OpenMeteoStub().start()
+    env = {**os.environ, "OPEN_METEO_URL": meteo.url, "PYTHONPATH": ROOT, "DB_POOL_SIZE": str(pool_size)}
+    modes = {
+        "inline": {**env, "PASSWORD_HASH_WORKERS": "0"},
+        "pool": env,
+    }
+    results = {name: run_mode(name, template, e, users, clients, seconds) for name, e in modes.items()}
+
+    keys = list(results["pool"])
+    print(f"{'':8}" + "".join(f"{k:>18}" for k in keys))
+    for name, r in results.items():
+        print(f"{name:8}" + "".join(f"{str(r[k]):>18}" for k in keys))
+    if any(r["dash_errors"] for r in results.values()):
+        raise SystemExit("[ERROR] ログイン殺到中にダッシュボードが失敗しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import time
+
+import click
+import numpy as np
+
+# =========================
+# ナウキャストの CPU 時間（全体をなめ直す vs 新しい値だけ流す）
+# =========================
+# 使い方（リポジトリ直下で）:
+#   python -m bench.nowcast --locations 2000 --interval 30
+#
+# 1日分の15分値（bench.stubs と同じ合成系列）を、取り込みの周期（interval 分）ごとに
+#   rescan:      それまでの全部の値を配列にして risk.score（15分刻み・3時間窓）で判定し直す
+#   incremental: nowcast.Nowcast.update で前回より新しい値だけを検知器に流す
+# として、1地点・1周期あたりの CPU 時間を比べる（取得した応答の形 (times, values) から判定まで）
+
+
+def _series(locations, alert_share):
+    from datetime import datetime
+
+    from bench.stubs import series
+
+    start = datetime(2026, 1, 1)
+    rnd = np.random.default_rng(1)
+    coords = rnd.uniform((24, 123), (46, 146), (locations, 2)).round(4)
+    return [series(lat, lon, start, 96, 15, alert_share) for lat, lon in coords]
+
+
+def rescan(data, now):
+    import pressure_store
+    import risk
+
+    # 毎周期、今までの値を全部読み直して判定する
+    labels = [t for times, _ in data for t in times]
+    epochs = pressure_store.to_epochs(labels).reshape(len(data), -1)
+    n = int((epochs[0] <= now).sum())
+    matrix = risk.to_matrix([values[:n] for _, values in data])
+    return risk.score(matrix, step_minutes=15)["level"]
+
+
+def incremental(state, ids, data, now):
+    import nowcast
+
+    state.update(ids, data, now)
+    return state.current(ids, now, max_age=nowcast.NOWCAST_STEP)
+
+
+@click.command()
+@click.option("--locations", default=2000, show_default=True, help="地点数")
+@click.option("--interval", default=30, show_default=True, help="取り込みの周期（分）")
+@click.option("--alert-share", default=0.05, show_default=True, help="荒れる地点の割合")
+def main(locations, interval, alert_share):
+    import nowcast
+    import pressure_store
+
+    data = _series(locations, alert_share)
+    ids = list(range(1, locations + 1))
+    start = int(pressure_store.to_epochs([data[0][0][0]])[0])
+    cycles = [start + k * interval * 60 for k in range(1, 24 * 60 // interval + 1)]
+    print(f"[INFO] locations={locations} cycles={len(cycles)} samples/location={len(data[0][0])}")
+
+    results = {}
+    for name in ("rescan", "incremental"):
+        state = nowcast.Nowcast()
+        started = time.process_time()
+        for now in cycles:
+            if name == "rescan":
+                rescan(data, now)
+            else:
+                incremental(state, ids, data, now)
+        cpu = time.process_time() - started
+        results[name] = {
+            "cpu_s": round(cpu, 3),
+            "us_per_location_cycle": round(cpu / (locations * len(cycles)) * 1e6, 2),
+        }
+
+    keys = list(results["rescan"])
+    print(f"{'':12}" + "".join(f"{k:>24}" for k in keys))
+    for name, r in results.items():
+        print(f"{name:12}" + "".join(f"{str(r[k]):>24}" for k in keys))
+    print(f"{'ratio':12}{results['rescan']['cpu_s'] / max(results['incremental']['cpu_s'], 1e-9):>23.1f}x")
+
+
+if __name__ == "__main__":
+    main()
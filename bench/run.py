@@ -0,0 +1,191 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import click
+
+from bench import synth
+from bench.stubs import OpenMeteoStub, SmtpStub
+
+# =========================
+# ベンチマーク
+# =========================
+# 使い方（リポジトリ直下で）:
+#   python -m bench.run --users 1k,100k                 計測して bench/results/ に保存
+#   python -m bench.run --users 1k --save-baseline main  bench/baselines/main.json に保存
+#   python -m bench.run --users 1k --compare main        ベースラインと比較（悪化を表示）
+#
+# ユーザー数ごとに合成 DB を作り（bench/data/、--reuse で使い回し）、
+# ジョブごとに DB を複製して別プロセスで実行する（RSS とキャッシュの状態をそろえるため）
+# Open-Meteo と SMTP はこのプロセス内のスタブに向ける
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+BASELINES_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# 実行順（ingest で毎時データとスナップショットができてから他を回す）
+JOBS = ("ingest", "daily-pressure-check", "daily-delta-check", "night-forecast-alert", "risk", "api")
+# --jobs で指定したときだけ回す（重いもの）
+OPTIONAL_JOBS = ("backfill",)
+# 比較するときの指標と、悪化とみなす割合
+METRICS = ("wall_s", "db_s", "peak_rss_mb", "msg_per_s", "items_per_s")
+HIGHER_IS_BETTER = {"msg_per_s", "items_per_s"}
+
+
+def parse_size(s):
+    s = s.strip().lower()
+    for suffix, mul in (("m", 1_000_000), ("k", 1_000)):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * mul)
+    return int(s)
+
+
+def _copy_db(src, dst):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(dst + suffix):
+            os.remove(dst + suffix)
+    shutil.copyfile(src, dst)
+
+
+def run_job(job, db_path, env):
+    proc = subprocess.run(
+        [sys.executable, "-m", "bench.job", job],
+        cwd=ROOT, env={**env, "DB_PATH": db_path}, capture_output=True, text=True,
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line[len("BENCH_RESULT "):])
+    raise RuntimeError(f"{job} failed:\n{proc.stdout[-2000:]}\n{proc.stderr[-2000:]}")
+
+
+def run_size(users, jobs, env, reuse=False):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    template = os.path.join(DATA_DIR, f"users_{users}.db")
+    if not (reuse and os.path.exists(template)):
+        synth.generate(template, users)
+
+    # 1回ぶんの作業用 DB（ジョブはこの上で順に状態を積み上げる）
+    work = os.path.join(DATA_DIR, f"run_{users}.db")
+    _copy_db(template, work)
+
+    results = {}
+    for job in jobs:
+        r = run_job(job, work, env)
+        results[job] = r
+        print(f"[INFO] users={users} {job}: wall={r['wall_s']}s db={r['db_s']}s "
+              f"rss={r['peak_rss_mb']}MB msgs={r['messages']} msg/s={r['msg_per_s']} "
+              f"items/s={r['items_per_s']}")
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, baseline, tolerance):
+    """
+    同じユーザー数・ジョブ・指標どうしを比べ、tolerance を超えて悪くなったものを返す
+    """
+    regressions = []
+    for size, jobs in current["results"].items():
+        for job, metrics in jobs.items():
+            base = baseline["results"].get(size, {}).get(job)
+            if not base:
+                continue
+            for m in METRICS:
+                new, old = metrics.get(m), base.get(m)
+                if not new or not old:
+                    continue
+                change = (new - old) / old
+                worse = -change if m in HIGHER_IS_BETTER else change
+                mark = "REGRESSION" if worse > tolerance else ""
+                print(f"{size:>8} {job:22} {m:12} {old:>10} -> {new:>10} ({change:+.1%}) {mark}")
+                if mark:
+                    regressions.append((size, job, m, old, new))
+    return regressions
+
+
+@click.command()
+@click.option("--users", default="1k", show_default=True, help="ユーザー数（カンマ区切り, 例: 1k,100k,1m）")
+@click.option("--jobs", default=",".join(JOBS), show_default=True,
+              help=f"計測するジョブ（カンマ区切り。ほかに {', '.join(OPTIONAL_JOBS)}）")
+@click.option("--alert-share", default=0.05, show_default=True, help="アラートが出る地点の割合")
+@click.option("--reuse", is_flag=True, help="bench/data の合成 DB があれば使い回す")
+@click.option("--save-baseline", metavar="NAME", help="結果を bench/baselines/NAME.json に保存")
+@click.option("--compare", "compare_to", metavar="NAME", help="bench/baselines/NAME.json と比較")
+@click.option("--tolerance", default=0.10, show_default=True, help="悪化とみなす割合")
+def main(users, jobs, alert_share, reuse, save_baseline, compare_to, tolerance):
+    jobs = [j.strip() for j in jobs.split(",") if j.strip()]
+    unknown = set(jobs) - set(JOBS) - set(OPTIONAL_JOBS)
+    if unknown:
+        raise click.BadParameter(f"不明なジョブ: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, ROOT)
+    meteo = OpenMeteoStub(alert_share=alert_share).start()
+    smtp = SmtpStub().start()
+    env = {
+        **os.environ,
+        "OPEN_METEO_URL": meteo.url,
+        "OPEN_METEO_ARCHIVE_URL": meteo.archive_url,
+        "SMTP_HOST": smtp.address[0],
+        "SMTP_PORT": str(smtp.address[1]),
+        "SMTP_STARTTLS": "0",
+        "SMTP_USER": "",
+        "MAIL_FROM": "bench@bench.invalid",
+        "PYTHONPATH": ROOT,
+    }
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "alert_share": alert_share,
+        },
+        "results": {},
+    }
+    started = time.perf_counter()
+    for size in users.split(","):
+        n = parse_size(size)
+        report["results"][str(n)] = run_size(n, jobs, env, reuse)
+    report["meta"]["total_s"] = round(time.perf_counter() - started, 1)
+    report["meta"]["stub_requests"] = meteo.requests
+    report["meta"]["stub_messages"] = smtp.messages
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"[INFO] saved {out}")
+
+    if save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        path = os.path.join(BASELINES_DIR, f"{save_baseline}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[INFO] baseline saved {path}")
+
+    if compare_to:
+        with open(os.path.join(BASELINES_DIR, f"{compare_to}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance)
+        if regressions:
+            print(f"[WARN] regressions: {len(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import random
+import sqlite3
+import time
+
+import click
+import numpy as np
+
+# =========================
+# 毎時気圧の保存形式の比較
+# =========================
+# 使い方（リポジトリ直下で）:
+#   python -m bench.storage --locations 200 --days 365
+#
+# 同じ合成データを「1行 1値」（旧 pressure_hourly）と「地点 × 日の float32 ブロック」
+# （pressure_blocks）の2つの DB に書き、ファイルサイズと読み出しの速さを比べる
+#   window:  全地点の直近2日（アラートジョブ・取り込み後の判定）
+#   history: 1地点の全期間（気圧感受性などの過去データ）を地点を変えて何回か
+#   full:    全地点の全期間
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+HISTORY_SAMPLES = 50
+
+
+def _open(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _size_mb(conn, path):
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return round(os.path.getsize(path) / 1e6, 2)
+
+
+def _series(rnd, hours):
+    # 1010hPa 前後のランダムウォーク（0.1hPa 単位）
+    steps = np.array([rnd.gauss(0, 0.4) for _ in range(hours)])
+    return np.round(1010 + np.cumsum(steps), 1)
+
+
+def _timed(fn, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return round((time.perf_counter() - started) / repeat, 4)
+
+
+# ----------------------------
+# 1行 1値
+# ----------------------------
+def bench_rows(path, data, start, days):
+    import risk
+    import pressure_store
+
+    conn = _open(path)
+    conn.execute("""
+        CREATE TABLE pressure_hourly (
+            location_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            pressure_hpa REAL,
+            PRIMARY KEY(location_id, ts)
+        ) WITHOUT ROWID
+    """)
+    labels = pressure_store.to_labels(start + np.arange(days * 24) * pressure_store.STEP)
+
+    started = time.perf_counter()
+    for location_id, values in data.items():
+        conn.executemany(
+            "INSERT INTO pressure_hourly VALUES (?, ?, ?)",
+            zip([location_id] * len(labels), labels, values.tolist()),
+        )
+    conn.commit()
+    write_s = round(time.perf_counter() - started, 3)
+
+    def read(sql, params):
+        # 旧 ingest.load_hourly と同じく地点ごとのリストに集めてから配列にする
+        by_loc = {}
+        for location_id, _, p in conn.execute(sql, params):
+            by_loc.setdefault(location_id, []).append(p)
+        return risk.to_matrix(list(by_loc.values()))
+
+    ids = list(data)
+    rnd = random.Random(2)
+    window = (labels[-48], "9999")
+    return {
+        "write_s": write_s,
+        "size_mb": _size_mb(conn, path),
+        "window_s": _timed(lambda: read(
+            "SELECT * FROM pressure_hourly WHERE ts >= ? AND ts < ? ORDER BY location_id, ts", window
+        )),
+        "history_s": _timed(lambda: read(
+            "SELECT * FROM pressure_hourly WHERE location_id = ? ORDER BY ts", (rnd.choice(ids),)
+        ), HISTORY_SAMPLES),
+        "full_s": _timed(lambda: read("SELECT * FROM pressure_hourly ORDER BY location_id, ts", ())),
+    }
+
+
+# ----------------------------
+# 地点 × 日のブロック
+# ----------------------------
+def bench_blocks(path, data, start, days):
+    import pressure_store
+
+    conn = _open(path)
+    conn.execute("""
+        CREATE TABLE pressure_blocks (
+            location_id INTEGER NOT NULL,
+            base_epoch INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY(location_id, base_epoch)
+        ) WITHOUT ROWID
+    """)
+    epochs = start + np.arange(days * 24) * pressure_store.STEP
+    end = int(epochs[-1]) + pressure_store.STEP
+
+    started = time.perf_counter()
+    for location_id, values in data.items():
+        pressure_store.write(conn, location_id, epochs, values)
+    conn.commit()
+    write_s = round(time.perf_counter() - started, 3)
+
+    ids = list(data)
+    rnd = random.Random(2)
+    return {
+        "write_s": write_s,
+        "size_mb": _size_mb(conn, path),
+        "window_s": _timed(lambda: pressure_store.read_matrix(conn, ids, end - 48 * pressure_store.STEP, end)),
+        "history_s": _timed(lambda: pressure_store.read_series(conn, rnd.choice(ids), start, end), HISTORY_SAMPLES),
+        "full_s": _timed(lambda: pressure_store.read_matrix(conn, ids, start, end)),
+    }
+
+
+@click.command()
+@click.option("--locations", default=200, show_default=True, help="地点数")
+@click.option("--days", default=365, show_default=True, help="日数")
+def main(locations, days):
+    import pressure_store
+
+    rnd = random.Random(1)
+    data = {i: _series(rnd, days * 24) for i in range(1, locations + 1)}
+    start = pressure_store.day_epoch("2020-01-01")
+    os.makedirs(DATA_DIR, exist_ok=True)
+    print(f"[INFO] locations={locations} days={days} values={locations * days * 24}")
+
+    results = {
+        "rows": bench_rows(os.path.join(DATA_DIR, "storage_rows.db"), data, start, days),
+        "blocks": bench_blocks(os.path.join(DATA_DIR, "storage_blocks.db"), data, start, days),
+    }
+    print(f"{'':8}" + "".join(f"{k:>12}" for k in results["rows"]))
+    for name, r in results.items():
+        print(f"{name:8}" + "".join(f"{v:>12}" for v in r.values()))
+    print(f"{'ratio':8}" + "".join(
+        f"{results['rows'][k] / max(results['blocks'][k], 1e-9):>11.1f}x" for k in results["rows"]
+    ))
+
+
+if __name__ == "__main__":
+    main()
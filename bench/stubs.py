@@ -0,0 +1,196 @@
+import gzip
+import json
+import math
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# =========================
+# ベンチマーク用の上流スタブ（Open-Meteo / SMTP）
+# =========================
+
+
+def amplitude(lat, lon, alert_share):
+    # 座標から決まる擬似乱数で「荒れる地点」を alert_share の割合だけ作る
+    r = math.sin(lat * 12.9898 + lon * 78.233) * 43758.5453
+    return 8.0 if r - math.floor(r) < alert_share else 1.5
+
+
+def series(lat, lon, start, n, step_minutes, alert_share):
+    # 1日周期の正弦波（荒れる地点は 3時間で 4hPa 以上下がる）
+    amp = amplitude(lat, lon, alert_share)
+    phase = (lat + lon) % (2 * math.pi)
+    times, values = [], []
+    for i in range(n):
+        t = start + timedelta(minutes=step_minutes * i)
+        h = (t - start).total_seconds() / 3600
+        times.append(t.strftime("%Y-%m-%dT%H:%M"))
+        values.append(round(1013 + amp * math.sin(2 * math.pi * h / 24 + phase), 1))
+    return times, values
+
+
+class OpenMeteoStub:
+    """
+    /v1/jma・/v1/archive 互換（複数座標・forecast_days・start_date/end_date・hourly/minutely_15）
+    keep-alive あり。requests に受けたリクエスト数を数える
+    応答の形はテスト用に後から変えられる
+      chunked: Transfer-Encoding: chunked で返す（chunk_size バイトずつ）
+      gzip:    Accept-Encoding: gzip のリクエストには gzip で返す
+      fail:    先頭から順に、このステータスで断る（429・503 など。空になったら普通に返す）
+      malformed: 先頭から順に、200 でこの本文（バイト列。gzip もせずそのまま）を返す（途中で切れた JSON など）
+      delay:   応答までに待つ秒数
+    in_flight / max_in_flight に同時に処理中のリクエスト数（とその最大）を持つ
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, alert_share=0.05):
+        stub = self
+        self.alert_share = alert_share
+        self.requests = 0
+        self.chunked = False
+        self.chunk_size = 1024
+        self.gzip = False
+        self.fail = []
+        self.malformed = []
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    status = stub.fail.pop(0) if stub.fail else 200
+                    raw = stub.malformed.pop(0) if status == 200 and stub.malformed else None
+                try:
+                    if stub.delay:
+                        time.sleep(stub.delay)
+                    if raw is not None:
+                        body = raw
+                    elif status == 200:
+                        body = json.dumps(stub.respond(parse_qs(urlparse(self.path).query))).encode()
+                    else:
+                        body = json.dumps({"error": True, "reason": f"HTTP {status}"}).encode()
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    if stub.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+                        if raw is None:
+                            body = gzip.compress(body)
+                        self.send_header("Content-Encoding", "gzip")
+                    if stub.chunked:
+                        self.send_header("Transfer-Encoding", "chunked")
+                        self.end_headers()
+                        for i in range(0, len(body), stub.chunk_size):
+                            part = body[i:i + stub.chunk_size]
+                            self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+                        self.wfile.write(b"0\r\n\r\n")
+                    else:
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def respond(self, q):
+        lats = [float(x) for x in q["latitude"][0].split(",")]
+        lons = [float(x) for x in q["longitude"][0].split(",")]
+        key = "minutely_15" if "minutely_15" in q else "hourly"
+        step = 15 if key == "minutely_15" else 60
+        if "start_date" in q:
+            start = datetime.fromisoformat(q["start_date"][0])
+            end = datetime.fromisoformat(q["end_date"][0]) + timedelta(days=1)
+        else:
+            start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=int(q.get("forecast_days", ["7"])[0]))
+        n = int((end - start).total_seconds() // (step * 60))
+
+        out = []
+        for lat, lon in zip(lats, lons):
+            times, values = series(lat, lon, start, n, step, self.alert_share)
+            out.append({"latitude": lat, "longitude": lon, key: {"time": times, "pressure_msl": values}})
+        return out[0] if len(out) == 1 else out
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/v1/jma"
+
+    @property
+    def archive_url(self):
+        # 過去データ API（archive）の代わり。start_date / end_date で同じ系列を返す
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/v1/archive"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stub-open-meteo", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class SmtpStub:
+    """
+    受け取るだけの SMTP サーバー（EHLO / MAIL / RCPT / DATA / RSET / NOOP / QUIT）
+    messages に受信数を数える
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        stub = self
+        self.messages = 0
+        self._lock = threading.Lock()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                self.reply("220 bench ESMTP")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    cmd = line[:4].upper()
+                    if cmd == b"EHLO":
+                        self.reply("250-bench")
+                        self.reply("250 8BITMIME")
+                    elif cmd == b"DATA":
+                        self.reply("354 end with .")
+                        while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                            pass
+                        with stub._lock:
+                            stub.messages += 1
+                        self.reply("250 OK")
+                    elif cmd == b"QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stub-smtp", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
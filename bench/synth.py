@@ -0,0 +1,62 @@
+import os
+import random
+import sqlite3
+import time
+from datetime import date, timedelta
+
+# =========================
+# 合成 DB（mvp.db と同じスキーマ）
+# =========================
+# 日本の範囲に一様にユーザーを置く。格子セル（GRID_STEP）ごとに地点ができるので
+# ユーザー数が増えると地点数も増える（0.05度格子で最大 ~5.7万地点）
+
+LAT_RANGE = (31.0, 43.0)
+LON_RANGE = (130.0, 142.0)
+PW_HASH = "scrypt:32768:8:1$bench$" + "0" * 128
+
+
+def generate(path, users, seed=1):
+    """
+    path に users 人ぶんの DB を作る（既にあれば作り直す）
+    ユーザー・設定・地点の割り当てと、前日の地点気圧（daily-delta 用）まで入れる
+    """
+    from migrations import assign_locations, migrate
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    started = time.perf_counter()
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    migrate(conn, verbose=False)
+
+    batch = 50_000
+    for first in range(1, users + 1, batch):
+        ids = range(first, min(first + batch, users + 1))
+        conn.executemany(
+            "INSERT INTO users (id, email, pw_hash, created_at, lat, lon) VALUES (?, ?, ?, datetime('now'), ?, ?)",
+            ((i, f"user{i}@bench.invalid", PW_HASH, rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE)) for i in ids),
+        )
+        conn.executemany(
+            "INSERT INTO user_settings (user_id, base_threshold, drink_offset, pollen_enabled) VALUES (?, ?, ?, ?)",
+            ((i, rnd.choice((3.0, 4.0, 5.0)), rnd.choice((0.0, 0.5, 1.0)), rnd.randint(0, 1)) for i in ids),
+        )
+    conn.commit()
+
+    assign_locations(conn)
+    yday = (date.today() - timedelta(days=1)).isoformat()
+    conn.execute("""
+        INSERT OR REPLACE INTO location_pressure_daily (location_id, date, pressure_hpa)
+        SELECT id, ?, 1013.0 FROM locations
+    """, (yday,))
+    conn.commit()
+
+    locations = conn.execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    print(f"[INFO] synth {path}: users={users} locations={locations} "
+          f"elapsed={time.perf_counter() - started:.1f}s")
+    return locations
@@ -0,0 +1,417 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+# =========================
+# 汎用 LRU + TTL キャッシュ
+# =========================
+class LRUCache:
+    """
+    スレッドセーフな LRU キャッシュ（TTL 付き）
+    maxsize を超えたら最も古く使われたものから捨てる
+    maxsize が 0 なら何も持たない（disable() 後。get は常にミス）
+    """
+
+    def __init__(self, maxsize=256, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_entry(self, key):
+        # ロック取得済みで呼ぶこと
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def _set_entry(self, key, value, stored_at=None):
+        # ロック取得済みで呼ぶこと
+        self._data[key] = (value, time.monotonic() if stored_at is None else stored_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set_entry(key, value)
+
+    def disable(self):
+        # 以後は何も持たない（書き込みを他のプロセスに知らせられない複数ワーカーで使う）
+        with self._lock:
+            self.maxsize = 0
+            self._data.clear()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else None,
+            }
+
+
+# =========================
+# 予報キャッシュ
+# =========================
+# ForecastCache（プロセス内）と SharedCache（プロセス間）の stats() が共通で持つ数値の項目
+# （どちらを使っても同じゲージの項目が出る）
+CACHE_STATS = (
+    "size", "hits", "misses", "evictions", "stale_hits", "refreshes", "refresh_errors",
+    "waits", "wait_timeouts", "inflight",
+)
+
+
+class ForecastCache(LRUCache):
+    """
+    予報用キャッシュ
+    - 同じキーへの同時ミスは1回だけ上流に取りに行く（single-flight）
+    - TTL切れでも stale_ttl 以内なら古い値を返し、裏で更新する（stale-while-revalidate）
+    - fresh(値) が False の値は TTL 内でも古い値として扱う（値の中身で鮮度を決めたい時用）
+    """
+
+    def __init__(self, maxsize=256, ttl=600.0, stale_ttl=3600.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.stale_ttl = stale_ttl
+        self._inflight = {}  # key -> threading.Event
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.waits = 0
+
+    def get_or_fetch(self, key, loader, fresh=None):
+        """
+        key に対応する値を返す。無ければ loader() で取得して保存する
+        loader の例外はそのまま呼び出し元へ（stale 値がある場合は裏更新のみ失敗）
+        """
+        while True:
+            with self._lock:
+                entry = self._get_entry(key)
+                now = time.monotonic()
+                if entry is not None:
+                    age = now - entry[1]
+                    if age <= self.ttl and (fresh is None or fresh(entry[0])):
+                        self.hits += 1
+                        return entry[0]
+                    if age <= self.stale_ttl:
+                        self.stale_hits += 1
+                        if key not in self._inflight:
+                            self._inflight[key] = threading.Event()
+                            threading.Thread(
+                                target=self._refresh, args=(key, loader), daemon=True
+                            ).start()
+                        return entry[0]
+
+                event = self._inflight.get(key)
+                if event is None:
+                    # 自分が取りに行く
+                    self.misses += 1
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    owner = True
+                else:
+                    self.waits += 1
+                    owner = False
+
+            if not owner:
+                # 他スレッドの取得完了を待って、もう一度キャッシュを見る
+                event.wait()
+                with self._lock:
+                    entry = self._get_entry(key)
+                    if entry is not None and time.monotonic() - entry[1] <= self.stale_ttl:
+                        return entry[0]
+                # 取得失敗していた場合は自分で取りに行く
+                continue
+
+            try:
+                value = loader()
+                with self._lock:
+                    self._set_entry(key, value)
+                return value
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+            with self._lock:
+                self._set_entry(key, value)
+                self.refreshes += 1
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+            print(f"[WARN] forecast refresh failed key={key}: {e}")
+        finally:
+            with self._lock:
+                event = self._inflight.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def stats(self):
+        s = super().stats()
+        with self._lock:
+            s.update({
+                "backend": "memory",
+                "stale_ttl": self.stale_ttl,
+                "stale_hits": self.stale_hits,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                # single-flight の待ち（待ちは取得が終わるまでなので打ち切りは無い）
+                "waits": self.waits,
+                "wait_timeouts": 0,
+                "inflight": len(self._inflight),
+            })
+        return s
+
+
+# =========================
+# プロセス間共有キャッシュ（SQLite）
+# =========================
+class SharedCache:
+    """
+    shared_cache テーブルに置く、ワーカープロセス間で共有するキャッシュ
+    ForecastCache と同じ get_or_fetch(key, loader) で使える
+    - 値は JSON で保存し、書くたびに version を1つ上げる（全ワーカーが同じ版を返す）
+    - ミス時は貸出（fill_owner）を取れた1プロセス・1スレッドだけが上流に取りに行き、
+      他は値が入るのを待つ → N ワーカーでも上流への取得はキー・TTL ごとに1回
+    - TTL切れでも stale_ttl 以内なら古い値を返し、貸出を取れたところが裏で更新する
+    - fresh(値) が False の値は TTL 内でも古い値として扱う（ForecastCache と同じ）
+    """
+
+    def __init__(self, namespace, ttl=600.0, stale_ttl=3600.0, lease=30.0,
+                 wait_timeout=None, poll_interval=0.05, connection=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lease = lease
+        # 他のプロセスの取得をこれ以上待ったら自分で取りに行く（秒）
+        self.wait_timeout = lease if wait_timeout is None else wait_timeout
+        self.poll_interval = poll_interval
+        self._connection = connection or db.connection
+        self._decoded = {}   # key -> (version, 値)（同じ版の JSON を毎回デコードしない）
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.waits = 0
+        self.wait_timeouts = 0
+        self.evictions = 0
+        self._stores = 0
+
+    def _key(self, key):
+        if isinstance(key, tuple):
+            key = ":".join(str(k) for k in key)
+        return f"{self.namespace}:{key}"
+
+    @staticmethod
+    def _owner():
+        # fork 後は pid が変わるので毎回作る
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    # ----------------------------
+    # 読み書き
+    # ----------------------------
+    def _read(self, key):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, version, stored_at FROM shared_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        version = row[1]
+        with self._lock:
+            memo = self._decoded.get(key)
+        if memo is not None and memo[0] == version:
+            value = memo[1]
+        else:
+            value = json.loads(row[0])
+            with self._lock:
+                self._decoded[key] = (version, value)
+        return value, version, row[2]
+
+    def _try_lease(self, key):
+        # 誰も取りに行っていない（か貸出期限切れ）なら自分が取る。取れたら True
+        now = time.time()
+        with self._connection() as conn:
+            cur = conn.execute("""
+                INSERT INTO shared_cache (key, fill_owner, fill_expires) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    fill_owner = excluded.fill_owner, fill_expires = excluded.fill_expires
+                WHERE shared_cache.fill_owner IS NULL OR shared_cache.fill_expires < ?
+            """, (key, self._owner(), now + self.lease, now))
+            conn.commit()
+        return cur.rowcount == 1
+
+    def _release(self, key):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE shared_cache SET fill_owner = NULL, fill_expires = NULL WHERE key = ? AND fill_owner = ?",
+                (key, self._owner()),
+            )
+            conn.commit()
+
+    def _store(self, key, value):
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO shared_cache (key, value, version, stored_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value, version = shared_cache.version + 1, stored_at = excluded.stored_at,
+                    fill_owner = NULL, fill_expires = NULL
+            """, (key, json.dumps(value, ensure_ascii=False, separators=(",", ":")), time.time()))
+            conn.commit()
+        with self._lock:
+            self._stores += 1
+            purge = self._stores % 256 == 0
+        if purge:
+            self.purge()
+
+    def _fill(self, key, loader):
+        # 上流から取る間は DB 接続を持たない
+        try:
+            value = loader()
+        except BaseException:
+            self._release(key)
+            raise
+        self._store(key, value)
+        return value
+
+    # ----------------------------
+    # 公開 API
+    # ----------------------------
+    def get_or_fetch(self, key, loader, fresh=None):
+        """
+        key に対応する値を返す。無ければ loader() で取得して全プロセス向けに保存する
+        loader の戻り値は JSON にできること（タプルはリストになって返る）
+        """
+        key = self._key(key)
+        deadline = None
+        while True:
+            entry = self._read(key)
+            if entry is not None:
+                value, _, stored_at = entry
+                age = time.time() - stored_at
+                if age <= self.ttl and (fresh is None or fresh(value)):
+                    self._count("hits")
+                    return value
+                if age <= self.stale_ttl:
+                    self._count("stale_hits")
+                    if self._try_lease(key):
+                        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                    return value
+
+            if self._try_lease(key):
+                self._count("misses")
+                return self._fill(key, loader)
+
+            # 別のプロセス（スレッド）が取得中。入るまで待つ
+            if deadline is None:
+                self._count("waits")
+                deadline = time.monotonic() + self.wait_timeout
+            elif time.monotonic() > deadline:
+                self._count("wait_timeouts")
+                value = loader()
+                self._store(key, value)
+                return value
+            time.sleep(self.poll_interval)
+
+    def _refresh(self, key, loader):
+        try:
+            self._fill(key, loader)
+            self._count("refreshes")
+        except Exception as e:
+            self._count("refresh_errors")
+            print(f"[WARN] shared cache refresh failed key={key}: {e}")
+
+    def get(self, key, default=None):
+        entry = self._read(self._key(key))
+        if entry is None or time.time() - entry[2] > self.ttl:
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        self._store(self._key(key), value)
+
+    def invalidate(self, key):
+        key = self._key(key)
+        with self._connection() as conn:
+            conn.execute("DELETE FROM shared_cache WHERE key = ?", (key,))
+            conn.commit()
+        with self._lock:
+            self._decoded.pop(key, None)
+
+    def purge(self):
+        # stale_ttl も過ぎた行と、このプロセスのデコード済みの写しを捨てる（捨てた行は evictions に数える）
+        with self._connection() as conn:
+            cur = conn.execute("""
+                DELETE FROM shared_cache
+                WHERE key >= ? AND key < ? AND stored_at < ?
+                  AND (fill_owner IS NULL OR fill_expires < ?)
+            """, (f"{self.namespace}:", f"{self.namespace};", time.time() - self.stale_ttl, time.time()))
+            conn.commit()
+        with self._lock:
+            self._decoded.clear()
+            self.evictions += cur.rowcount
+
+    def stats(self):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT COUNT(*), COUNT(fill_owner) FROM shared_cache WHERE key >= ? AND key < ?
+            """, (f"{self.namespace}:", f"{self.namespace};")).fetchone()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "shared",
+                "size": row[0],
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else None,
+                "evictions": self.evictions,
+                "stale_hits": self.stale_hits,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "waits": self.waits,
+                "wait_timeouts": self.wait_timeouts,
+                "inflight": row[1],
+            }
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+import metrics
+
+# =========================
+# DB設定（パスはここだけで決める）
+# =========================
+DB_PATH = os.getenv(
+    "DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mvp.db")
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+# ----------------------------
+# クエリ時間の計測（palert_db_query_seconds）
+# ----------------------------
+_observe_by_sql = {}  # SQL 文 → 観測口（文は cached_statements 程度しか種類が無い）
+
+
+def _observe_query(sql, elapsed):
+    observe = _observe_by_sql.get(sql)
+    if observe is None:
+        if len(_observe_by_sql) > 4 * DB_CACHED_STATEMENTS:
+            _observe_by_sql.clear()
+        observe = _observe_by_sql[sql] = metrics.db_query_seconds.labels(op=metrics.sql_op(sql))
+    observe(elapsed)
+
+
+class MeteredCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_query(sql, time.perf_counter() - started)
+
+
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """
+    SQLite 接続プール
+    接続は必要になった時に size 本まで作り、以後は使い回す
+    PRAGMA は接続を作った時に1回だけ流す
+    """
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, factory=None):
+        self.path = path
+        self.factory = factory or (MeteredConnection if metrics.METRICS_ENABLED else sqlite3.Connection)
+        self.size = size
+        self.timeout = timeout
+        self._idle = []  # LIFO（直近に使った接続を優先）
+        self._created = 0
+        self._cond = threading.Condition()
+        self.acquires = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,  # 1度に使うのは1スレッドだけ（プールが保証）
+            cached_statements=DB_CACHED_STATEMENTS,
+            factory=self.factory,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+        return conn
+
+    def acquire(self):
+        started = time.perf_counter()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    conn = None
+                    break
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - started)
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle:
+                        raise PoolTimeout(f"DB接続待ちがタイムアウトしました（{self.timeout}s）")
+
+            elapsed = time.perf_counter() - started
+            metrics.db_pool_wait_seconds.observe(elapsed)
+            self.acquires += 1
+            if waited:
+                self.waits += 1
+                self.wait_total += elapsed
+                self.wait_max = max(self.wait_max, elapsed)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 壊れた接続は捨てる
+            try:
+                conn.close()
+            finally:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._cond:
+            for conn in self._idle:
+                conn.close()
+            self._created -= len(self._idle)
+            self._idle.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "path": self.path,
+                "size": self.size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "in_use": self._created - len(self._idle),
+                "acquires": self.acquires,
+                "waits": self.waits,
+                "wait_total_ms": round(self.wait_total * 1000, 1),
+                "wait_max_ms": round(self.wait_max * 1000, 1),
+            }
+
+
+pool = ConnectionPool()
+metrics.stats_gauge(
+    "palert_db_pool", "接続プールの状態", pool.stats,
+    ("size", "created", "idle", "in_use", "acquires", "waits"),
+)
+
+
+# =========================
+# リクエスト単位の接続
+# =========================
+def get_conn():
+    """
+    リクエスト（アプリコンテキスト）ごとに1本だけ借りる
+    返却は teardown で自動。呼び出し側で close() しないこと
+    """
+    if not has_app_context():
+        raise RuntimeError("get_conn() はアプリコンテキスト内で使ってください（外では connection() を使う）")
+    if "db" not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def close_conn(exc=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def connection():
+    # アプリ外（バッチなど）で使う: with connection() as conn:
+    return pool.connection()
+
+
+def init_app(app):
+    app.teardown_appcontext(close_conn)
@@ -0,0 +1,383 @@
+import asyncio
+import gzip
+import json
+import os
+import random
+import ssl
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+OPEN_METEO_URL = os.getenv("OPEN_METEO_URL", "https://api.open-meteo.com/v1/jma")
+FORECAST_TIMEOUT = float(os.getenv("FORECAST_TIMEOUT", "20"))
+# 1リクエストに載せる地点数の上限（URL長と上流の負荷を抑える）
+FORECAST_BATCH_SIZE = int(os.getenv("FORECAST_BATCH_SIZE", "100"))
+# 同時リクエスト数の上限と、再試行回数・待ち時間（秒）
+FORECAST_CONCURRENCY = int(os.getenv("FORECAST_CONCURRENCY", "8"))
+FORECAST_MAX_RETRIES = int(os.getenv("FORECAST_MAX_RETRIES", "3"))
+FORECAST_BACKOFF = float(os.getenv("FORECAST_BACKOFF", "0.5"))
+FORECAST_BACKOFF_MAX = float(os.getenv("FORECAST_BACKOFF_MAX", "8"))
+# 使い終わった接続を残しておく時間（秒）
+FORECAST_KEEPALIVE = float(os.getenv("FORECAST_KEEPALIVE", "30"))
+
+# 再試行する HTTP ステータス（レート制限と上流の一時障害）
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class ForecastError(RuntimeError):
+    """予報の取得に失敗（再試行しても駄目だった）"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class _TransientError(Exception):
+    # 再試行してよい失敗（内部用）
+    pass
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# =========================
+# 非同期 HTTP クライアント
+# =========================
+class _Connection:
+    __slots__ = ("reader", "writer", "idle_since")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = time.monotonic()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class ForecastClient:
+    """
+    予報 API 用の asyncio クライアント（Web とジョブで共有）
+    - ホストごとに keep-alive 接続を使い回す
+    - セマフォで同時リクエスト数を concurrency 本に抑える
+    - 1リクエストごとのタイムアウト
+    - 接続エラー・タイムアウト・429/5xx はジッター付き指数バックオフで再試行
+
+    イベントループは専用スレッドで1本だけ回し、同期コードからは
+    run() / fetch_hourly_batch() で呼ぶ
+    """
+
+    def __init__(self, base_url=None, concurrency=None, timeout=None, max_retries=None,
+                 backoff=None, backoff_max=None, keepalive=None, upstream="open_meteo"):
+        self.base_url = base_url or OPEN_METEO_URL
+        self.upstream = upstream  # メトリクスのラベル
+        self.concurrency = max(1, FORECAST_CONCURRENCY if concurrency is None else concurrency)
+        self.timeout = FORECAST_TIMEOUT if timeout is None else timeout
+        self.max_retries = FORECAST_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = FORECAST_BACKOFF if backoff is None else backoff
+        self.backoff_max = FORECAST_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.keepalive = FORECAST_KEEPALIVE if keepalive is None else keepalive
+
+        self._idle = {}            # (scheme, host, port) -> [_Connection]
+        self._semaphore = None     # ループ上で作る
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._ssl = None
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.connects = 0
+        self.reused = 0
+
+    # ----------------------------
+    # イベントループ（専用スレッド）
+    # ----------------------------
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is not None and self._thread.is_alive():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name="forecast-client", daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            return loop
+
+    def run(self, coro):
+        # 同期コードから呼ぶ入口。結果が出るまで待つ
+        return self.submit(coro).result()
+
+    def submit(self, coro):
+        # 待たずに投げる（concurrent.futures.Future を返す）。先読みしながら処理したいとき用
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        async def _close():
+            for conns in self._idle.values():
+                for c in conns:
+                    c.close()
+            self._idle.clear()
+
+        self.run(_close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+
+    # ----------------------------
+    # 接続プール
+    # ----------------------------
+    async def _acquire(self, scheme, host, port):
+        conns = self._idle.get((scheme, host, port))
+        now = time.monotonic()
+        while conns:
+            c = conns.pop()
+            if now - c.idle_since < self.keepalive and not c.reader.at_eof():
+                self._count("reused")
+                return c
+            c.close()
+
+        if scheme == "https":
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self._count("connects")
+        return _Connection(reader, writer)
+
+    def _release(self, key, conn):
+        conn.idle_since = time.monotonic()
+        self._idle.setdefault(key, []).append(conn)
+
+    # ----------------------------
+    # 1リクエスト
+    # ----------------------------
+    async def _request(self, url):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        key = (scheme, host, port)
+
+        conn = await self._acquire(scheme, host, port)
+        try:
+            conn.writer.write((
+                f"GET {path} HTTP/1.1\r\n"
+                f"Host: {parts.netloc}\r\n"
+                "Accept: application/json\r\n"
+                "Accept-Encoding: gzip\r\n"
+                "Connection: keep-alive\r\n"
+                "User-Agent: P-Alert\r\n"
+                "\r\n"
+            ).encode())
+            await conn.writer.drain()
+            status, headers, body = await self._read_response(conn.reader)
+        except BaseException:
+            conn.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close":
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return status, body
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("接続が閉じられました")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        return status, headers, body
+
+    # ----------------------------
+    # 再試行つき JSON 取得
+    # ----------------------------
+    def _delay(self, attempt):
+        # フルジッター: 0 〜 min(上限, base * 2^attempt) の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    async def get_json(self, params, base_url=None):
+        url = f"{base_url or self.base_url}?{urllib.parse.urlencode(params, safe=',/')}"
+        attempt = 0
+        while True:
+            started = None
+            try:
+                async with self._semaphore:
+                    self._count("requests")
+                    started = time.perf_counter()
+                    status, body = await asyncio.wait_for(self._request(url), self.timeout)
+                if status in RETRY_STATUS:
+                    raise _TransientError(f"HTTP {status}")
+                if status != 200:
+                    raise ForecastError(f"予報APIエラー: HTTP {status} {body[:200]!r}", status)
+                try:
+                    data = json.loads(body)
+                except ValueError as e:
+                    # 200 でも本文が途中で切れた・JSON でない（プロキシのエラーページ等）→ 再試行
+                    raise _TransientError(f"予報APIの応答が JSON ではありません: {e}") from e
+                metrics.upstream_seconds.observe(time.perf_counter() - started, upstream=self.upstream, outcome="ok")
+                return data
+            # EOFError: gzip の本文が途中で切れていた
+            except (_TransientError, asyncio.TimeoutError, OSError, EOFError, asyncio.IncompleteReadError) as e:
+                if started is not None:
+                    metrics.upstream_seconds.observe(
+                        time.perf_counter() - started, upstream=self.upstream, outcome="retryable")
+                if attempt >= self.max_retries:
+                    self._count("failures")
+                    raise ForecastError(f"予報の取得に失敗しました（{attempt + 1}回）: {e!r}") from e
+                self._count("retries")
+                metrics.upstream_retries.inc(upstream=self.upstream)
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+            except ForecastError:
+                metrics.upstream_seconds.observe(time.perf_counter() - started, upstream=self.upstream, outcome="error")
+                self._count("failures")
+                raise
+
+    # ----------------------------
+    # 予報
+    # ----------------------------
+    async def fetch_chunk(self, chunk, variable="hourly", base_url=None, **params):
+        """
+        1リクエスト分（chunk は数十地点まで）の pressure_msl
+        params は forecast_days=2 や start_date= / end_date=（過去データ API）など
+        戻り値: chunk と同じ順の [(times, values), ...]
+        """
+        data = await self.get_json({
+            "latitude": ",".join(str(lat) for lat, _ in chunk),
+            "longitude": ",".join(str(lon) for _, lon in chunk),
+            variable: "pressure_msl",
+            "timezone": "Asia/Tokyo",
+            **params,
+        }, base_url)
+
+        # 1地点だけのときはオブジェクト、複数のときは配列で返ってくる
+        if isinstance(data, dict):
+            data = [data]
+        if len(data) != len(chunk):
+            raise ForecastError(f"Open-Meteo の応答地点数が一致しません: {len(data)} != {len(chunk)}")
+        return [(d[variable]["time"], d[variable]["pressure_msl"]) for d in data]
+
+    async def fetch_many(self, coords, forecast_days=2, chunk_size=FORECAST_BATCH_SIZE,
+                         variable="hourly", base_url=None):
+        """
+        coords を chunk_size 地点ずつに分けて並行取得する（同時数はセマフォで制限）
+        戻り値: coords と同じ順の [(times, values), ...]
+        """
+        chunks = list(_chunks(list(coords), max(1, chunk_size)))
+        parts = await asyncio.gather(*(
+            self.fetch_chunk(c, variable, base_url, forecast_days=forecast_days) for c in chunks
+        ))
+        return [pair for part in parts for pair in part]
+
+    # ----------------------------
+    # 状態
+    # ----------------------------
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "connects": self.connects,
+                "reused": self.reused,
+                "idle": sum(len(v) for v in self._idle.values()),
+            }
+
+
+client = ForecastClient()
+metrics.stats_gauge(
+    "palert_forecast_client", "予報クライアントの状態", client.stats,
+    ("requests", "retries", "failures", "connects", "reused", "idle"),
+)
+
+
+# =========================
+# 同期 API（既存の呼び出し口）
+# =========================
+def fetch_hourly_batch(coords, forecast_days=2, chunk_size=FORECAST_BATCH_SIZE, caller="batch"):
+    """
+    複数地点の毎時 pressure_msl をまとめて取得する
+    Open-Meteo のカンマ区切り複数座標リクエストを chunk_size 地点ずつ、並行して投げる
+    coords: [(lat, lon), ...]
+    戻り値: coords と同じ順の [(times, values), ...]
+    """
+    coords = list(coords)
+    if not coords:
+        return []
+    with metrics.forecast_fetch_seconds.time(caller=caller):
+        return client.run(client.fetch_many(coords, forecast_days, chunk_size))
+
+
+def fetch_hourly(lat, lon, forecast_days=2, caller="single"):
+    # 1地点ぶん（times, values）
+    return fetch_hourly_batch([(lat, lon)], forecast_days, caller=caller)[0]
+
+
+def fetch_minutely_batch(coords, forecast_days=1, chunk_size=FORECAST_BATCH_SIZE, caller="nowcast"):
+    """
+    複数地点の15分ごとの pressure_msl（Open-Meteo の minutely_15）をまとめて取得する
+    戻り値: coords と同じ順の [(times, values), ...]（times は "YYYY-MM-DDTHH:MM"）
+    """
+    coords = list(coords)
+    if not coords:
+        return []
+    with metrics.forecast_fetch_seconds.time(caller=caller):
+        return client.run(client.fetch_many(coords, forecast_days, chunk_size, variable="minutely_15"))
@@ -0,0 +1,19 @@
+import math
+import os
+
+# 予報格子の間隔（度）。JMA MSM はおよそ 0.05 度（約5km）
+GRID_STEP = float(os.getenv("GRID_STEP", "0.05"))
+
+
+# ----------------------------
+# 空間ハッシュ
+# ----------------------------
+def cell_key(lat, lon, step=GRID_STEP):
+    # 緯度経度 → 格子セルの整数キー (i, j)
+    return (int(math.floor(lat / step + 0.5)), int(math.floor(lon / step + 0.5)))
+
+
+def cell_center(key, step=GRID_STEP):
+    # 格子セルキー → セル中心の緯度経度（URLに載せるため丸める）
+    i, j = key
+    return round(i * step, 4), round(j * step, 4)
@@ -0,0 +1,24 @@
+import os
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = f"{os.getenv('WEB_HOST', '0.0.0.0')}:{os.getenv('WEB_PORT', '8000')}"
+workers = int(os.getenv("WEB_WORKERS", "4"))
+worker_class = "gthread"
+# SSE（/api/pressure/stream）は sse_server.py（asyncio）で受ける。ここで受ける分は
+# 1ワーカー SSE_MAX_STREAMS 本まで（超えたら 503）なので、その分を通常のリクエスト用に上乗せする
+threads = int(os.getenv("WEB_THREADS", "16")) + int(os.getenv("SSE_MAX_STREAMS", "4"))
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+# アプリの読み込み・マイグレーションは親で1回だけ
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # ワーカー番号（0 から。落ちたワーカーの番号は作り直したワーカーが引き継ぐ）
+    # → /metrics のポート（WEB_METRICS_PORT + 番号）と worker ラベルが入れ替わりで変わらない
+    used = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = next(i for i in range(len(used) + 1) if i not in used)
+
+
+def post_fork(server, worker):
+    import wsgi
+    wsgi.post_fork(server.cfg.workers, worker.slot)
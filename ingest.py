@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+
+import db
+import nowcast
+import pressure_store
+from forecast import fetch_hourly_batch
+from migrations import assign_locations
+from pressure import load_dashboards
+from sse import hub
+
+# 取り込み間隔と、スナップショットを「新しい」とみなす期間（秒）
+INGEST_INTERVAL = float(os.getenv("INGEST_INTERVAL", "1800"))
+INGEST_MAX_AGE = float(os.getenv("INGEST_MAX_AGE", "3600"))
+INGEST_FORECAST_DAYS = int(os.getenv("INGEST_FORECAST_DAYS", "2"))
+
+
+# ----------------------------
+# 取り込み
+# ----------------------------
+def active_locations(conn):
+    # ユーザーがいる地点だけ（未割り当てのユーザーは先に割り当てる）
+    assign_locations(conn)
+    conn.commit()
+    return conn.execute("""
+        SELECT id, lat, lon FROM locations
+        WHERE id IN (SELECT location_id FROM users)
+    """).fetchall()
+
+
+def ingest_locations(conn, locations):
+    """
+    指定地点の毎時予報をまとめて取得し、
+    pressure_blocks とダッシュボード文書（dashboard_snapshots）を書き込む
+    文書は書き込んだブロックを読み直して作る（スナップショットと保存値が必ず一致する）
+    戻り値: 書き込んだ地点数
+    """
+    locations = list(locations)
+    if not locations:
+        return 0
+
+    series = fetch_hourly_batch(
+        [(l["lat"], l["lon"]) for l in locations], forecast_days=INGEST_FORECAST_DAYS
+    )
+
+    ids = []
+    for loc, (times, pressures) in zip(locations, series):
+        if times and pressure_store.write(conn, loc["id"], pressure_store.to_epochs(times), pressures):
+            ids.append(loc["id"])
+
+    # 予報の範囲（今日の 0時から INGEST_FORECAST_DAYS 日）を全地点まとめて読み、判定する
+    start = int(pressure_store.day_base(pressure_store.now_epoch()))
+    docs = load_dashboards(conn, ids, start, start + INGEST_FORECAST_DAYS * pressure_store.DAY)
+    snapshot_rows = [
+        (location_id, json.dumps(doc, ensure_ascii=False), doc["risk"])
+        for location_id, doc in docs.items()
+    ]
+
+    conn.executemany("""
+        INSERT INTO dashboard_snapshots (location_id, payload, risk, updated_at)
+        VALUES (?, ?, ?, datetime('now'))
+        ON CONFLICT(location_id) DO UPDATE SET
+            payload = excluded.payload,
+            risk = excluded.risk,
+            updated_at = excluded.updated_at
+    """, snapshot_rows)
+    conn.commit()
+
+    # 同じプロセスで開いているダッシュボードへすぐ配る（変化が無ければ送られない）
+    for location_id, payload, _ in snapshot_rows:
+        hub.publish(location_id, payload)
+    return len(snapshot_rows)
+
+
+def ingest_stale(conn, locations, max_age=INGEST_MAX_AGE):
+    """
+    スナップショットが無い／古い地点だけ取り込み直す（ジョブの前処理用）
+    """
+    fresh = {
+        r["location_id"]
+        for r in conn.execute(
+            "SELECT location_id FROM dashboard_snapshots WHERE updated_at >= datetime('now', ?)",
+            (f"-{int(max_age)} seconds",),
+        )
+    }
+    stale = [l for l in locations if l["id"] not in fresh]
+    if stale:
+        print(f"[INFO] ingest stale locations={len(stale)}")
+    return ingest_locations(conn, stale)
+
+
+def ingest_once(conn=None):
+    if conn is None:
+        with db.connection() as conn:
+            return ingest_once(conn)
+    started = time.perf_counter()
+    locations = active_locations(conn)
+    n = ingest_locations(conn, locations)
+    # 15分値のナウキャストも同じ周期で（急な低下はこの周期のうちにアラートまで出す）
+    if nowcast.NOWCAST_ENABLED:
+        nowcast.run(conn, locations)
+    print(f"[INFO] ingest: locations={n} elapsed={time.perf_counter() - started:.2f}s")
+    return n
+
+
+# ----------------------------
+# 読み出し（ジョブ用）
+# ----------------------------
+def load_snapshots(conn):
+    # {location_id: payload(dict)}
+    return {
+        r["location_id"]: json.loads(r["payload"])
+        for r in conn.execute("SELECT location_id, payload FROM dashboard_snapshots")
+    }
+
+
+# ----------------------------
+# バックグラウンド実行
+# ----------------------------
+class IngestWorker(threading.Thread):
+    """
+    interval 秒ごとに ingest_once を回すスレッド
+    失敗しても次の周期で再試行する
+    """
+
+    def __init__(self, interval=INGEST_INTERVAL):
+        super().__init__(name="ingest-worker", daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                ingest_once()
+            except Exception as e:
+                print(f"[ERROR] ingest failed: {e}")
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
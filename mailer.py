@@ -0,0 +1,290 @@
+import os
+import queue
+import random
+import smtplib
+import threading
+import time
+from collections import namedtuple
+from email.mime.text import MIMEText
+
+import metrics
+
+SMTP_HOST = os.getenv("SMTP_HOST", "")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USER = os.getenv("SMTP_USER", "")
+SMTP_PASS = os.getenv("SMTP_PASS", "")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
+MAIL_FROM = os.getenv("MAIL_FROM", SMTP_USER)
+
+# 同時接続数（ワーカー数）と、1接続で送る最大通数
+SMTP_WORKERS = int(os.getenv("SMTP_WORKERS", "4"))
+SMTP_PER_CONNECTION = int(os.getenv("SMTP_PER_CONNECTION", "100"))
+SMTP_MAX_RETRIES = int(os.getenv("SMTP_MAX_RETRIES", "3"))
+# 再送までの待ち（秒）: 0 〜 min(上限, base * 2^attempt) の一様乱数（フルジッター）
+SMTP_BACKOFF = float(os.getenv("SMTP_BACKOFF", "0.5"))
+SMTP_BACKOFF_MAX = float(os.getenv("SMTP_BACKOFF_MAX", "10"))
+# 送り終えた接続を次の send_many まで残しておく上限（秒。これより空いたら使わずに張り直す）
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+
+# tag は呼び出し側の識別子（user_id など）で、結果にそのまま返す
+# message_id を渡すと Message-ID ヘッダーに使う（再送しても同じ ID になる）
+Mail = namedtuple("Mail", "to_addr subject body tag message_id", defaults=(None, None))
+SendResult = namedtuple("SendResult", "mail ok error")
+
+
+def build_message(to_addr, subject, body, mail_from=None, message_id=None):
+    msg = MIMEText(body, "plain", "utf-8")
+    msg["Subject"] = subject
+    msg["From"] = mail_from or MAIL_FROM
+    msg["To"] = to_addr
+    if message_id:
+        msg["Message-ID"] = message_id
+    return msg
+
+
+def _is_disconnect(e):
+    # サーバー側で切られていた（置いておいた接続で最初に出るエラー）
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code == 421
+    return isinstance(e, (smtplib.SMTPServerDisconnected, OSError))
+
+
+def is_transient(e):
+    # 421 / 4xx と切断は再接続して再送する。5xx はそのまま失敗
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPException):
+        return isinstance(e, smtplib.SMTPServerDisconnected)
+    return isinstance(e, OSError)
+
+
+class _Session:
+    # 認証済みの SMTP 接続と、その接続で送った通数・最後に使った時刻
+    __slots__ = ("conn", "used", "last_used")
+
+    def __init__(self):
+        self.conn = None
+        self.used = 0
+        self.last_used = 0.0
+
+
+class SmtpDispatcher:
+    """
+    SMTP 一括送信
+    ワーカーごとに認証済みの接続を持ち回し、per_connection 通ごとに張り直す
+    workers=1 なら呼び出し側のスレッドで送り、それ以上ならワーカースレッドを最初の send_many で立てて使い続ける
+    接続は send_many をまたいで使い回す
+    （張り直すのはエラーの時・per_connection 通ごと・SMTP_IDLE_TIMEOUT 秒空いた時だけ）
+    使い終わったら close()
+    """
+
+    def __init__(self, host=None, port=None, user=None, password=None, starttls=None,
+                 mail_from=None, workers=None, per_connection=None, max_retries=None, timeout=20):
+        self.host = SMTP_HOST if host is None else host
+        self.port = SMTP_PORT if port is None else port
+        self.user = SMTP_USER if user is None else user
+        self.password = SMTP_PASS if password is None else password
+        self.starttls = SMTP_STARTTLS if starttls is None else starttls
+        self.mail_from = mail_from or MAIL_FROM or self.user
+        self.workers = max(1, SMTP_WORKERS if workers is None else workers)
+        self.per_connection = max(1, SMTP_PER_CONNECTION if per_connection is None else per_connection)
+        self.max_retries = SMTP_MAX_RETRIES if max_retries is None else max_retries
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.elapsed = 0.0
+        self._session = _Session()
+        self._session_lock = threading.Lock()
+        self._jobs = queue.Queue()   # (i, mail, 結果を返すキュー)。None でワーカーが終わる
+        self._threads = []
+
+        if not self.host:
+            raise RuntimeError("SMTP設定が未設定です（.env の SMTP_HOST などを確認してください）")
+
+    # ----------------------------
+    # 接続
+    # ----------------------------
+    def _connect(self):
+        s = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            s.starttls()
+        if self.user:
+            s.login(self.user, self.password)
+        with self._lock:
+            self.connects += 1
+        return s
+
+    @staticmethod
+    def _close(s):
+        if s is None:
+            return
+        try:
+            s.quit()
+        except Exception:
+            try:
+                s.close()
+            except Exception:
+                pass
+
+    def _end(self, session):
+        self._close(session.conn)
+        session.conn = None
+
+    # ----------------------------
+    # 1通
+    # ----------------------------
+    def _deliver(self, session, mail):
+        """
+        session の接続で mail を送る（無い・使い切った・空きすぎた接続は張り直す）
+        戻り値: 送れなかった時の例外（送れたら None）
+        """
+        msg = build_message(mail.to_addr, mail.subject, mail.body, self.mail_from, mail.message_id)
+        attempt = 0
+        while True:
+            if session.conn is not None and (
+                session.used >= self.per_connection
+                or time.monotonic() - session.last_used > SMTP_IDLE_TIMEOUT
+            ):
+                self._end(session)
+            reused = session.conn is not None
+            try:
+                if session.conn is None:
+                    session.conn = self._connect()
+                    session.used = 0
+                started = time.perf_counter()
+                try:
+                    session.conn.send_message(msg)
+                except Exception:
+                    metrics.smtp_send_seconds.observe(time.perf_counter() - started, outcome="error")
+                    raise
+                metrics.smtp_send_seconds.observe(time.perf_counter() - started, outcome="ok")
+                session.used += 1
+                session.last_used = time.monotonic()
+                return None
+            except Exception as e:
+                self._end(session)
+                stale = reused and _is_disconnect(e)
+                if not stale and (not is_transient(e) or attempt >= self.max_retries):
+                    return e
+                with self._lock:
+                    self.reconnects += 1
+                if stale:
+                    # 置いておいた接続が切られていただけ。すぐ張り直して送り直す（試行には数えない）
+                    continue
+                time.sleep(self._delay(attempt))
+                attempt += 1
+
+    @staticmethod
+    def _delay(attempt):
+        # フルジッター（同時に断られたワーカーが同じ間隔で一斉に再送しない）
+        return random.uniform(0, min(SMTP_BACKOFF_MAX, SMTP_BACKOFF * 2 ** attempt))
+
+    def _send_one(self, session, mail):
+        try:
+            error = self._deliver(session, mail)
+        except Exception as e:   # メッセージが組み立てられない等
+            error = e
+        with self._lock:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        return SendResult(mail, error is None, error)
+
+    # ----------------------------
+    # ワーカー（send_many をまたいで使い続ける）
+    # ----------------------------
+    def _worker(self):
+        session = _Session()
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                i, mail, out = job
+                out.put((i, self._send_one(session, mail)))
+        finally:
+            self._end(session)
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"smtp-worker-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def send_many(self, mails):
+        """
+        mails: Mail のリスト
+        戻り値: 入力と同じ順の SendResult のリスト（例外は投げずに error に入れる）
+        """
+        mails = list(mails)
+        results = [None] * len(mails)
+        if not mails:
+            return results
+
+        started = time.perf_counter()
+        if self.workers == 1:
+            # スレッドを立てず、持ち回しの接続でそのまま送る
+            with self._session_lock:
+                for i, mail in enumerate(mails):
+                    results[i] = self._send_one(self._session, mail)
+        else:
+            self._start_workers()
+            out = queue.Queue()
+            for i, mail in enumerate(mails):
+                self._jobs.put((i, mail, out))
+            for _ in mails:
+                i, result = out.get()
+                results[i] = result
+
+        with self._lock:
+            self.elapsed += time.perf_counter() - started
+        return results
+
+    def close(self):
+        # ワーカーを止めて、持ち回しの接続を閉じる
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._jobs.put(None)
+        for t in threads:
+            t.join(self.timeout)
+        with self._session_lock:
+            self._end(self._session)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "elapsed_sec": round(self.elapsed, 3),
+                "per_sec": round(self.sent / self.elapsed, 1) if self.elapsed else None,
+            }
+
+    def report(self, label="mail"):
+        s = self.stats()
+        print(
+            f"[INFO] {label}: sent={s['sent']} failed={s['failed']} connects={s['connects']} "
+            f"elapsed={s['elapsed_sec']}s rate={s['per_sec']}/s"
+        )
+
+
+def send_email(to_addr, subject, body):
+    # 1通だけ送る（テスト送信など）。失敗したら例外
+    d = SmtpDispatcher(workers=1)
+    try:
+        result = d.send_many([Mail(to_addr, subject, body)])[0]
+    finally:
+        d.close()
+    if not result.ok:
+        raise result.error
@@ -0,0 +1,348 @@
+import bisect
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# =========================
+# メトリクス（Prometheus テキスト形式）
+# =========================
+# 外部ライブラリなし。観測1回はロック1回 + 二分探索だけなので常時オンで使える
+# 値はプロセスごと（Web・スケジューラーそれぞれの /metrics を収集する）
+# gunicorn の Web ワーカーは1つのポートを共有し、どのワーカーが答えるか決まらない
+# → ワーカーが2つ以上なら Flask の /metrics は出さず、各ワーカーが serve() で自分のポート
+#   （WEB_METRICS_PORT + ワーカー番号, wsgi.post_fork）から worker ラベル付きで出す（set_worker）
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# /metrics に要る Authorization: Bearer <token>
+# Web（Flask）の /metrics はトークン必須（未設定なら 404 で出さない）
+# serve() の専用ポートは METRICS_HOST（既定 localhost）だけで待ち受け、トークンが設定されていれば確かめる
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# 秒単位の既定バケット（1ms 〜 30s）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# このプロセスのワーカー番号（set_worker。全系列に worker ラベルとして付く）
+_worker = None
+
+
+def set_worker(index):
+    """
+    gunicorn のワーカーとして出す（worker="<index>" を全系列に付け、Flask の /metrics は 404 にする）
+    """
+    global _worker
+    _worker = None if index is None else str(index)
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    if _worker is not None:
+        pairs.append(f'worker="{_worker}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(v):
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v)) if abs(v) < 1e15 else repr(v)
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}   # ラベル値のタプル -> 値
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルは {self.labelnames} です")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED or not amount:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def expose(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels_text(self.labelnames, k)} {_num(v)}" for k, v in items
+        ]
+
+
+class Gauge(_Metric):
+    """
+    値を set するか、fn（呼ぶと {ラベル値のタプル: 値} か数値を返す）で収集時に読む
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def expose(self):
+        if self.fn is not None:
+            try:
+                got = self.fn()
+            except Exception:
+                got = {}
+            items = list(got.items()) if isinstance(got, dict) else [((), got)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels_text(self.labelnames, k)} {_num(v)}"
+            for k, v in items if v is not None
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if METRICS_ENABLED:
+            self._observe(self._key(labels), value)
+
+    def _observe(self, key, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [バケットごとの件数..., +Inf の件数, 合計]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def labels(self, **labels):
+        # ラベルを固定した観測口（ホットパス用。毎回のラベル組み立てを省く）
+        key = self._key(labels)
+        return lambda value: METRICS_ENABLED and self._observe(key, value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return sum(state[:-1]) if state else 0
+
+    def expose(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = self.header()
+        for key, state in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket{_labels_text(self.labelnames, key, [('le', _num(float(bound)))])} {cumulative}"
+                )
+            labels = _labels_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_num(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} は別の種類で登録済みです")
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), fn=None):
+        return self._add(Gauge, name, help_text, labelnames, fn=fn)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# ----------------------------
+# 共通のメトリクス
+# ----------------------------
+upstream_seconds = registry.histogram(
+    "palert_upstream_request_seconds", "上流 API への1リクエストの所要時間", ("upstream", "outcome"))
+upstream_retries = registry.counter(
+    "palert_upstream_retries_total", "上流 API の再試行回数", ("upstream",))
+forecast_fetch_seconds = registry.histogram(
+    "palert_forecast_fetch_seconds", "予報取得（全チャンク・再試行込み）の所要時間", ("caller",))
+db_query_seconds = registry.histogram(
+    "palert_db_query_seconds", "SQLite の execute / executemany の所要時間", ("op",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0))
+db_pool_wait_seconds = registry.histogram(
+    "palert_db_pool_wait_seconds", "接続プールから接続を借りるまでの待ち時間",
+    buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0))
+smtp_send_seconds = registry.histogram(
+    "palert_smtp_send_seconds", "SMTP 1通の送信の所要時間", ("outcome",))
+http_request_seconds = registry.histogram(
+    "palert_http_request_seconds", "HTTP リクエストの所要時間（ルート別）", ("method", "route", "status"))
+# palert_alerts_* はすべてユーザー（= 通知1通）単位。地点単位は palert_alert_locations_total
+alert_locations = registry.counter(
+    "palert_alert_locations_total", "判定の対象にした地点数（evaluated: 判定できた / no_data: データが無かった）",
+    ("kind", "outcome"))
+alerts_evaluated = registry.counter(
+    "palert_alerts_evaluated_total", "判定したユーザー数（地点のデータがあった人）", ("kind",))
+alerts_queued = registry.counter(
+    "palert_alerts_queued_total", "アウトボックスに積んだアラート数", ("kind",))
+alerts_sent = registry.counter(
+    "palert_alerts_sent_total", "送信できたアラート数", ("kind",))
+alerts_skipped = registry.counter(
+    "palert_alerts_skipped_total",
+    "送らなかったユーザー数（no_data: 地点のデータが無い / below_threshold: しきい値未満 / already_queued: 積み済み）",
+    ("kind", "reason"))
+alerts_failed = registry.counter(
+    "palert_alerts_failed_total", "送信に失敗したアラート数", ("kind", "outcome"))
+job_seconds = registry.histogram(
+    "palert_job_duration_seconds", "スケジューラーのジョブ所要時間", ("job", "status"),
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+
+
+def sql_op(sql):
+    # ラベルは先頭のキーワードだけ（SQL 文そのものは使わない）
+    word = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA", "CREATE") else "OTHER"
+
+
+def stats_gauge(name, help_text, fn, keys):
+    """
+    stats() の dict から数値だけを {"key": 値} でラベル付きゲージにする
+    fn: 引数なしで stats の dict を返す関数 / keys: 出す項目
+    """
+    return registry.gauge(
+        name, help_text, ("stat",),
+        fn=lambda: {(k,): v for k, v in fn().items() if k in keys and isinstance(v, (int, float))},
+    )
+
+
+def authorized(header):
+    # Authorization ヘッダーが METRICS_TOKEN と一致するか（トークン未設定なら True）
+    if not METRICS_TOKEN:
+        return True
+    return hmac.compare_digest((header or "").encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+
+# ----------------------------
+# Flask
+# ----------------------------
+def init_app(app):
+    """
+    リクエストごとの所要時間の計測と /metrics の登録
+    """
+    from flask import Response, abort, g, request
+
+    @app.before_request
+    def _metrics_start():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            http_request_seconds.observe(
+                time.perf_counter() - started,
+                method=request.method, route=rule, status=response.status_code,
+            )
+        return response
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        # Web は外から届くので、トークンが無ければ出さない
+        # 複数ワーカーでは答えるワーカーが毎回変わるので出さない（各ワーカーの専用ポートから集める）
+        if not METRICS_TOKEN or _worker is not None:
+            abort(404)
+        if not authorized(request.headers.get("Authorization")):
+            abort(401)
+        return Response(registry.expose(), mimetype="text/plain; version=0.0.4")
+
+
+def serve(port, host=None):
+    """
+    Flask の無いプロセス（スケジューラー・SSE サーバー）用に /metrics だけ返す HTTP サーバーを立てる
+    既定は METRICS_HOST（localhost）で待ち受ける。外から集めるなら METRICS_HOST と METRICS_TOKEN を設定する
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            if not authorized(self.headers.get("Authorization")):
+                self.send_error(401)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((METRICS_HOST if host is None else host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,505 @@
+import os
+import struct
+
+from grid import cell_key, cell_center
+
+# =========================
+# マイグレーション
+# =========================
+# 適用済みバージョンは PRAGMA user_version に持つ
+# 追加するときは MIGRATIONS の末尾に (番号, 名前, 関数) を足すだけ（既存は書き換えない）
+
+DEFAULT_LAT = float(os.getenv("LAT", "34.07"))
+DEFAULT_LON = float(os.getenv("LON", "132.99"))
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _run(conn, statements):
+    for sql in statements:
+        conn.execute(sql)
+
+
+# ----------------------------
+# 0001: 初期スキーマ（init_db で作っていたもの）
+# ----------------------------
+def m0001_baseline(conn):
+    _run(conn, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE,
+            pw_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            log_at TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            note TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pressure_daily (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            pressure_hpa REAL,
+            p_min REAL,
+            p_max REAL,
+            p_range REAL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            UNIQUE(user_id, date),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS alerts_sent (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            sent_at TEXT NOT NULL DEFAULT (datetime('now')),
+            UNIQUE(user_id, date, kind),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            base_threshold REAL NOT NULL DEFAULT 4.0,
+            drink_offset REAL NOT NULL DEFAULT 0.0,
+            pollen_offset REAL NOT NULL DEFAULT 0.0,
+            pollen_enabled INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+    ])
+
+
+# ----------------------------
+# 0002: ユーザーの地点（緯度経度）
+# ----------------------------
+def m0002_user_location(conn):
+    cols = _columns(conn, "users")
+    if "lat" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN lat REAL")
+    if "lon" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN lon REAL")
+
+
+# ----------------------------
+# 0003: 気圧を地点単位に正規化
+# pressure_daily（ユーザー×日）→ location_pressure_daily（地点×日）
+# ----------------------------
+def m0003_locations(conn):
+    _run(conn, [
+        """
+        CREATE TABLE locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cell_i INTEGER NOT NULL,
+            cell_j INTEGER NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            UNIQUE(cell_i, cell_j)
+        )
+        """,
+        "ALTER TABLE users ADD COLUMN location_id INTEGER REFERENCES locations(id)",
+        "CREATE INDEX idx_users_location ON users(location_id)",
+        # 緯度経度が変わったら地点を割り当て直す
+        """
+        CREATE TRIGGER users_location_changed
+        AFTER UPDATE OF lat, lon ON users
+        BEGIN
+            UPDATE users SET location_id = NULL WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TABLE location_pressure_daily (
+            location_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            pressure_hpa REAL,
+            p_min REAL,
+            p_max REAL,
+            p_range REAL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            PRIMARY KEY(location_id, date),
+            FOREIGN KEY(location_id) REFERENCES locations(id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX idx_location_pressure_daily_date ON location_pressure_daily(date, p_range)",
+    ])
+
+    assign_locations(conn, DEFAULT_LAT, DEFAULT_LON)
+
+    # 地点ごとに1行へまとめる（同じ地点・同じ日なら最後に書かれた行を採用）
+    conn.execute("""
+        INSERT OR IGNORE INTO location_pressure_daily
+            (location_id, date, pressure_hpa, p_min, p_max, p_range, created_at)
+        SELECT u.location_id, p.date, p.pressure_hpa, p.p_min, p.p_max, p.p_range, p.created_at
+        FROM pressure_daily p
+        JOIN users u ON u.id = p.user_id
+        WHERE p.id IN (
+            SELECT MAX(p2.id)
+            FROM pressure_daily p2
+            JOIN users u2 ON u2.id = p2.user_id
+            GROUP BY u2.location_id, p2.date
+        )
+    """)
+    conn.execute("DROP TABLE pressure_daily")
+
+
+# ----------------------------
+# 0004: 毎時の気圧時系列と、地点ごとのダッシュボード文書
+# ----------------------------
+def m0004_hourly_and_snapshots(conn):
+    _run(conn, [
+        """
+        CREATE TABLE pressure_hourly (
+            location_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            pressure_hpa REAL,
+            PRIMARY KEY(location_id, ts),
+            FOREIGN KEY(location_id) REFERENCES locations(id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE dashboard_snapshots (
+            location_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            risk TEXT,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(location_id) REFERENCES locations(id)
+        )
+        """,
+    ])
+
+
+# ----------------------------
+# 0005: ダッシュボード文書を詰めた形式（start + step + values）に変更
+# 旧形式は捨てる（次の取り込みで作り直される）
+# ----------------------------
+def m0005_compact_snapshots(conn):
+    conn.execute("DELETE FROM dashboard_snapshots")
+
+
+# ----------------------------
+# 0006: 送信待ちアラート（アウトボックス）
+# 判定ジョブが積み、配信ワーカーが取り出して送る
+# status: pending → sending → sent / dead（再試行し尽くした・恒久エラー）
+# sending 中の next_attempt_at は貸出期限（ワーカーが落ちたら期限後に取り直される）
+# ----------------------------
+def m0006_alert_outbox(conn):
+    _run(conn, [
+        """
+        CREATE TABLE alert_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            to_addr TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL DEFAULT (datetime('now')),
+            claimed_by TEXT,
+            claimed_at TEXT,
+            last_error TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            sent_at TEXT,
+            UNIQUE(user_id, date, kind),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        "CREATE INDEX idx_alert_outbox_ready ON alert_outbox(status, next_attempt_at)",
+    ])
+
+
+# ----------------------------
+# 0007: スケジューラーの実行履歴とジョブごとのロック
+# ----------------------------
+def m0007_scheduler(conn):
+    _run(conn, [
+        """
+        CREATE TABLE job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            scheduled_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            status TEXT NOT NULL,
+            duration_ms REAL,
+            error TEXT,
+            owner TEXT
+        )
+        """,
+        "CREATE INDEX idx_job_runs_job ON job_runs(job, scheduled_at)",
+        # 別プロセス・別ホストのスケジューラーと同じジョブを同時に走らせないためのロック
+        """
+        CREATE TABLE job_locks (
+            job TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ])
+
+
+# ----------------------------
+# 0008: 体調ログの索引と、日別・週別の集計（トリガーで挿入時に更新）
+# 週は月曜始まり（week = その週の月曜の日付）
+# ----------------------------
+def m0008_log_aggregates(conn):
+    _run(conn, [
+        "CREATE INDEX IF NOT EXISTS idx_logs_user_id ON logs(user_id, id)",
+        """
+        CREATE TABLE log_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            high_n INTEGER NOT NULL,
+            PRIMARY KEY(user_id, day)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE log_weekly (
+            user_id INTEGER NOT NULL,
+            week TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            high_n INTEGER NOT NULL,
+            PRIMARY KEY(user_id, week)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER logs_aggregate_insert
+        AFTER INSERT ON logs
+        BEGIN
+            INSERT INTO log_daily (user_id, day, n, score_sum, high_n)
+            VALUES (NEW.user_id, substr(NEW.log_at, 1, 10), 1, NEW.score, NEW.score >= 4)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                n = n + 1,
+                score_sum = score_sum + excluded.score_sum,
+                high_n = high_n + excluded.high_n;
+            INSERT INTO log_weekly (user_id, week, n, score_sum, high_n)
+            VALUES (NEW.user_id, date(substr(NEW.log_at, 1, 10), 'weekday 0', '-6 days'), 1, NEW.score, NEW.score >= 4)
+            ON CONFLICT(user_id, week) DO UPDATE SET
+                n = n + 1,
+                score_sum = score_sum + excluded.score_sum,
+                high_n = high_n + excluded.high_n;
+        END
+        """,
+        """
+        CREATE TRIGGER logs_aggregate_delete
+        AFTER DELETE ON logs
+        BEGIN
+            UPDATE log_daily
+            SET n = n - 1, score_sum = score_sum - OLD.score, high_n = high_n - (OLD.score >= 4)
+            WHERE user_id = OLD.user_id AND day = substr(OLD.log_at, 1, 10);
+            UPDATE log_weekly
+            SET n = n - 1, score_sum = score_sum - OLD.score, high_n = high_n - (OLD.score >= 4)
+            WHERE user_id = OLD.user_id AND week = date(substr(OLD.log_at, 1, 10), 'weekday 0', '-6 days');
+        END
+        """,
+        # 既存ログから作り直す
+        """
+        INSERT INTO log_daily (user_id, day, n, score_sum, high_n)
+        SELECT user_id, substr(log_at, 1, 10), COUNT(*), SUM(score), SUM(score >= 4)
+        FROM logs GROUP BY 1, 2
+        """,
+        """
+        INSERT INTO log_weekly (user_id, week, n, score_sum, high_n)
+        SELECT user_id, date(substr(log_at, 1, 10), 'weekday 0', '-6 days'), COUNT(*), SUM(score), SUM(score >= 4)
+        FROM logs GROUP BY 1, 2
+        """,
+    ])
+
+
+# ----------------------------
+# 0009: ユーザーごとの気圧感受性（体調スコア × 3時間気圧変化の逐次統計）
+# last_log_id までのログを反映済み
+# ----------------------------
+def m0009_user_sensitivity(conn):
+    conn.execute("""
+        CREATE TABLE user_sensitivity (
+            user_id INTEGER PRIMARY KEY,
+            n INTEGER NOT NULL DEFAULT 0,
+            mean_dp REAL NOT NULL DEFAULT 0,
+            mean_score REAL NOT NULL DEFAULT 0,
+            m2_dp REAL NOT NULL DEFAULT 0,
+            m2_score REAL NOT NULL DEFAULT 0,
+            c_dp_score REAL NOT NULL DEFAULT 0,
+            last_log_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+
+# ----------------------------
+# 0010: プロセス間で共有するキャッシュ（複数ワーカーで同じ値を配る）
+# fill_owner / fill_expires は「今取りに行っているプロセス」の貸出
+# ----------------------------
+def m0010_shared_cache(conn):
+    conn.execute("""
+        CREATE TABLE shared_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            stored_at REAL,
+            fill_owner TEXT,
+            fill_expires REAL
+        ) WITHOUT ROWID
+    """)
+
+
+# ----------------------------
+# 0011: 過去データ取り込み（backfill-pressure）のチェックポイント
+# start_date 〜 done_through まで途切れなく書き込み済み
+# ----------------------------
+def m0011_backfill_progress(conn):
+    conn.execute("""
+        CREATE TABLE backfill_progress (
+            location_id INTEGER PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            done_through TEXT NOT NULL,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(location_id) REFERENCES locations(id)
+        )
+    """)
+
+
+# ----------------------------
+# 0012: 毎時気圧を地点 × 日の float32 ブロックに（pressure_store.py）
+# pressure_hourly の行を詰め替えてから消す
+# ----------------------------
+def m0012_pressure_blocks(conn):
+    conn.execute("""
+        CREATE TABLE pressure_blocks (
+            location_id INTEGER NOT NULL,
+            base_epoch INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY(location_id, base_epoch),
+            FOREIGN KEY(location_id) REFERENCES locations(id)
+        ) WITHOUT ROWID
+    """)
+
+    # ts は日本時間の "YYYY-MM-DD HH:MM"。日の 0時（JST）の UNIX 秒と時（0〜23）に分ける
+    rows = conn.execute("""
+        SELECT location_id,
+               CAST(strftime('%s', substr(ts, 1, 10)) AS INTEGER) - 32400 AS base_epoch,
+               CAST(substr(ts, 12, 2) AS INTEGER) AS hour,
+               pressure_hpa
+        FROM pressure_hourly
+        WHERE pressure_hpa IS NOT NULL
+        ORDER BY location_id, ts
+    """)
+
+    def blocks():
+        key, day = None, None
+        for location_id, base_epoch, hour, p in rows:
+            if (location_id, base_epoch) != key:
+                if key is not None:
+                    yield (*key, struct.pack("<24f", *day))
+                key, day = (location_id, base_epoch), [float("nan")] * 24
+            day[hour] = p
+        if key is not None:
+            yield (*key, struct.pack("<24f", *day))
+
+    conn.executemany("INSERT INTO pressure_blocks (location_id, base_epoch, data) VALUES (?, ?, ?)", blocks())
+    conn.execute("DROP TABLE pressure_hourly")
+
+
+MIGRATIONS = [
+    (1, "baseline", m0001_baseline),
+    (2, "user_location", m0002_user_location),
+    (3, "locations", m0003_locations),
+    (4, "hourly_and_snapshots", m0004_hourly_and_snapshots),
+    (5, "compact_snapshots", m0005_compact_snapshots),
+    (6, "alert_outbox", m0006_alert_outbox),
+    (7, "scheduler", m0007_scheduler),
+    (8, "log_aggregates", m0008_log_aggregates),
+    (9, "user_sensitivity", m0009_user_sensitivity),
+    (10, "shared_cache", m0010_shared_cache),
+    (11, "backfill_progress", m0011_backfill_progress),
+    (12, "pressure_blocks", m0012_pressure_blocks),
+]
+
+
+# =========================
+# 地点の割り当て
+# =========================
+def assign_locations(conn, default_lat=DEFAULT_LAT, default_lon=DEFAULT_LON):
+    """
+    location_id が未設定のユーザーを格子セル（空間ハッシュ）に割り当てる
+    セルに対応する locations 行が無ければ作る
+    戻り値: 割り当てたユーザー数
+    """
+    users = conn.execute(
+        "SELECT id, lat, lon FROM users WHERE location_id IS NULL"
+    ).fetchall()
+    if not users:
+        return 0
+
+    groups = {}
+    for user_id, lat, lon in users:
+        lat = default_lat if lat is None else lat
+        lon = default_lon if lon is None else lon
+        groups.setdefault(cell_key(float(lat), float(lon)), []).append(user_id)
+
+    updates = []
+    for key, user_ids in groups.items():
+        c_lat, c_lon = cell_center(key)
+        conn.execute(
+            "INSERT OR IGNORE INTO locations (cell_i, cell_j, lat, lon) VALUES (?, ?, ?, ?)",
+            (key[0], key[1], c_lat, c_lon),
+        )
+        location_id = conn.execute(
+            "SELECT id FROM locations WHERE cell_i = ? AND cell_j = ?", key
+        ).fetchone()[0]
+        updates.extend((location_id, user_id) for user_id in user_ids)
+
+    conn.executemany("UPDATE users SET location_id = ? WHERE id = ?", updates)
+    return len(updates)
+
+
+# =========================
+# 実行
+# =========================
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, verbose=True):
+    """
+    未適用のマイグレーションを番号順に1つずつトランザクションで流す
+    途中で失敗したらそのマイグレーションは丸ごとロールバック
+    """
+    version = current_version(conn)
+    for number, name, fn in MIGRATIONS:
+        if number <= version:
+            continue
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN")
+        try:
+            fn(conn)
+            conn.execute(f"PRAGMA user_version = {int(number)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+        if verbose:
+            print(f"[INFO] migrated to {number:04d}_{name}")
+    return version
@@ -0,0 +1,198 @@
+import bisect
+import os
+import threading
+from collections import deque
+
+import metrics
+import outbox
+import pressure_store
+import thresholds
+from forecast import ForecastError, fetch_minutely_batch
+from mailer import Mail
+
+# =========================
+# 15分ごとのナウキャスト（急な気圧低下の検知）
+# =========================
+# 毎時の値だけだと、90分で一気に下がるような変化が1時間おきの値にならされてしまう
+# NOWCAST_ENABLED=1 なら、取り込みの周期ごとに Open-Meteo の minutely_15 も取り、
+# 地点ごとの検知器（DropDetector）に「前回より新しく、今の時刻までの」値だけを流す
+# 検知器は直近 NOWCAST_WINDOW_MINUTES 分の最高値を単調キュー（deque）で持つ
+# → 1点あたり O(1)（償却）で「窓の中の最高値から今まで」の低下量が更新できる（系列を毎回なめ直さない）
+# 低下量が各ユーザーのしきい値に届いたら、その周期のうちに当日分のアラートを積んで送る（1日1通まで）
+
+NOWCAST_ENABLED = os.getenv("NOWCAST_ENABLED", "0") == "1"
+NOWCAST_WINDOW_MINUTES = int(os.getenv("NOWCAST_WINDOW_MINUTES", "180"))
+# 最後の値がこれより古い地点は判定しない（上流が止まっている間に古い低下で送らない）
+NOWCAST_MAX_AGE = int(os.getenv("NOWCAST_MAX_AGE", "3600"))
+NOWCAST_STEP = 15 * 60
+KIND = "nowcast_drop"
+
+
+# ----------------------------
+# 検知器（1地点分）
+# ----------------------------
+class DropDetector:
+    """
+    push(epoch, hpa) を時刻の昇順で呼ぶ。前回以前の時刻・欠測は無視する
+    drop: 直近 width 秒の最高値から今の値までの変化（マイナスが低下、0 以下）
+    """
+
+    __slots__ = ("width", "peaks", "last_epoch", "value", "drop", "peak_epoch", "peak")
+
+    def __init__(self, width=NOWCAST_WINDOW_MINUTES * 60):
+        self.width = width
+        # (epoch, hpa) を hpa の降順に並べておく。先頭が窓の中の最高値
+        self.peaks = deque()
+        self.last_epoch = None
+        self.value = None
+        self.drop = 0.0
+        self.peak_epoch = None
+        self.peak = None
+
+    def push(self, epoch, hpa):
+        if hpa is None or hpa != hpa or (self.last_epoch is not None and epoch <= self.last_epoch):
+            return False
+        peaks = self.peaks
+        # 窓から外れた古い値を前から、今の値以下の値（もう最高値になり得ない）を後ろから捨てる
+        while peaks and peaks[0][0] < epoch - self.width:
+            peaks.popleft()
+        while peaks and peaks[-1][1] <= hpa:
+            peaks.pop()
+        peaks.append((epoch, hpa))
+
+        self.last_epoch = epoch
+        self.value = hpa
+        self.peak_epoch, self.peak = peaks[0]
+        self.drop = round(hpa - self.peak, 1)
+        return True
+
+
+def _index_after(epochs, t):
+    # 昇順の epochs で t より後になる最初の位置（等間隔の range なら割り算、それ以外は二分探索）
+    if isinstance(epochs, range):
+        return min(len(epochs), max(0, (t - epochs.start) // epochs.step + 1))
+    return bisect.bisect_right(epochs, t)
+
+
+class Nowcast:
+    """
+    地点ごとの検知器（プロセスに1つ）
+    検知器は最初に値が来た時に作り、以後の周期は新しい値だけを流す
+    """
+
+    def __init__(self, window_minutes=NOWCAST_WINDOW_MINUTES):
+        self.width = window_minutes * 60
+        self._detectors = {}
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    def update(self, location_ids, series, now):
+        """
+        series: location_ids と同じ順の [(times, values), ...]（fetch_minutely_batch の戻り値）
+        now より後（予報）の値は流さない。戻り値: 流した値の数
+        """
+        present = [n for n, (times, _) in enumerate(series) if times]
+        if not present:
+            return 0
+        # ラベルは先頭と末尾だけ（全地点ぶん1回で）エポック秒にし、間は 15分刻みの range とみなす
+        ends = pressure_store.to_epochs(
+            [t for n in present for t in (series[n][0][0], series[n][0][-1])]
+        ).reshape(-1, 2).tolist()
+
+        pushed = 0
+        with self._lock:
+            for n, (first, last) in zip(present, ends):
+                times, values = series[n]
+                epochs = range(first, last + NOWCAST_STEP, NOWCAST_STEP)
+                if len(epochs) != len(times):
+                    # 等間隔でない応答（欠けた時刻がある等）はラベルを全部読む
+                    epochs = pressure_store.to_epochs(times).tolist()
+
+                location_id = location_ids[n]
+                det = self._detectors.get(location_id)
+                if det is None:
+                    det = self._detectors[location_id] = DropDetector(self.width)
+                # 前回流した時刻より後 〜 now までだけ
+                a = 0 if det.last_epoch is None else _index_after(epochs, det.last_epoch)
+                b = _index_after(epochs, now)
+                for t, v in zip(epochs[a:b], values[a:b]):
+                    pushed += det.push(t, v)
+            self.samples += pushed
+        return pushed
+
+    def current(self, location_ids, now, max_age=NOWCAST_MAX_AGE):
+        # 判定できる地点の {location_id: DropDetector}（最後の値が max_age 秒以内）
+        with self._lock:
+            return {
+                i: det for i in location_ids
+                if (det := self._detectors.get(i)) is not None
+                and det.last_epoch is not None and det.last_epoch >= now - max_age
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "locations": len(self._detectors),
+                "samples": self.samples,
+                "dropping": sum(1 for d in self._detectors.values() if d.drop < 0),
+            }
+
+
+state = Nowcast()
+metrics.stats_gauge("palert_nowcast", "ナウキャストの検知器", state.stats, ("locations", "samples", "dropping"))
+
+
+# ----------------------------
+# 取り込みの周期ごとに
+# ----------------------------
+def run(conn, locations, now=None):
+    """
+    15分値を取得して検知器を進め、低下量がしきい値に届いた人へ当日のアラートを積んで送る
+    戻り値: 積んだ件数
+    """
+    locations = list(locations)
+    if not locations:
+        return 0
+    now = pressure_store.now_epoch() if now is None else now
+    ids = [l["id"] for l in locations]
+    try:
+        series = fetch_minutely_batch([(l["lat"], l["lon"]) for l in locations])
+    except ForecastError as e:
+        print(f"[WARN] {KIND}: 15分値の取得に失敗しました（次の周期で再試行）: {e}")
+        return 0
+    pushed = state.update(ids, series, now)
+
+    detectors = state.current(ids, now)
+    metrics.alert_locations.inc(len(detectors), kind=KIND, outcome="evaluated")
+    metrics.alert_locations.inc(len(ids) - len(detectors), kind=KIND, outcome="no_data")
+
+    users = thresholds.load(conn)
+    hits = thresholds.evaluate(users, list(detectors), [d.drop for d in detectors.values()], direction="drop")
+    thresholds.record(KIND, users, list(detectors), hits)
+
+    today = pressure_store.to_labels([now])[0][:10]
+    cur = conn.cursor()
+    mails = []
+    for t in thresholds.unsent_users(cur, hits, today, KIND):
+        drop, _, threshold, location_id = hits[t["id"]]
+        det = detectors[location_id]
+        peak_at, last_at = pressure_store.to_labels([det.peak_epoch, det.last_epoch])
+        minutes = (det.last_epoch - det.peak_epoch) // 60
+        mails.append(Mail(
+            to_addr=t["email"],
+            subject=f"[P-Alert] 気圧が急に下がっています（{drop:+.1f}hPa）",
+            body=(
+                f"{peak_at[11:]} の {det.peak:.1f} hPa から {last_at[11:]} の {det.value:.1f} hPa まで、"
+                f"{minutes}分で {drop:+.1f} hPa 下がりました（15分ごとの速報値）。\n\n"
+                f"判定: あなたのしきい値 {threshold:.1f}hPa を超えました。\n"
+                "体調に気をつけて、無理せずお過ごしください。"
+            ),
+            tag=int(t["id"]),
+        ))
+
+    queued = outbox.enqueue(cur, mails, today, KIND)
+    conn.commit()
+    print(f"[INFO] {KIND}: locations={len(detectors)} samples={pushed} queued={queued}")
+    if queued:
+        outbox.deliver(label=KIND)
+    return queued
@@ -0,0 +1,276 @@
+import os
+import random
+import socket
+import threading
+import time
+
+import db
+import metrics
+from mailer import Mail, SmtpDispatcher, is_transient
+
+# =========================
+# アラートのアウトボックス
+# =========================
+# 判定ジョブは enqueue() で alert_outbox に積んでコミットするだけ
+# 送信は配信ワーカーが claim → 送信 → ack を小さなバッチで繰り返す（ack は1通送るごと）
+# - 積むのは (user_id, date, kind) で一意（ジョブを再実行しても二重に積まない）
+# - 取り出した行は貸出期限つき。ワーカーが落ちても期限後に別ワーカーが取り直す
+#   （取り直しも attempts に数え、上限に達した行は取り直さずに dead）
+# - 送れたら sent + alerts_sent を同じトランザクションで記録
+# - 一時エラーは指数バックオフで再試行、恒久エラー・上限超えは dead
+# - ワーカーは DB 接続を1バッチの間だけ借りる。本数はプールの空きまで（ジョブが重なっても取り合わない）
+#   借りられなければ（PoolTimeout）少し待って借り直す
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20"))
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "60"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+# DB 接続が借りられない時に借り直す回数（until_empty の時。超えたら残りは次の周期で送る）
+OUTBOX_POOL_RETRIES = int(os.getenv("OUTBOX_POOL_RETRIES", "3"))
+
+STATUSES = ("pending", "sending", "sent", "dead")
+
+
+# ----------------------------
+# 積む
+# ----------------------------
+def enqueue(cur, mails, yyyy_mm_dd, kind):
+    """
+    mails（tag=user_id の Mail）を alert_outbox に積む
+    既に同じ (user_id, date, kind) があれば無視。コミットは呼び出し側
+    戻り値: 新しく積んだ件数
+    """
+    mails = list(mails)
+    before = cur.connection.total_changes
+    cur.executemany("""
+        INSERT OR IGNORE INTO alert_outbox (user_id, date, kind, to_addr, subject, body)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, ((int(m.tag), yyyy_mm_dd, kind, m.to_addr, m.subject, m.body) for m in mails))
+    queued = cur.connection.total_changes - before
+    metrics.alerts_queued.inc(queued, kind=kind)
+    metrics.alerts_skipped.inc(len(mails) - queued, kind=kind, reason="already_queued")
+    return queued
+
+
+# ----------------------------
+# 取り出す・記録する
+# ----------------------------
+def claim(conn, worker_id, limit=OUTBOX_BATCH, lease=OUTBOX_LEASE, max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """
+    送信可能な行を最大 limit 件、貸出状態（sending）にして返す
+    期限切れの sending（落ちたワーカーの分）も対象。1文の UPDATE なので取り合いにならない
+    ただし期限切れの sending で attempts が max_attempts に達した行は dead にする
+    （送る途中でワーカーが落ち続ける行を、いつまでも取り直さない）
+    """
+    expired = conn.execute("""
+        UPDATE alert_outbox
+        SET status = 'dead', last_error = ?
+        WHERE status = 'sending' AND next_attempt_at <= datetime('now') AND attempts >= ?
+        RETURNING kind
+    """, (f"lease expired after {max_attempts} attempts", max_attempts)).fetchall()
+    rows = conn.execute("""
+        UPDATE alert_outbox
+        SET status = 'sending',
+            attempts = attempts + 1,
+            claimed_by = ?,
+            claimed_at = datetime('now'),
+            next_attempt_at = datetime('now', ?)
+        WHERE id IN (
+            SELECT id FROM alert_outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= datetime('now')
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+        )
+        RETURNING id, user_id, date, kind, to_addr, subject, body, attempts
+    """, (worker_id, f"+{int(lease)} seconds", limit)).fetchall()
+    conn.commit()
+    for r in expired:
+        metrics.alerts_failed.inc(kind=r["kind"], outcome="dead")
+    return rows
+
+
+def _retry_delay(attempts):
+    # フルジッター: 0 〜 min(上限, base * 2^(attempts-1))
+    return random.uniform(0, min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF * 2 ** (attempts - 1)))
+
+
+def ack(conn, worker_id, sent_rows, failed, max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """
+    送信結果を1トランザクションで記録する
+    sent_rows: 送れた行 / failed: [(行, 例外), ...]
+    自分が取った行（claimed_by = worker_id かつ sending）だけ更新する
+    """
+    conn.executemany("""
+        UPDATE alert_outbox
+        SET status = 'sent', sent_at = datetime('now'), last_error = NULL
+        WHERE id = ? AND status = 'sending' AND claimed_by = ?
+    """, ((r["id"], worker_id) for r in sent_rows))
+    conn.executemany("""
+        INSERT OR IGNORE INTO alerts_sent (user_id, date, kind) VALUES (?, ?, ?)
+    """, ((r["user_id"], r["date"], r["kind"]) for r in sent_rows))
+
+    retry, dead = [], []
+    for r, error in failed:
+        if is_transient(error) and r["attempts"] < max_attempts:
+            retry.append((f"+{int(_retry_delay(r['attempts']))} seconds", repr(error)[:500], r["id"], worker_id))
+            metrics.alerts_failed.inc(kind=r["kind"], outcome="retry")
+        else:
+            dead.append((repr(error)[:500], r["id"], worker_id))
+            metrics.alerts_failed.inc(kind=r["kind"], outcome="dead")
+    conn.executemany("""
+        UPDATE alert_outbox
+        SET status = 'pending', next_attempt_at = datetime('now', ?), last_error = ?
+        WHERE id = ? AND status = 'sending' AND claimed_by = ?
+    """, retry)
+    conn.executemany("""
+        UPDATE alert_outbox
+        SET status = 'dead', last_error = ?
+        WHERE id = ? AND status = 'sending' AND claimed_by = ?
+    """, dead)
+    conn.commit()
+
+    for r in sent_rows:
+        metrics.alerts_sent.inc(kind=r["kind"])
+    return len(retry), len(dead)
+
+
+def requeue_dead(conn, kind=None):
+    # dead を pending に戻す（設定を直した後の手動再送用）
+    cur = conn.execute("""
+        UPDATE alert_outbox
+        SET status = 'pending', attempts = 0, next_attempt_at = datetime('now')
+        WHERE status = 'dead' AND (? IS NULL OR kind = ?)
+    """, (kind, kind))
+    conn.commit()
+    return cur.rowcount
+
+
+def has_ready(conn):
+    # 今すぐ送れる行があるか（無ければ SMTP に繋がずに済ませる）
+    return conn.execute("""
+        SELECT 1 FROM alert_outbox
+        WHERE status IN ('pending', 'sending') AND next_attempt_at <= datetime('now')
+        LIMIT 1
+    """).fetchone() is not None
+
+
+def stats(conn):
+    counts = dict.fromkeys(STATUSES, 0)
+    for status, n in conn.execute("SELECT status, COUNT(*) FROM alert_outbox GROUP BY status"):
+        counts[status] = n
+    return counts
+
+
+# ----------------------------
+# 配信ワーカー
+# ----------------------------
+class DeliveryWorker(threading.Thread):
+    """
+    claim → 送信 → ack を繰り返すスレッド
+    until_empty=True なら送るものが無くなった時点で終わる（ジョブの後処理用）
+    """
+
+    def __init__(self, n=0, batch=OUTBOX_BATCH, until_empty=False, poll_interval=OUTBOX_POLL_INTERVAL):
+        super().__init__(name=f"outbox-worker-{n}", daemon=True)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{n}"
+        self.batch = batch
+        self.until_empty = until_empty
+        self.poll_interval = poll_interval
+        # 再試行はアウトボックス側で持つので、ディスパッチャーは即時の再送をしない
+        # SMTP の接続はこのワーカーが終わるまで張ったまま（バッチごとに STARTTLS・認証し直さない）
+        self.dispatcher = SmtpDispatcher(workers=1, max_retries=0)
+        self._stop_event = threading.Event()
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.pool_timeouts = 0
+
+    def run_once(self, conn):
+        rows = claim(conn, self.worker_id, self.batch)
+        if not rows:
+            return 0
+        mails = [
+            Mail(r["to_addr"], r["subject"], r["body"], tag=r, message_id=f"<alert-{r['id']}@p-alert>")
+            for r in rows
+        ]
+        # 1通送るごとに記録する（バッチの途中で落ちても、送れた分を取り直して二重に送らない）
+        for mail in mails:
+            res = self.dispatcher.send_many([mail])[0]
+            if res.ok:
+                retried, dead = ack(conn, self.worker_id, [mail.tag], [])
+                self.sent += 1
+            else:
+                print(f"[ERROR] send failed {mail.tag['kind']} to {mail.to_addr}: {res.error}")
+                retried, dead = ack(conn, self.worker_id, [], [(mail.tag, res.error)])
+            self.retried += retried
+            self.dead += dead
+        return len(rows)
+
+    def run(self):
+        busy = 0
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    # 接続は1バッチ（claim → 送信 → ack）の間だけ借りる。待っている間は持たない
+                    with db.connection() as conn:
+                        busy = 0
+                        if self.run_once(conn):
+                            continue
+                except db.PoolTimeout as e:
+                    busy += 1
+                    self.pool_timeouts += 1
+                    if self.until_empty and busy > OUTBOX_POOL_RETRIES:
+                        print(f"[WARN] outbox worker {self.worker_id}: DB 接続が借りられません（残りは次の周期で送ります）: {e}")
+                        return
+                    # フルジッター（他のワーカー・ジョブと同時に借り直さない）
+                    delay = random.uniform(0, self.poll_interval * 2 ** (busy - 1))
+                    print(f"[WARN] outbox worker {self.worker_id}: {e}（{delay:.1f}s 後に借り直します）")
+                    self._stop_event.wait(delay)
+                    continue
+                except Exception as e:
+                    print(f"[ERROR] outbox worker {self.worker_id}: {e}")
+                if self.until_empty:
+                    return
+                self._stop_event.wait(self.poll_interval)
+        finally:
+            self.dispatcher.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def deliver(workers=OUTBOX_WORKERS, until_empty=True, label="outbox"):
+    """
+    workers 本の配信ワーカーを回す（DB 接続プールの空きの本数まで）
+    until_empty=True なら送れるものを送り切って戻る（送信数を返す）
+    """
+    if until_empty:
+        try:
+            with db.connection() as conn:
+                if not has_ready(conn):
+                    return 0
+        except db.PoolTimeout as e:
+            # 積んだ分は残っているので、次の deliver-alerts で送る
+            print(f"[WARN] {label}: DB 接続が借りられないので今回は送りません: {e}")
+            return 0
+
+    # 他のジョブ・リクエストが借りている分は使わない（呼び出し元が借りている分も含めて）
+    pool = db.pool.stats()
+    free = pool["size"] - pool["in_use"]
+    if workers > free:
+        print(f"[INFO] {label}: workers={workers} → {max(1, free)}（DB 接続プールの空き）")
+    started = time.perf_counter()
+    threads = [DeliveryWorker(n, until_empty=until_empty) for n in range(max(1, min(workers, free)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sent = sum(t.sent for t in threads)
+    print(
+        f"[INFO] {label}: sent={sent} retry={sum(t.retried for t in threads)} "
+        f"dead={sum(t.dead for t in threads)} elapsed={time.perf_counter() - started:.2f}s"
+    )
+    return sent
@@ -0,0 +1,160 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import db
+import metrics
+
+# =========================
+# パスワードのハッシュ（ログイン・登録）
+# =========================
+# ハッシュ1回で数百ミリ秒 CPU を使うので、リクエストのスレッドでは計算せず
+# プロセスプール（PASSWORD_HASH_WORKERS 本）に回して結果だけ待つ
+# 実行中 + 順番待ちが PASSWORD_HASH_MAX_PENDING に達していたら計算せずにすぐ HashBusy
+# → ログインが殺到しても CPU を使い切らず、ダッシュボードの応答は落ちない
+# ログインに成功した時、保存済みのハッシュが PASSWORD_HASH_METHOD と違えば作り直す（upgrade）
+# ハッシュを待つ間は DB 接続を持たない（ワーカーのスレッド数 > DB_POOL_SIZE なので、
+# 持ったまま待つとログインの殺到で接続を使い切り、ダッシュボードが PoolTimeout になる）
+
+# werkzeug がハッシュの先頭に書く形（パラメーターまで）で指定する
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# 0 ならプールを使わずその場で計算（CLI・単発のスクリプト用）
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(max(1, PASSWORD_HASH_WORKERS) * 4)))
+# 結果を待つ上限（秒）
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "5"))
+# プールの子プロセスの作り方（fork は使わない）
+# 子は起動スクリプト（__main__）を読み込み直すので、スクリプト側は if __name__ == "__main__": で守る
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class HashBusy(RuntimeError):
+    """ハッシュの待ち行列がいっぱい・待ちきれなかった（503 で断る）"""
+
+
+class HashPool:
+    """
+    ハッシュ計算用のプロセスプール
+    pending（投げてまだ終わっていない数）が max_pending に達したら投げずに HashBusy
+    プールは最初に使う時に作る。fork した子（gunicorn のワーカー）では親のものを使わず作り直す
+    pending は計算が本当に終わった時に減らす（待ちきれずに諦めた計算も、終わるまで上限に数える）
+    """
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 timeout=PASSWORD_HASH_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            # 作る時にはもうリクエストのスレッド・SSE の監視・接続プールが動いているので fork はしない
+            # （他スレッドが持っていたロックを子が引き継いで固まることがある）
+            # forkserver / spawn の子はまっさらなプロセスから始まる
+            ctx = multiprocessing.get_context(START_METHOD)
+            if START_METHOD == "forkserver":
+                # ハッシュの関数はサーバーで先に読んでおく（子ごとに読み込み直さない）
+                ctx.set_forkserver_preload(["werkzeug.security"])
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=ctx)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _done(self, _future):
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HashBusy(f"password hash queue is full: pending={self.pending}")
+            try:
+                future = self._get_executor().submit(fn, *args)
+            except BrokenProcessPool:
+                # 子プロセスが落ちていたら作り直して1回だけ投げ直す
+                self._executor = None
+                future = self._get_executor().submit(fn, *args)
+            self.pending += 1
+            self.submitted += 1
+        future.add_done_callback(self._done)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # cancel() で止まるのは順番待ちのものだけ。計算中のものは最後まで走る
+            # pending は done コールバックで減らすので、走り続けている分も上限に数えられたまま
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            raise HashBusy(f"password hash timed out after {self.timeout}s") from None
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+
+pool = HashPool()
+metrics.stats_gauge(
+    "palert_password_hash", "パスワードハッシュのプール", pool.stats,
+    ("workers", "pending", "submitted", "rejected", "timeouts"),
+)
+
+
+# ----------------------------
+# 呼び出し口
+# ----------------------------
+def hash_password(password):
+    return pool.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(pw_hash, password):
+    return pool.run(check_password_hash, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    # 先頭の方式・パラメーター（"pbkdf2:sha256:600000" など）が今の設定と違う
+    return pw_hash.split("$", 1)[0] != PASSWORD_HASH_METHOD
+
+
+def upgrade(user_id, old_hash, password):
+    """
+    ログイン成功の直後に呼ぶ：古い方式のハッシュなら今の設定で作り直して保存する
+    接続は作り直した後、保存する間だけ借りる
+    混んでいれば何もしない（次のログインでまた試す）。戻り値: 作り直したか
+    """
+    if not needs_rehash(old_hash):
+        return False
+    try:
+        new_hash = hash_password(password)
+    except HashBusy:
+        return False
+    with db.connection() as conn:
+        conn.execute("UPDATE users SET pw_hash = ? WHERE id = ? AND pw_hash = ?", (new_hash, user_id, old_hash))
+        conn.commit()
+    return True
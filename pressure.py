@@ -1,11 +1,59 @@
-from flask import Blueprint, render_template, redirect, url_for, jsonify
-from datetime import datetime
+from flask import Blueprint, render_template, redirect, url_for, jsonify, current_app, request, make_response
+from datetime import datetime, timezone
 from flask_login import login_required, current_user
+import gzip
 import json
-import urllib.request
+import os
+import threading
+
+from cache import CACHE_STATS, ForecastCache, LRUCache, SharedCache
+from risk import danger_window, score, RISK_LEVELS
+from db import get_conn
+from forecast import ForecastError, fetch_hourly
+from grid import cell_center, cell_key
+from migrations import DEFAULT_LAT, DEFAULT_LON
+import metrics
+import pressure_store
+from pressure_series import PressureSeries
+from sse import hub, snapshot_version, format_event, SSE_MAX_STREAMS
 
 pressure_bp = Blueprint("pressure", __name__)
 
+# 予報キャッシュ（予報の格子セルごと。値にモデル実行回を持つ）
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", "600"))
+FORECAST_CACHE_STALE_TTL = float(os.getenv("FORECAST_CACHE_STALE_TTL", "3600"))
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "1024"))
+MODEL_RUN_HOURS = 3          # JMA MSM は3時間ごとに更新
+
+# shared: shared_cache テーブルで全ワーカープロセスが共有（既定）/ memory: プロセス内だけ
+FORECAST_CACHE_BACKEND = os.getenv("FORECAST_CACHE_BACKEND", "shared")
+
+if FORECAST_CACHE_BACKEND == "memory":
+    forecast_cache = ForecastCache(
+        maxsize=FORECAST_CACHE_SIZE,
+        ttl=FORECAST_CACHE_TTL,
+        stale_ttl=FORECAST_CACHE_STALE_TTL,
+    )
+else:
+    forecast_cache = SharedCache("forecast", ttl=FORECAST_CACHE_TTL, stale_ttl=FORECAST_CACHE_STALE_TTL)
+
+# 取り込み前の地点の判定結果（ダッシュボード文書）も同じ寿命で共有する
+dashboard_cache = SharedCache("dashboard", ttl=FORECAST_CACHE_TTL, stale_ttl=FORECAST_CACHE_STALE_TTL)
+
+metrics.stats_gauge("palert_forecast_cache", "予報キャッシュの状態", forecast_cache.stats, CACHE_STATS)
+
+# /api/pressure の応答（系列は start + step + values の詰めた形）
+SERIES_STEP = 3600
+API_CACHE_CONTROL = "private, max-age=60, must-revalidate"
+GZIP_MIN_BYTES = 512
+
+# since= 差分用に、最近配った版の系列を覚えておく（版 → (start, values)）
+served_versions = LRUCache(maxsize=4096, ttl=6 * 3600)
+
+# 古いスナップショットを取り込み直す時の地点ごとのロック（このプロセス内で同じ地点を同時に取りに行かない）
+_refresh_locks = {}
+_refresh_locks_guard = threading.Lock()
+
 
 # ----------------------------
 # ダッシュボード画面
@@ -19,18 +67,8 @@ def index():
 # 気圧取得
 # ----------------------------
 def fetch_pressure(lat, lon):
-    url = (
-        "https://api.open-meteo.com/v1/jma?"
-        f"latitude={lat}&longitude={lon}"
-        "&hourly=pressure_msl"
-        "&timezone=Asia%2FTokyo"
-    )
-
-    with urllib.request.urlopen(url) as response:
-        data = json.loads(response.read().decode())
-
-    times = data["hourly"]["time"]
-    pressures = data["hourly"]["pressure_msl"]
+    # 予報クライアント経由（タイムアウト・再試行・接続の使い回しつき）
+    times, pressures = fetch_hourly(lat, lon, forecast_days=2, caller="fetch_pressure")
 
     labels = [t.replace("T", " ")[:16] for t in times[:48]]
     values = [round(p, 1) for p in pressures[:48]]
@@ -38,79 +76,259 @@ def fetch_pressure(lat, lon):
     return labels, values
 
 
-def _parse_label_to_dt(label: str) -> datetime:
-    s = label.replace("T", " ")[:16]
-    return datetime.strptime(s, "%Y-%m-%d %H:%M")
+def _model_run(now=None):
+    # 直近のモデル実行時刻（UTC, MODEL_RUN_HOURS 刻み）
+    now = now or datetime.now(timezone.utc)
+    return now.strftime("%Y%m%d") + f"{now.hour - now.hour % MODEL_RUN_HOURS:02d}"
 
 
-def _find_now_index(labels):
-    now = datetime.now()
-    best_i = 0
-    best_diff = None
+def _cached(cache, lat, lon, load):
+    """
+    格子セル（grid.cell_key）をキーに、{"model_run", "data"} の形で cache に置く
+    モデル実行回が変わった値は TTL 内でも古い値として返しつつ裏で取り直す
+    （キーに実行回を入れないので、実行回の境目でも全セルが同時に同期ミスにならない）
+    load はセル中心の (lat, lon) を受け取る
+    """
+    key = cell_key(lat, lon)
+    c_lat, c_lon = cell_center(key)
+    run = _model_run()
 
-    for i, lb in enumerate(labels):
-        try:
-            dt = _parse_label_to_dt(lb)
-            diff = abs((dt - now).total_seconds())
-            if best_diff is None or diff < best_diff:
-                best_diff = diff
-                best_i = i
-        except:
-            continue
+    def loader():
+        return {"model_run": _model_run(), "data": load(c_lat, c_lon)}
 
-    return best_i
+    return cache.get_or_fetch(key, loader, fresh=lambda v: v["model_run"] == run)["data"]
 
 
-# ----------------------------
-# API
-# ----------------------------
-@login_required
-@pressure_bp.route("/api/pressure")
-def api_pressure():
+def get_forecast(lat, lon):
+    """
+    キャッシュ経由で fetch_pressure を呼ぶ（同じ格子セルは1回だけ取りに行く）
+    戻り値: (labels, values)
+    """
+    labels, values = _cached(forecast_cache, lat, lon, fetch_pressure)
+    return labels, values
 
-    labels, values = fetch_pressure(34.07, 132.99)
 
-    if not values:
-        return jsonify({"error": "no data"}), 500
+def get_dashboard(lat, lon):
+    """
+    取り込み前の地点用：予報 → 危険帯の判定 → ダッシュボード文書
+    判定結果ごと共有キャッシュに置くので、どのワーカーも同じ文書（同じ ETag）を返す
+    """
+    def build(c_lat, c_lon):
+        labels, values = get_forecast(c_lat, c_lon)
+        if not values:
+            raise ValueError("no data")
+        danger, risk = danger_window(labels, values)
+        return build_dashboard(PressureSeries.from_labels(labels, values), danger, risk)
 
-    i_now = _find_now_index(labels)
+    return _cached(dashboard_cache, lat, lon, build)
 
-    current_hpa = values[i_now]
-    current_time = labels[i_now]
+
+def build_dashboard(series, danger, risk, now=None):
+    """
+    1地点分のダッシュボード文書（/api/pressure の中身）
+    series は PressureSeries（1地点）。danger / risk は risk.danger_window などで求めたもの
+    系列は start + step + values の詰めた形（欠けている時刻は None）
+    """
+    start, values = series.compact(SERIES_STEP)
+    now = pressure_store.now_epoch() if now is None else now
+    i_now = int(series.epochs[series.index_at(now)] - start) // SERIES_STEP
 
     delta_3h = None
-    if i_now >= 3:
+    if i_now >= 3 and values[i_now] is not None and values[i_now - 3] is not None:
         delta_3h = round(values[i_now] - values[i_now - 3], 1)
 
-    danger = None
-    if len(values) >= 4:
-        best_i = 0
-        best_drop = 0
-        for i in range(len(values) - 3):
-            drop = values[i + 3] - values[i]
-            if drop < best_drop:
-                best_drop = drop
-                best_i = i
-        danger = {
-            "start": labels[best_i],
-            "end": labels[best_i + 3],
-            "delta_hpa": round(best_drop, 1)
-        }
-
-    risk = "安定"
-    if danger:
-        drop3 = abs(danger["delta_hpa"])
-        if drop3 >= 8:
-            risk = "警戒"
-        elif drop3 >= 4:
-            risk = "注意"
-
-    return jsonify({
-        "labels": labels,
+    return {
+        "start": start,
+        "step": SERIES_STEP,
         "values": values,
-        "current_hpa": current_hpa,
-        "current_time": current_time,
+        "current_hpa": values[i_now],
+        "current_time": pressure_store.to_labels([start + i_now * SERIES_STEP])[0],
         "delta_3h": delta_3h,
         "danger_window": danger,
         "risk": risk
-    })
\ No newline at end of file
+    }
+
+
+def load_dashboards(conn, location_ids, start, end):
+    """
+    取り込み済みの毎時データ（pressure_blocks）の [start, end) から地点ごとの文書を作る
+    全地点の危険区間とリスクは risk.score で一度に判定する
+    戻り値: {location_id: 文書}（データの無い地点は入らない）
+    """
+    series = PressureSeries.read(conn, location_ids, start, end)
+    scored = score(series.values)
+    labels = series.labels
+    counts = series.count()
+
+    docs = {}
+    for n, location_id in enumerate(location_ids):
+        if not counts[n]:
+            continue
+        danger = None
+        if scored["start"][n] >= 0:
+            danger = {
+                "start": labels[scored["start"][n]],
+                "end": labels[scored["end"][n]],
+                "delta_hpa": round(float(scored["delta"][n]), 1),
+            }
+        level = RISK_LEVELS[int(scored["level"][n])]
+        # 先頭・末尾の欠測は落とす（値のある最初の時刻から）
+        docs[location_id] = build_dashboard(series.row(n).trim(), danger, level)
+    return docs
+
+
+# ----------------------------
+# API
+# ----------------------------
+def _series_patch(old, doc):
+    """
+    前の版 old=(start, values) から今の版 doc への差分
+    戻り値: [[今の版での位置, 値], ...]（新しい点・変わった点だけ）
+    """
+    old_start, old_values = old
+    shift = (doc["start"] - old_start) // doc["step"]
+    patch = []
+    for i, v in enumerate(doc["values"]):
+        j = i + shift
+        if j < 0 or j >= len(old_values) or old_values[j] != v:
+            patch.append([i, v])
+    return patch
+
+
+def _finish(resp, etag):
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = API_CACHE_CONTROL
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _refresh_lock(location_id):
+    with _refresh_locks_guard:
+        return _refresh_locks.setdefault(location_id, threading.Lock())
+
+
+def _user_payload(conn, user_id):
+    """
+    ユーザーの地点のダッシュボード文書（JSON文字列）。作れなければ None
+    - 新しいスナップショット（INGEST_MAX_AGE 秒以内）があれば、それを1行読むだけ
+    - 無い・古い地点は、その地点だけ取り込み直してから読む（同じ地点の同時リクエストは1回にまとめる）
+      取り込みに失敗したら、古いスナップショットでも返す
+    - 地点が未割り当てのユーザーは、自分の座標（無ければ既定の座標）でその場で作る
+    """
+    import ingest   # ingest は load_dashboards のためにこのモジュールを読むので、ここで読む
+
+    sql = """
+        SELECT u.location_id, u.lat, u.lon, l.lat AS loc_lat, l.lon AS loc_lon, s.payload,
+               s.updated_at >= datetime('now', ?) AS fresh
+        FROM users u
+        LEFT JOIN locations l ON l.id = u.location_id
+        LEFT JOIN dashboard_snapshots s ON s.location_id = u.location_id
+        WHERE u.id = ?
+    """
+    params = (f"-{int(ingest.INGEST_MAX_AGE)} seconds", user_id)
+    row = conn.execute(sql, params).fetchone()
+    if row is None:
+        return None
+    if row["payload"] is not None and row["fresh"]:
+        return row["payload"]
+
+    if row["location_id"] is None or row["loc_lat"] is None:
+        lat = row["lat"] if row["lat"] is not None else DEFAULT_LAT
+        lon = row["lon"] if row["lon"] is not None else DEFAULT_LON
+        try:
+            return json.dumps(get_dashboard(lat, lon), ensure_ascii=False)
+        except (ValueError, ForecastError) as e:
+            print(f"[WARN] dashboard user={user_id}: {e}")
+            return None
+
+    location = {"id": row["location_id"], "lat": row["loc_lat"], "lon": row["loc_lon"]}
+    with _refresh_lock(row["location_id"]):
+        try:
+            # 待っている間に他のリクエストが取り込んでいれば、ingest_stale は何もしない
+            ingest.ingest_stale(conn, [location])
+        except ForecastError as e:
+            print(f"[WARN] ingest location={row['location_id']}: {e}")
+    row = conn.execute(sql, params).fetchone()
+    return row["payload"]
+
+
+@pressure_bp.route("/api/pressure")
+@login_required
+def api_pressure():
+    """
+    ?since=<版> を付けると、その版からの差分（patch）だけ返す
+    If-None-Match / since が今の版と同じなら 304
+    """
+
+    payload = _user_payload(get_conn(), current_user.id)
+    if payload is None:
+        return jsonify({"error": "no data"}), 503
+
+    etag = snapshot_version(payload)
+    since = request.args.get("since")
+
+    if since == etag or request.if_none_match.contains(etag):
+        return _finish(make_response("", 304), etag)
+
+    doc = json.loads(payload)
+    doc["v"] = etag
+    served_versions.set(etag, (doc["start"], doc["values"]))
+
+    old = served_versions.get(since) if since else None
+    if old is not None:
+        doc["base"] = since
+        doc["len"] = len(doc["values"])
+        doc["patch"] = _series_patch(old, doc)
+        del doc["values"]
+
+    body = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode()
+    resp = current_app.response_class(body, mimetype="application/json")
+
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        resp.set_data(gzip.compress(body, compresslevel=6))
+        resp.headers["Content-Encoding"] = "gzip"
+
+    return _finish(resp, etag)
+
+
+@pressure_bp.route("/api/pressure/stream")
+@login_required
+def api_pressure_stream():
+    """
+    Server-Sent Events：自分の地点のスナップショットが変わるたびに届く
+    接続直後に今の版を1回送る
+    1接続がスレッドを1本持ち続けるので、このプロセスでは SSE_MAX_STREAMS 本まで（超えたら 503）
+    本番はリバースプロキシでこのパスを sse_server.py（asyncio）へ回す
+    """
+    if hub.stats()["subscribers"] >= SSE_MAX_STREAMS:
+        resp = jsonify({"error": "stream busy"})
+        resp.headers["Retry-After"] = "60"
+        return resp, 503
+
+    row = get_conn().execute("""
+        SELECT u.location_id, s.payload
+        FROM users u
+        LEFT JOIN dashboard_snapshots s ON s.location_id = u.location_id
+        WHERE u.id = ?
+    """, (current_user.id,)).fetchone()
+
+    if row is None or row["location_id"] is None:
+        return jsonify({"error": "no location"}), 404
+
+    initial = version = None
+    if row["payload"] is not None:
+        version = snapshot_version(row["payload"])
+        initial = format_event(version, row["payload"])
+
+    sub = hub.subscribe(row["location_id"], version)
+    return current_app.response_class(
+        hub.stream(sub, initial),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@pressure_bp.route("/api/pressure/cache")
+@login_required
+def api_pressure_cache():
+    return jsonify(forecast_cache.stats())
@@ -0,0 +1,198 @@
+import numpy as np
+
+import pressure_store
+
+# =========================
+# 気圧の時系列（時刻の int64 配列 + 値の float64 配列）
+# =========================
+# ダッシュボード・アラートジョブ・設定画面で共通に使う
+# 時刻は UNIX 秒（昇順）、値は hPa（欠測は NaN）。値は1地点なら (時刻,)、複数地点なら (地点 × 時刻)
+# ラベル文字列のパースや Pa / hPa の判定は作る時に1回だけ。時刻で引く時は二分探索
+
+# これより大きい値は Pa とみなす（上流が Pa で返してきた時の保険）
+PA_THRESHOLD = 2000
+
+
+def normalize_hpa(values, unit=None):
+    """
+    値を hPa にそろえる
+    unit="Pa" / "hPa" で指定、None なら値ごとに PA_THRESHOLD 超を Pa とみなす
+    """
+    values = np.asarray(values, dtype=np.float64)   # None -> NaN
+    if unit == "Pa":
+        return values / 100.0
+    if unit == "hPa":
+        return values
+    if unit is not None:
+        raise ValueError(f"unit must be 'Pa', 'hPa' or None: {unit}")
+    return np.where(values > PA_THRESHOLD, values / 100.0, values)
+
+
+def _nearest_index(epochs, t):
+    # 昇順の epochs を二分探索して t に最も近い位置（同じ距離なら早い方、空なら -1）
+    n = len(epochs)
+    if not n:
+        return -1
+    i = int(np.searchsorted(epochs, t))
+    if i == 0:
+        return 0
+    if i == n:
+        return n - 1
+    return i - 1 if t - epochs[i - 1] <= epochs[i] - t else i
+
+
+class PressureSeries:
+    """
+    気圧の時系列
+    切り出し（between / day / row / trim）は元の配列のビューで、コピーも単位の判定もしない
+    """
+
+    __slots__ = ("epochs", "values")
+
+    def __init__(self, epochs, values, unit=None):
+        self.epochs = np.asarray(epochs, dtype=np.int64)
+        self.values = normalize_hpa(values, unit)
+        if self.values.shape[-1:] != self.epochs.shape:
+            raise ValueError(f"values {self.values.shape} do not match epochs {self.epochs.shape}")
+
+    @classmethod
+    def _view(cls, epochs, values):
+        s = cls.__new__(cls)
+        s.epochs = epochs
+        s.values = values
+        return s
+
+    # ----------------------------
+    # 作る
+    # ----------------------------
+    @classmethod
+    def from_labels(cls, labels, values, unit=None):
+        # "YYYY-MM-DD HH:MM" / "YYYY-MM-DDTHH:MM"（日本時間, 昇順）のラベルから
+        return cls(pressure_store.to_epochs(list(labels)), values, unit)
+
+    @classmethod
+    def read(cls, conn, location_ids, start, end):
+        """
+        pressure_blocks の [start, end)（UNIX 秒）を毎時で読む
+        location_ids が1つの ID なら1地点、並びなら (地点 × 時刻)（行は location_ids の順）
+        """
+        if np.ndim(location_ids) == 0:
+            epochs, matrix = pressure_store.read_matrix(conn, [location_ids], start, end)
+            return cls(epochs, matrix[0])
+        return cls(*pressure_store.read_matrix(conn, location_ids, start, end))
+
+    # ----------------------------
+    # 形
+    # ----------------------------
+    def __len__(self):
+        return len(self.epochs)
+
+    def __repr__(self):
+        span = f"{self.labels[0]} .. {self.labels[-1]}" if len(self) else "empty"
+        return f"PressureSeries(shape={self.values.shape}, {span})"
+
+    @property
+    def labels(self):
+        # "YYYY-MM-DD HH:MM"（日本時間）
+        return pressure_store.to_labels(self.epochs)
+
+    def row(self, n):
+        # 複数地点のうち n 行目の1地点分
+        return self._view(self.epochs, self.values[n])
+
+    def rows(self, selector):
+        # 複数地点のうち selector（真偽の配列・位置の並び）で選んだ地点
+        return self._view(self.epochs, self.values[selector])
+
+    def count(self):
+        # 値のある時刻の数（地点ごと）
+        return (~np.isnan(self.values)).sum(axis=-1)
+
+    # ----------------------------
+    # 時刻で引く
+    # ----------------------------
+    def index_at(self, t):
+        # t（UNIX 秒）に最も近い時刻の位置。同じ距離なら早い方。空なら -1
+        return _nearest_index(self.epochs, t)
+
+    def nearest(self, t):
+        """
+        t に最も近い「値のある」時刻の (位置, 値)
+        1地点ならスカラー（値が1つも無ければ (-1, NaN)）、複数地点なら地点ごとの配列
+        """
+        if self.values.ndim == 1:
+            valid = np.flatnonzero(~np.isnan(self.values))
+            if not len(valid):
+                return -1, np.nan
+            i = valid[_nearest_index(self.epochs[valid], t)]
+            return int(i), float(self.values[i])
+
+        rows = np.arange(len(self.values))
+        idx = np.full(len(rows), self.index_at(t), dtype=np.int64)
+        if not len(self.epochs):
+            return idx, np.full(len(rows), np.nan)
+        # 一番近い時刻が欠測の地点だけ、値のある時刻の中から探し直す
+        missing = np.isnan(self.values[rows, idx])
+        if missing.any():
+            sub = self.values[missing]
+            dist = np.where(np.isnan(sub), np.iinfo(np.int64).max, np.abs(self.epochs - t))
+            idx[missing] = np.where(np.isnan(sub).all(axis=1), -1, dist.argmin(axis=1))
+        return idx, np.where(idx >= 0, self.values[rows, idx], np.nan)
+
+    def between(self, start, end):
+        # [start, end) の部分
+        a, b = np.searchsorted(self.epochs, [start, end])
+        return self._view(self.epochs[a:b], self.values[..., a:b])
+
+    def day(self, yyyy_mm_dd):
+        # その日（日本時間 0時〜24時）の部分
+        start = pressure_store.day_epoch(yyyy_mm_dd)
+        return self.between(start, start + pressure_store.DAY)
+
+    def trim(self):
+        # 先頭・末尾の、どの地点も欠測の時刻を落とす
+        has = ~np.isnan(self.values)
+        if has.ndim > 1:
+            has = has.any(axis=0)
+        idx = np.flatnonzero(has)
+        if not len(idx):
+            return self._view(self.epochs[:0], self.values[..., :0])
+        return self._view(self.epochs[idx[0]:idx[-1] + 1], self.values[..., idx[0]:idx[-1] + 1])
+
+    # ----------------------------
+    # 変換
+    # ----------------------------
+    def resample(self, step, how="mean"):
+        """
+        step 秒ごと（日本時間の区切り）にまとめる。欠測は無視、全部欠測の区間は NaN
+        how: "mean" / "min" / "max"
+        """
+        if how not in ("mean", "min", "max"):
+            raise ValueError(f"how must be 'mean', 'min' or 'max': {how}")
+        if not len(self.epochs):
+            return self
+        keys = (self.epochs + pressure_store.JST_OFFSET) // step * step - pressure_store.JST_OFFSET
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+        v = self.values
+        if how == "min":
+            out = np.fmin.reduceat(v, starts, axis=-1)
+        elif how == "max":
+            out = np.fmax.reduceat(v, starts, axis=-1)
+        else:
+            valid = ~np.isnan(v)
+            total = np.add.reduceat(np.where(valid, v, 0.0), starts, axis=-1)
+            n = np.add.reduceat(valid.astype(np.int64), starts, axis=-1)
+            out = np.where(n > 0, total / np.maximum(n, 1), np.nan)
+        return self._view(keys[starts], out)
+
+    def compact(self, step=pressure_store.STEP):
+        """
+        1地点分を等間隔の (開始エポック秒, 値のリスト) にする（/api/pressure の形）
+        欠けている時刻・欠測は None
+        """
+        if not len(self.epochs):
+            return None, []
+        out = np.full((self.epochs[-1] - self.epochs[0]) // step + 1, np.nan)
+        out[(self.epochs - self.epochs[0]) // step] = self.values
+        return int(self.epochs[0]), [None if v != v else v for v in out.tolist()]
@@ -0,0 +1,194 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+# =========================
+# 毎時気圧の保存形式（地点 × 日のブロック）
+# =========================
+# pressure_blocks の1行 = 1地点の1日（日本時間 0時〜23時）
+#   base_epoch: その日の 0時（JST）の UNIX 秒
+#   data:       24時間分の float32（リトルエンディアン）を詰めた BLOB。欠測は NaN
+# 1行 1値（pressure_hourly）より10倍近く小さく、期間の読み出しはブロック単位の主キー範囲スキャン
+# 読むときは BLOB のバイト列を、結果の配列の該当する枠へそのまま1回コピーする（値ごとの Python オブジェクトを作らない）
+
+JST_OFFSET = 9 * 3600   # Asia/Tokyo（夏時間なし）
+STEP = 3600
+SLOTS = 24
+DAY = STEP * SLOTS
+DTYPE = np.dtype("<f4")
+BLOCK_BYTES = SLOTS * DTYPE.itemsize
+# 読み出した値はこの桁で丸める（float32 の端数を API・メールに出さない）
+VALUE_DECIMALS = 1
+# 一時テーブルに流す地点数がこれ以下なら IN (...) で済ませる
+INLINE_IDS = int(os.getenv("PRESSURE_STORE_INLINE_IDS", "500"))
+
+
+# ----------------------------
+# 時刻
+# ----------------------------
+def day_base(epochs):
+    # その時刻を含む日（JST）の 0時の UNIX 秒
+    return (np.asarray(epochs, dtype=np.int64) + JST_OFFSET) // DAY * DAY - JST_OFFSET
+
+
+def to_epochs(labels):
+    """
+    "YYYY-MM-DD HH:MM" / "YYYY-MM-DDTHH:MM[:SS]"（日本時間）→ UNIX 秒の int64 配列
+    """
+    local = np.array(labels, dtype="datetime64[s]").astype(np.int64)
+    return local - JST_OFFSET
+
+
+def to_labels(epochs):
+    # UNIX 秒 → "YYYY-MM-DD HH:MM"（日本時間）
+    local = (np.asarray(epochs, dtype=np.int64) + JST_OFFSET).astype("datetime64[s]").astype("datetime64[m]")
+    return [s.replace("T", " ") for s in np.datetime_as_string(local)]
+
+
+def day_epoch(yyyy_mm_dd):
+    # "YYYY-MM-DD" の 0時（JST）
+    return int(to_epochs([yyyy_mm_dd])[0])
+
+
+def now_epoch():
+    return int(datetime.now().timestamp())
+
+
+# ----------------------------
+# 書き込み
+# ----------------------------
+def write(conn, location_id, epochs, values):
+    """
+    1地点の毎時値をブロックに詰めて書く（コミットは呼び出し側）
+    既存のブロックとは時刻ごとにマージし、新しい側が NaN / None の時刻は元の値を残す
+    戻り値: 書いた値の数
+    """
+    values = np.asarray(values, dtype=np.float64)   # None -> NaN
+    keep = ~np.isnan(values)
+    if not keep.any():
+        return 0
+    epochs = np.asarray(epochs, dtype=np.int64)[keep]
+    values = values[keep]
+
+    bases = day_base(epochs)
+    days, inv = np.unique(bases, return_inverse=True)
+    blocks = np.full((len(days), SLOTS), np.nan, dtype=DTYPE)
+    blocks[inv, (epochs - bases) // STEP] = values
+
+    existing = conn.execute("""
+        SELECT base_epoch, data FROM pressure_blocks
+        WHERE location_id = ? AND base_epoch BETWEEN ? AND ?
+    """, (location_id, int(days[0]), int(days[-1]))).fetchall()
+    for base, blob in existing:
+        i = np.searchsorted(days, base)
+        if i < len(days) and days[i] == base:
+            old = np.frombuffer(blob, dtype=DTYPE)
+            empty = np.isnan(blocks[i])
+            blocks[i, empty] = old[empty]
+
+    conn.executemany("""
+        INSERT INTO pressure_blocks (location_id, base_epoch, data) VALUES (?, ?, ?)
+        ON CONFLICT(location_id, base_epoch) DO UPDATE SET data = excluded.data
+    """, ((location_id, int(base), block.tobytes()) for base, block in zip(days, blocks)))
+    return int(keep.sum())
+
+
+# ----------------------------
+# 読み出し
+# ----------------------------
+def _fill(blocks, placed):
+    """
+    placed: (ブロック番号, BLOB) の並び。blocks（C 連続・ブロックを SLOTS 個ずつ並べた DTYPE 配列）の
+    その番号の枠へ BLOB を直接コピーする（全 BLOB をつないだ一時バッファを作らない）
+    """
+    out = memoryview(blocks.reshape(-1)).cast("B")
+    for n, blob in placed:
+        at = n * BLOCK_BYTES
+        out[at:at + BLOCK_BYTES] = blob
+
+
+def _select_blocks(conn, location_ids, first_day, last_day):
+    # 指定地点の [first_day, last_day] のブロック（地点ごとの主キー範囲）
+    if len(location_ids) <= INLINE_IDS:
+        marks = ",".join("?" * len(location_ids))
+        return conn.execute(f"""
+            SELECT location_id, base_epoch, data FROM pressure_blocks
+            WHERE location_id IN ({marks}) AND base_epoch BETWEEN ? AND ?
+        """, (*location_ids, first_day, last_day))
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS store_locations (location_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM store_locations")
+    conn.executemany("INSERT OR IGNORE INTO store_locations (location_id) VALUES (?)", ((i,) for i in location_ids))
+    return conn.execute("""
+        SELECT b.location_id, b.base_epoch, b.data
+        FROM store_locations t
+        JOIN pressure_blocks b ON b.location_id = t.location_id
+        WHERE b.base_epoch BETWEEN ? AND ?
+    """, (first_day, last_day))
+
+
+def read_matrix(conn, location_ids, start, end):
+    """
+    [start, end)（UNIX 秒）の毎時値を (地点 × 時刻) の float64 配列で読む
+    location_ids と同じ順の行、値の無い時刻は NaN（0.1hPa 単位に丸めた値）
+    戻り値: (epochs, matrix)
+    """
+    location_ids = [int(i) for i in location_ids]
+    start = int(start) // STEP * STEP
+    end = max(-(-int(end) // STEP) * STEP, start)
+    epochs = np.arange(start, end, STEP, dtype=np.int64)
+    if not location_ids or not len(epochs):
+        return epochs, np.full((len(location_ids), len(epochs)), np.nan)
+
+    first_day = int(day_base(start))
+    n_days = int(day_base(end - 1) - first_day) // DAY + 1
+    index = {location_id: n for n, location_id in enumerate(location_ids)}
+
+    cube = np.full((len(location_ids), n_days, SLOTS), np.nan, dtype=DTYPE)
+    _fill(cube, (
+        (index[location_id] * n_days + (base - first_day) // DAY, blob)
+        for location_id, base, blob in _select_blocks(conn, location_ids, first_day, first_day + (n_days - 1) * DAY)
+    ))
+
+    offset = (start - first_day) // STEP
+    matrix = cube.reshape(len(location_ids), -1)[:, offset:offset + len(epochs)]
+    return epochs, np.round(matrix.astype(np.float64), VALUE_DECIMALS)
+
+
+def read_series(conn, location_id, start, end):
+    # 1地点分: (epochs, values)
+    epochs, matrix = read_matrix(conn, [location_id], start, end)
+    return epochs, matrix[0]
+
+
+def values_at(conn, location_ids, epochs):
+    """
+    (地点, 時刻) の組ごとの値（地点と時刻は同じ長さの配列、時刻は正時に切り捨て）
+    必要なブロックだけを読む。無い値は NaN
+    """
+    location_ids = np.asarray(location_ids, dtype=np.int64)
+    epochs = np.asarray(epochs, dtype=np.int64) // STEP * STEP
+    out = np.full(len(epochs), np.nan)
+    if not len(epochs):
+        return out
+
+    bases = day_base(epochs)
+    keys, inv = np.unique(np.stack([location_ids, bases], axis=1), axis=0, return_inverse=True)
+    inv = inv.reshape(-1)
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS store_keys (
+            location_id INTEGER, base_epoch INTEGER, PRIMARY KEY(location_id, base_epoch)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM store_keys")
+    conn.executemany("INSERT INTO store_keys VALUES (?, ?)", keys.tolist())
+    position = {(int(a), int(b)): n for n, (a, b) in enumerate(keys)}
+    blocks = np.full((len(keys), SLOTS), np.nan, dtype=DTYPE)
+    _fill(blocks, ((position[(location_id, base)], blob) for location_id, base, blob in conn.execute("""
+        SELECT b.location_id, b.base_epoch, b.data
+        FROM store_keys k
+        JOIN pressure_blocks b ON b.location_id = k.location_id AND b.base_epoch = k.base_epoch
+    """)))
+    out[:] = blocks[inv, (epochs - bases) // STEP]
+    return np.round(out, VALUE_DECIMALS)
@@ -0,0 +1,156 @@
+import numpy as np
+
+# リスク判定（3時間変化量ベース）: 注意=4hPa以上 / 警戒=8hPa以上
+RISK_LEVELS = ("安定", "注意", "警戒")
+CAUTION_HPA = 4.0
+WARNING_HPA = 8.0
+DEFAULT_WIDTH_HOURS = 3
+WINDOW_HOURS = (1, 3, 6, 24)
+# 個人しきい値の下限（補正を重ねても暴発しないように）
+MIN_THRESHOLD_HPA = 0.5
+
+
+# ----------------------------
+# 配列化
+# ----------------------------
+def to_matrix(series_list, length=None):
+    """
+    地点ごとの値リストを (地点 × 時刻) の float 配列にする
+    長さが足りない地点や None は NaN で埋める
+    """
+    if length is None:
+        length = max((len(v) for v in series_list), default=0)
+    m = np.full((len(series_list), length), np.nan, dtype=np.float64)
+    for i, vals in enumerate(series_list):
+        row = np.asarray(vals[:length], dtype=np.float64)  # None -> nan
+        m[i, :len(row)] = row
+    return m
+
+
+# ----------------------------
+# 窓ごとの変化量
+# ----------------------------
+def window_deltas(values, width=DEFAULT_WIDTH_HOURS, step_minutes=60):
+    """
+    values: (地点 × 時刻) 配列
+    戻り値: (地点 × 窓) 配列。deltas[c, i] = values[c, i+w] - values[c, i]
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    w = int(round(width * 60 / step_minutes))
+    if w < 1 or values.shape[1] <= w:
+        return np.empty((values.shape[0], 0), dtype=np.float64)
+    return values[:, w:] - values[:, :-w]
+
+
+def worst_windows(values, width=DEFAULT_WIDTH_HOURS, direction="drop", step_minutes=60):
+    """
+    地点ごとに最も大きく下がる（direction="rise" なら上がる）窓を探す
+    同じ値なら早い方を採用する
+    戻り値: (start_idx, end_idx, delta)
+      start_idx / end_idx は int 配列（有効な窓が無い地点は -1）
+      delta は変化量（マイナスが低下）、無い地点は NaN
+    """
+    if direction not in ("drop", "rise"):
+        raise ValueError(f"direction must be 'drop' or 'rise': {direction}")
+
+    deltas = window_deltas(values, width, step_minutes)
+    n = deltas.shape[0]
+    w = int(round(width * 60 / step_minutes))
+    if deltas.shape[1] == 0:
+        return np.full(n, -1), np.full(n, -1), np.full(n, np.nan)
+
+    if direction == "drop":
+        filled = np.where(np.isnan(deltas), np.inf, deltas)
+        idx = np.argmin(filled, axis=1)
+    else:
+        filled = np.where(np.isnan(deltas), -np.inf, deltas)
+        idx = np.argmax(filled, axis=1)
+
+    rows = np.arange(n)
+    best = deltas[rows, idx]
+    valid = ~np.isnan(best)
+    start = np.where(valid, idx, -1)
+    end = np.where(valid, idx + w, -1)
+    return start, end, best
+
+
+def classify(delta, direction="drop", caution=CAUTION_HPA, warning=WARNING_HPA):
+    """
+    変化量 → リスクレベル（0=安定, 1=注意, 2=警戒）
+    drop は低下量、rise は上昇量だけを見る
+    """
+    delta = np.asarray(delta, dtype=np.float64)
+    mag = -delta if direction == "drop" else delta
+    mag = np.where(np.isnan(mag), 0.0, np.maximum(mag, 0.0))
+    mag = np.round(mag, 1)  # 表示値（小数1桁）と判定を揃える
+    return (mag >= caution).astype(np.int8) + (mag >= warning).astype(np.int8)
+
+
+def score(values, width=DEFAULT_WIDTH_HOURS, direction="drop", step_minutes=60,
+          caution=CAUTION_HPA, warning=WARNING_HPA):
+    # 全地点の最悪窓とリスクレベルを一度に求める
+    start, end, delta = worst_windows(values, width, direction, step_minutes)
+    level = classify(delta, direction, caution, warning)
+    return {"start": start, "end": end, "delta": delta, "level": level}
+
+
+def scan(values, widths=WINDOW_HOURS, direction="drop", step_minutes=60):
+    # 複数の窓幅をまとめて評価する {width: score(...)}
+    return {w: score(values, w, direction, step_minutes) for w in widths}
+
+
+# ----------------------------
+# ユーザーごとのしきい値
+# ----------------------------
+def effective_thresholds(base, drink, pollen_offset, pollen_enabled):
+    """
+    実効しきい値 = 基本 - 飲酒 - 花粉(オン時)、下限 MIN_THRESHOLD_HPA
+    引数はスカラーでもユーザーごとの配列でもよい
+    """
+    pollen = np.where(np.asarray(pollen_enabled) == 1, pollen_offset, 0.0)
+    effective = np.asarray(base, dtype=np.float64) - drink - pollen
+    return np.maximum(effective, MIN_THRESHOLD_HPA)
+
+
+def personal_levels(user_locations, thresholds, location_ids, deltas, direction="drop"):
+    """
+    地点ごとの変化量を各ユーザーに配り、その人のしきい値でレベルを決める（ループなし）
+    user_locations / thresholds: ユーザーごとの配列
+    location_ids / deltas: 判定できた地点ごとの配列
+    注意 = しきい値以上、警戒 = しきい値 × (WARNING_HPA / CAUTION_HPA) 以上
+    戻り値: (ユーザーごとの変化量（地点のデータが無ければ NaN）, レベル)
+    """
+    user_locations = np.asarray(user_locations, dtype=np.int64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    location_ids = np.asarray(location_ids, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=np.float64)
+
+    user_delta = np.full(user_locations.shape, np.nan)
+    if location_ids.size:
+        order = np.argsort(location_ids)
+        keys = location_ids[order]
+        pos = np.minimum(np.searchsorted(keys, user_locations), keys.size - 1)
+        found = keys[pos] == user_locations
+        user_delta[found] = deltas[order][pos[found]]
+
+    level = classify(user_delta, direction, thresholds, thresholds * (WARNING_HPA / CAUTION_HPA))
+    return user_delta, level
+
+
+# ----------------------------
+# 1地点用（画面・メール本文向け）
+# ----------------------------
+def danger_window(labels, values, width=DEFAULT_WIDTH_HOURS, direction="drop"):
+    """
+    1地点の最悪窓を {"start", "end", "delta_hpa"} とリスク名で返す
+    有効な窓が無ければ (None, "安定")
+    """
+    r = score(to_matrix([values]), width, direction)
+    if r["start"][0] < 0:
+        return None, RISK_LEVELS[0]
+    danger = {
+        "start": labels[r["start"][0]],
+        "end": labels[r["end"][0]],
+        "delta_hpa": round(float(r["delta"][0]), 1),
+    }
+    return danger, RISK_LEVELS[int(r["level"][0])]
@@ -0,0 +1,366 @@
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+
+import db
+import metrics
+
+# =========================
+# 常駐スケジューラー
+# =========================
+# python -m scheduler で起動し、ジョブを同じプロセスの中で時刻どおりに回す
+# 起動は1回だけなので、Flask・接続プール・予報クライアント・キャッシュは温まったまま使い回す
+# - トリガーは cron 形式（分 時 日 月 曜日、ローカル時刻）
+# - ジョブごとのロック（プロセス内 + job_locks テーブルで別プロセスとも排他）
+# - 開始時刻のジッター、取りこぼし（misfire）の扱い、実行履歴（job_runs）
+
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "30"))
+# 予定時刻からこれ以上遅れたら実行せず missed として記録する（秒）
+SCHEDULER_MISFIRE_GRACE = float(os.getenv("SCHEDULER_MISFIRE_GRACE", "600"))
+SCHEDULER_LOCK_TTL = int(os.getenv("SCHEDULER_LOCK_TTL", "3600"))
+# 実行中はこの間隔でロックの期限を延ばす（秒。TTL より長いジョブでも別プロセスに取られない）
+SCHEDULER_LOCK_RENEW = float(os.getenv("SCHEDULER_LOCK_RENEW", str(SCHEDULER_LOCK_TTL / 3)))
+# 設定すると、このポートで /metrics を返す（0 なら出さない）
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6),  # 0 = 日曜（cron と同じ。7 も日曜として受け付ける）
+)
+
+
+# ----------------------------
+# cron トリガー
+# ----------------------------
+class CronTrigger:
+    """
+    "*/30 * * * *" のような5項目の cron 式
+    各項目は * / 数値 / a-b / */n / a-b/n / カンマ区切り
+    """
+    __slots__ = ("expr", "minute", "hour", "day", "month", "weekday", "_any_day", "_any_weekday")
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron 式は5項目です: {expr!r}")
+        self.expr = expr
+        for (name, lo, hi), part in zip(_FIELDS, parts):
+            setattr(self, name, self._parse(part, lo, hi if name != "weekday" else 7))
+        self.weekday = frozenset(d % 7 for d in self.weekday)
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for item in field.split(","):
+            rng, _, step = item.partition("/")
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                start, end = (int(x) for x in rng.split("-"))
+            else:
+                start = int(rng)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError(f"cron の値が範囲外です: {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, dt):
+        # cron と同じく、日と曜日の両方が指定されていればどちらか一致で可
+        dom = dt.day in self.day
+        dow = (dt.weekday() + 1) % 7 in self.weekday
+        if self._any_day:
+            return dow
+        if self._any_weekday:
+            return dom
+        return dom or dow
+
+    def next_after(self, dt):
+        # dt より後で最初に一致する時刻（分単位）
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.month:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if dt.hour not in self.hour:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+            if dt.minute not in self.minute:
+                dt += timedelta(minutes=1)
+                continue
+            return dt
+        raise ValueError(f"一致する時刻がありません: {self.expr!r}")
+
+
+# ----------------------------
+# ロックと履歴
+# ----------------------------
+def acquire_lock(conn, job, owner, ttl=SCHEDULER_LOCK_TTL):
+    # 期限切れか自分のロックなら取れる。取れたら True
+    cur = conn.execute("""
+        INSERT INTO job_locks (job, owner, expires_at) VALUES (?, ?, datetime('now', ?))
+        ON CONFLICT(job) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE job_locks.expires_at < datetime('now') OR job_locks.owner = excluded.owner
+    """, (job, owner, f"+{int(ttl)} seconds"))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def renew_lock(conn, job, owner, ttl=SCHEDULER_LOCK_TTL):
+    # 自分のロックの期限を延ばす。もう自分のものでなければ False
+    cur = conn.execute(
+        "UPDATE job_locks SET expires_at = datetime('now', ?) WHERE job = ? AND owner = ?",
+        (f"+{int(ttl)} seconds", job, owner),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def release_lock(conn, job, owner):
+    conn.execute("DELETE FROM job_locks WHERE job = ? AND owner = ?", (job, owner))
+    conn.commit()
+
+
+def record_run(conn, job, scheduled_at, status, owner, started_at=None, finished_at=None,
+               duration_ms=None, error=None):
+    conn.execute("""
+        INSERT INTO job_runs (job, scheduled_at, started_at, finished_at, status, duration_ms, error, owner)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (job, _fmt(scheduled_at), _fmt(started_at), _fmt(finished_at), status, duration_ms, error, owner))
+    conn.commit()
+
+
+def last_scheduled(conn, job):
+    row = conn.execute(
+        "SELECT MAX(scheduled_at) FROM job_runs WHERE job = ?", (job,)
+    ).fetchone()
+    return datetime.fromisoformat(row[0]) if row[0] else None
+
+
+def _fmt(dt):
+    return dt.isoformat(sep=" ", timespec="seconds") if dt else None
+
+
+# ----------------------------
+# ジョブ
+# ----------------------------
+class Job:
+    """
+    name: 履歴・ロックの名前 / fn: 引数なしの関数
+    jitter: 予定時刻に足す 0〜jitter 秒の乱数（同時刻に集中させない）
+    """
+    __slots__ = ("name", "trigger", "fn", "jitter", "misfire_grace", "next_run", "fire_at", "_lock")
+
+    def __init__(self, name, cron, fn, jitter=0, misfire_grace=SCHEDULER_MISFIRE_GRACE):
+        self.name = name
+        self.trigger = CronTrigger(os.getenv(f"SCHEDULE_{name.upper().replace('-', '_')}", cron))
+        self.fn = fn
+        self.jitter = jitter
+        self.misfire_grace = misfire_grace
+        self.next_run = None   # 予定時刻（履歴に残す）
+        self.fire_at = None    # ジッター込みの実際の開始時刻
+        self._lock = threading.Lock()
+
+    def schedule(self, after):
+        self.next_run = self.trigger.next_after(after)
+        self.fire_at = self.next_run + timedelta(seconds=random.uniform(0, self.jitter))
+
+
+class Scheduler:
+    def __init__(self, jobs, tick=SCHEDULER_TICK):
+        self.jobs = {j.name: j for j in jobs}
+        self.tick = tick
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop_event = threading.Event()
+
+    # ----------------------------
+    # 1回の実行
+    # ----------------------------
+    def run_job(self, job, scheduled_at):
+        """
+        ロックを取って job を実行し、結果を job_runs に記録する
+        前回の実行が終わっていない / 別プロセスが実行中なら skipped
+        """
+        if not job._lock.acquire(blocking=False):
+            with db.connection() as conn:
+                record_run(conn, job.name, scheduled_at, "skipped", self.owner, error="前回の実行中")
+            return "skipped"
+        try:
+            # 接続はロックを取る間・記録する間だけ借りる
+            # （実行中に持ち続けると、ジョブ自身が使う分（配信のワーカー等）とでプールが足りなくなる）
+            with db.connection() as conn:
+                if not acquire_lock(conn, job.name, self.owner):
+                    record_run(conn, job.name, scheduled_at, "skipped", self.owner, error="別プロセスが実行中")
+                    return "skipped"
+
+            started_at = datetime.now()
+            started = time.perf_counter()
+            status, error = "ok", None
+            done = threading.Event()
+            renewer = threading.Thread(
+                target=self._keep_lock, args=(job, done), name=f"lock-{job.name}", daemon=True
+            )
+            renewer.start()
+            try:
+                job.fn()
+            except Exception as e:
+                status, error = "failed", repr(e)[:1000]
+                print(f"[ERROR] job {job.name}: {e}")
+            finally:
+                duration_ms = (time.perf_counter() - started) * 1000
+                done.set()
+                renewer.join()
+
+            metrics.job_seconds.observe(duration_ms / 1000, job=job.name, status=status)
+            with db.connection() as conn:
+                release_lock(conn, job.name, self.owner)
+                record_run(conn, job.name, scheduled_at, status, self.owner,
+                           started_at, datetime.now(), round(duration_ms, 3), error)
+            print(f"[INFO] job {job.name}: {status} {duration_ms:.1f}ms")
+            return status
+        finally:
+            job._lock.release()
+
+    def _keep_lock(self, job, done):
+        # job の実行中、ロックの期限を延ばし続ける（done が立ったら終わる）
+        while not done.wait(SCHEDULER_LOCK_RENEW):
+            try:
+                with db.connection() as conn:
+                    if not renew_lock(conn, job.name, self.owner):
+                        print(f"[WARN] job {job.name}: ロックが他のプロセスに移っています")
+            except Exception as e:
+                print(f"[WARN] job {job.name}: ロックの延長に失敗しました: {e}")
+
+    def _start(self, job, scheduled_at):
+        threading.Thread(
+            target=self.run_job, args=(job, scheduled_at), name=f"job-{job.name}", daemon=True
+        ).start()
+
+    # ----------------------------
+    # ループ
+    # ----------------------------
+    def catch_up(self, now):
+        """
+        停止中に予定時刻を過ぎたジョブを、猶予内なら1回だけ実行する（まとめて1回）
+        猶予を過ぎていれば missed として記録して次の予定から
+        """
+        with db.connection() as conn:
+            for job in self.jobs.values():
+                last = last_scheduled(conn, job.name)
+                if last is None:
+                    continue
+                due = job.trigger.next_after(last)
+                if due > now:
+                    continue
+                if (now - due).total_seconds() <= job.misfire_grace:
+                    self._start(job, due)
+                else:
+                    record_run(conn, job.name, due, "missed", self.owner)
+
+    def run_forever(self):
+        now = datetime.now()
+        self.catch_up(now)
+        for job in self.jobs.values():
+            job.schedule(now)
+            print(f"[INFO] scheduled {job.name} ({job.trigger.expr}) next={_fmt(job.next_run)}")
+
+        while not self._stop_event.is_set():
+            now = datetime.now()
+            for job in self.jobs.values():
+                if job.fire_at > now:
+                    continue
+                late = (now - job.next_run).total_seconds() - job.jitter
+                if late > job.misfire_grace:
+                    # スリープ復帰などで大きく遅れた回は走らせない
+                    with db.connection() as conn:
+                        record_run(conn, job.name, job.next_run, "missed", self.owner)
+                else:
+                    self._start(job, job.next_run)
+                job.schedule(now)
+
+            wake = min(j.fire_at for j in self.jobs.values())
+            self._stop_event.wait(max(0.0, min(self.tick, (wake - datetime.now()).total_seconds())))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+# ----------------------------
+# 既定のジョブ
+# ----------------------------
+def default_jobs():
+    # Flask アプリはここで1回だけ読み込む（以後の実行は温まった状態から）
+    import analytics
+    import app as web
+    import ingest
+    import outbox
+    import pressure_job
+
+    def recompute_sensitivity():
+        with db.connection() as conn:
+            analytics.recompute_all(conn)
+
+    def in_app(fn):
+        def run():
+            with web.app.app_context():
+                fn()
+        return run
+
+    return [
+        Job("ingest", "*/30 * * * *", ingest.ingest_once, jitter=60),
+        Job("deliver-alerts", "*/5 * * * *", outbox.deliver, jitter=10),
+        Job("daily-pressure-check", "0 18 * * *", in_app(web.daily_pressure_check), jitter=60),
+        Job("daily-delta-check", "5 18 * * *", pressure_job.run_daily_pressure_check, jitter=60),
+        Job("night-forecast-alert", "0 21 * * *", in_app(web.night_forecast_alert), jitter=60),
+        Job("recompute-sensitivity", "30 3 * * *", recompute_sensitivity, jitter=60),
+    ]
+
+
+@click.command()
+@click.option("--run", "run_now", metavar="JOB", help="指定ジョブを今すぐ1回だけ実行して終わる")
+@click.option("--list", "list_jobs", is_flag=True, help="ジョブと次回予定を表示する")
+def main(run_now, list_jobs):
+    """
+    常駐スケジューラー（python -m scheduler）
+    予定は SCHEDULE_<JOB名> 環境変数（cron 形式）で上書きできる
+    """
+    import app as web
+    web.init_db()
+    sched = Scheduler(default_jobs())
+
+    if list_jobs:
+        now = datetime.now()
+        for job in sched.jobs.values():
+            click.echo(f"{job.name:24} {job.trigger.expr:16} next={_fmt(job.trigger.next_after(now))}")
+        return
+    if run_now:
+        if run_now not in sched.jobs:
+            raise click.BadParameter(f"ジョブがありません: {run_now}")
+        sched.run_job(sched.jobs[run_now], datetime.now().replace(second=0, microsecond=0))
+        return
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    try:
+        sched.run_forever()
+    except KeyboardInterrupt:
+        sched.stop()
+
+
+if __name__ == "__main__":
+    main()
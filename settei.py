@@ -1,51 +1,103 @@
-import sqlite3
+import math
+import os
 from flask import Blueprint, render_template, request, redirect, session, flash
 from flask_login import login_required, current_user
 
+from db import get_conn
+from cache import LRUCache
+import pressure_store
+from pressure_series import PressureSeries
+import risk
+import thresholds
+
 settei_bp = Blueprint("settei", __name__, url_prefix="/settei")
 
-DB_PATH = "mvp.db"  # あなたのDB名に合わせる
+# ユーザー設定キャッシュ（書き込み時に無効化。無効化はこのプロセスの中だけなので、
+# gunicorn のワーカーが2つ以上なら wsgi.post_fork で切る）
+settings_cache = LRUCache(
+    maxsize=int(os.getenv("SETTINGS_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SETTINGS_CACHE_TTL", "300")),
+)
+
+# 飲酒補正（フォームの選択肢 → hPa）
+DRINK_OFFSETS = {
+    "none": 0.0,
+    "shochu": 0.5,
+    "beer_whisky": 1.0,
+    "wine": 1.5,
+}
+POLLEN_OFFSET = 0.5
+# 基本アラート値（hPa）として受け付ける範囲
+BASE_THRESHOLD_MIN = risk.MIN_THRESHOLD_HPA
+BASE_THRESHOLD_MAX = 20.0
 
-def calc_effective_threshold(s):
-    base_t = float(s["base_threshold"])
-    drink = float(s["drink_offset"])
-    pollen = float(s["pollen_offset"]) if int(s["pollen_enabled"]) == 1 else 0.0
-    effective = base_t - drink - pollen
-    # 下限（暴発防止）※好みで0.0でもOK
-    return max(effective, 0.5)
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
 def calc_effective_threshold(s):
     """
     実効しきい値 = 基本 - 飲酒 - 花粉(オン時)
     s は sqlite3.Row を想定（s["base_threshold"] で取れる）
+    計算はアラートジョブと同じ risk.effective_thresholds
     """
-    base_t = float(s["base_threshold"])
-    drink = float(s["drink_offset"])
-    pollen = float(s["pollen_offset"]) if int(s["pollen_enabled"]) == 1 else 0.0
-    effective = base_t - drink - pollen
-
-    # 暴発防止（好みで 0.0 にしてもOK）
-    return max(effective, 0.5)
+    return float(risk.effective_thresholds(
+        float(s["base_threshold"]), float(s["drink_offset"]),
+        float(s["pollen_offset"]), int(s["pollen_enabled"]),
+    ))
 def get_user_settings(user_id):
-    db = get_db()
-    row = db.execute(
-        "SELECT * FROM user_settings WHERE user_id = ?",
-        (user_id,)
-    ).fetchone()
+    """
+    ユーザー設定を返す（無ければ既定値で作る）
+    キャッシュ優先。ミス時は主キーで読むだけで、行が無い時だけ作って書き込む
+    """
+    s = settings_cache.get(user_id)
+    if s is not None:
+        return s
 
+    db = get_conn()
+    row = db.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
     if row is None:
-        db.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
-        db.commit()
+        # 同時に作られても1行（後から来た方は既にある行をそのまま読む）
         row = db.execute(
-            "SELECT * FROM user_settings WHERE user_id = ?",
+            """
+            INSERT INTO user_settings (user_id) VALUES (?)
+            ON CONFLICT(user_id) DO UPDATE SET user_id = excluded.user_id
+            RETURNING *
+            """,
             (user_id,)
         ).fetchone()
+        db.commit()
 
-    db.close()
-    return row
+    s = dict(row)
+    settings_cache.set(user_id, s)
+    return s
+
+def parse_base_threshold(text):
+    """
+    フォームの基本アラート値 → float（数値でない・nan / inf・範囲外は ValueError）
+    """
+    value = float(text)
+    if not math.isfinite(value) or not BASE_THRESHOLD_MIN <= value <= BASE_THRESHOLD_MAX:
+        raise ValueError(f"base_threshold out of range: {text!r}")
+    return value
+
+def save_user_settings(user_id, base_threshold, drink_offset, pollen_enabled):
+    db = get_conn()
+    row = db.execute(
+        """
+        INSERT INTO user_settings (user_id, base_threshold, drink_offset, pollen_offset, pollen_enabled, updated_at)
+        VALUES (?, ?, ?, ?, ?, datetime('now'))
+        ON CONFLICT(user_id) DO UPDATE SET
+            base_threshold = excluded.base_threshold,
+            drink_offset = excluded.drink_offset,
+            pollen_offset = excluded.pollen_offset,
+            pollen_enabled = excluded.pollen_enabled,
+            updated_at = excluded.updated_at
+        RETURNING *
+        """,
+        (user_id, base_threshold, drink_offset, POLLEN_OFFSET, 1 if pollen_enabled else 0)
+    ).fetchone()
+    db.commit()
+
+    # 書き込んだら古いキャッシュは捨てて、最新の行を入れ直す
+    settings_cache.invalidate(user_id)
+    settings_cache.set(user_id, dict(row))
 
 @settei_bp.route("/", methods=["GET", "POST"])
 @login_required
@@ -55,22 +107,64 @@ def settei_home():
         return redirect("/login")
 
     if request.method == "POST":
-        ...
+        try:
+            base_threshold = parse_base_threshold(request.form.get("base_threshold", "4.0"))
+        except ValueError:
+            flash(f"基本アラート値は {BASE_THRESHOLD_MIN:.1f}〜{BASE_THRESHOLD_MAX:.1f} の数値で入力してください")
+            return redirect("/settei/")
+
+        drink_offset = DRINK_OFFSETS.get(request.form.get("drink_choice", "none"), 0.0)
+        pollen_enabled = request.form.get("pollen_enabled") is not None
+
+        save_user_settings(user_id, base_threshold, drink_offset, pollen_enabled)
+        flash("設定を保存しました")
         return redirect("/settei/")
 
     s = get_user_settings(user_id)
     effective = calc_effective_threshold(s)
-    return render_template("settei.html", s=s, effective=effective)
+    return render_template(
+        "settei.html", s=s, effective=effective, base_min=BASE_THRESHOLD_MIN, base_max=BASE_THRESHOLD_MAX
+    )
 @settei_bp.route("/test-alert", methods=["POST"])
 @login_required
 def test_alert():
+    """
+    前夜アラートと同じ判定（risk.score → thresholds.evaluate）を、
+    自分の地点のこれから24時間の予報に当てて結果を表示する（メールは送らない）
+    """
     user_id = current_user.id
     if not user_id:
         return redirect("/login")
 
-    s = get_user_settings(user_id)
-    effective = calc_effective_threshold(s)
+    db = get_conn()
+    users = thresholds.load(db, user_id=user_id)
+    if not len(users["user_id"]):
+        flash("地点が未設定のため判定できません。")
+        return redirect("/settei/")
+    threshold = float(users["threshold"][0])
+    location_id = int(users["location_id"][0])
+
+    now = pressure_store.now_epoch()
+    series = PressureSeries.read(db, location_id, now, now + 25 * pressure_store.STEP)
+    scored = risk.score(series.values[None, :])
+    if series.count() < 6 or scored["start"][0] < 0:
+        flash(f"予報データがまだありません（実効しきい値 {threshold:.1f} hPa）。")
+        return redirect("/settei/")
+
+    hits = thresholds.evaluate(users, [location_id], scored["delta"])
+    delta = float(scored["delta"][0])
 
-    # いまは「テストしたよ」だけ（安全）
-    flash(f"✅ テストアラート（模擬）: 現在の実効しきい値は {effective:.1f} hPa です。")
+    if user_id in hits:
+        _, level, _, _ = hits[user_id]
+        labels = series.labels
+        start, end = labels[scored["start"][0]], labels[scored["end"][0]]
+        flash(
+            f"✅ テストアラート: {risk.RISK_LEVELS[level]}（{start} 〜 {end} に {delta:.1f} hPa）。"
+            f"実効しきい値 {threshold:.1f} hPa なので、この予報なら通知されます。"
+        )
+    else:
+        flash(
+            f"✅ テストアラート: これから24時間の最大3時間変化は {delta:.1f} hPa。"
+            f"実効しきい値 {threshold:.1f} hPa に届かないため、通知はされません。"
+        )
     return redirect("/settei/")
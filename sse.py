@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import db
+import metrics
+
+# ハートビート間隔と、別プロセスの取り込み結果を拾いに行く間隔（秒）
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "20"))
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", "5"))
+# Web プロセス内で同時に持つ SSE 接続の上限（1接続 = 1スレッドを占有する）
+# 超えた分は 503（ブラウザは定期取得に切り替える）。数千タブは sse_server.py（asyncio）で受ける
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "4"))
+
+
+def snapshot_version(payload):
+    # /api/pressure の ETag と同じ版文字列
+    return hashlib.sha1(payload.encode()).hexdigest()[:20]
+
+
+def read_updates(conn, location_ids, since):
+    # since（updated_at）以降に更新された、指定地点のスナップショット
+    marks = ",".join("?" * len(location_ids))
+    return conn.execute(f"""
+        SELECT location_id, payload, updated_at
+        FROM dashboard_snapshots
+        WHERE location_id IN ({marks}) AND updated_at >= ?
+    """, (*location_ids, since or "")).fetchall()
+
+
+def format_event(version, payload, event="snapshot"):
+    # payload は JSON 文字列。版を "v" に入れて1行にする
+    doc = json.loads(payload)
+    doc["v"] = version
+    data = json.dumps(doc, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\nid: {version}\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """
+    1接続ぶんの受け口
+    キューは持たず「最新の1件」だけ保持する（遅いクライアントは古い版を飛ばす）
+    """
+    __slots__ = ("location_id", "pending", "dropped", "_event")
+
+    def __init__(self, location_id):
+        self.location_id = location_id
+        self.pending = None
+        self.dropped = 0
+        self._event = threading.Event()
+
+    def offer(self, message):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = message
+        self._event.set()
+
+    def take(self, timeout):
+        # timeout 内に届いたメッセージを返す。無ければ None（ハートビートを送る）
+        if not self._event.wait(timeout):
+            return None
+        self._event.clear()
+        message, self.pending = self.pending, None
+        return message
+
+
+class BroadcastHub:
+    """
+    地点ごとの購読者へスナップショットを配る
+    同じ版は二度配らない（予報・リスクが変わった時だけ送る）
+    """
+
+    def __init__(self, heartbeat=SSE_HEARTBEAT, poll_interval=SSE_POLL_INTERVAL):
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self._subs = {}        # location_id -> set(Subscriber)
+        self._versions = {}    # location_id -> 最後に配った版
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._last_seen = None  # 監視で最後に見た updated_at
+        self.published = 0
+        self.delivered = 0
+
+    # ----------------------------
+    # 購読
+    # ----------------------------
+    def subscribe(self, location_id, version=None):
+        # version: 接続直後に送った版（同じ版を監視から二重に送らないため）
+        sub = Subscriber(location_id)
+        with self._lock:
+            self._subs.setdefault(location_id, set()).add(sub)
+            if version is not None:
+                self._versions.setdefault(location_id, version)
+        self._ensure_watcher()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.location_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[sub.location_id]
+
+    def stream(self, sub, initial=None):
+        """
+        text/event-stream 用のジェネレーター
+        切断（GeneratorExit）で購読を外す
+        """
+        try:
+            yield "retry: 5000\n\n"
+            if initial is not None:
+                yield initial
+            while True:
+                message = sub.take(self.heartbeat)
+                yield message if message is not None else ": ping\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+    # ----------------------------
+    # 配信
+    # ----------------------------
+    def publish(self, location_id, payload):
+        """
+        payload（JSON文字列）を地点の購読者全員へ
+        前回と同じ版なら何もしない。戻り値: 配った購読者数
+        """
+        version = snapshot_version(payload)
+        with self._lock:
+            if self._versions.get(location_id) == version:
+                return 0
+            self._versions[location_id] = version
+            subs = list(self._subs.get(location_id, ()))
+        if not subs:
+            return 0
+
+        message = format_event(version, payload)
+        for sub in subs:
+            sub.offer(message)
+        with self._lock:
+            self.published += 1
+            self.delivered += len(subs)
+        return len(subs)
+
+    # ----------------------------
+    # 別プロセスの取り込み結果の監視
+    # ----------------------------
+    def _ensure_watcher(self):
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._watcher = threading.Thread(target=self._watch, name="sse-watcher", daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                location_ids = list(self._subs)
+            if location_ids:
+                try:
+                    self.poll(location_ids)
+                except Exception as e:
+                    print(f"[WARN] sse watcher: {e}")
+            time.sleep(self.poll_interval)
+
+    def poll(self, location_ids):
+        # 前回以降に更新されたスナップショットだけ読んで配る
+        with db.connection() as conn:
+            rows = read_updates(conn, location_ids, self._last_seen)
+        for r in rows:
+            self.publish(r["location_id"], r["payload"])
+            if self._last_seen is None or r["updated_at"] > self._last_seen:
+                self._last_seen = r["updated_at"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "locations": len(self._subs),
+                "subscribers": sum(len(s) for s in self._subs.values()),
+                "published": self.published,
+                "delivered": self.delivered,
+            }
+
+
+hub = BroadcastHub()
+metrics.stats_gauge(
+    "palert_sse", "SSE の購読状況", hub.stats, ("locations", "subscribers", "published", "delivered"),
+)
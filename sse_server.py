@@ -0,0 +1,299 @@
+import asyncio
+import os
+from http.cookies import SimpleCookie
+
+import click
+
+import db
+import metrics
+from sse import SSE_HEARTBEAT, SSE_POLL_INTERVAL, format_event, read_updates, snapshot_version
+
+# =========================
+# SSE 専用サーバー（asyncio・1プロセス）
+# =========================
+#   python -m sse_server
+# リバースプロキシで /api/pressure/stream だけをこのプロセスへ回す（Cookie が届くよう同じオリジンで）
+# 接続はスレッドではなくコルーチン1本 + 最新1件の受け口で持つ
+# → 数千タブが開きっぱなしでも、Web ワーカー（gunicorn のスレッド）を1本も使わない
+# ログインは Flask のセッション Cookie を同じ FLASK_SECRET_KEY で検証する
+# 更新は dashboard_snapshots を SSE_POLL_INTERVAL ごとに1回だけ読み、地点の購読者全員に配る
+
+SSE_HOST = os.getenv("SSE_HOST", "127.0.0.1")
+SSE_PORT = int(os.getenv("SSE_PORT", "8001"))
+SSE_PATH = "/api/pressure/stream"
+# 同時接続の上限（超えたら 503。ブラウザは定期取得に切り替える）
+SSE_MAX_CONNECTIONS = int(os.getenv("SSE_MAX_CONNECTIONS", "10000"))
+# リクエストヘッダーを読み切るまで / 1回の送信が捌けるまでの上限（秒）
+SSE_HEADER_TIMEOUT = float(os.getenv("SSE_HEADER_TIMEOUT", "10"))
+SSE_WRITE_TIMEOUT = float(os.getenv("SSE_WRITE_TIMEOUT", "30"))
+# 設定すると、このポートで /metrics を返す（0 なら出さない）
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+
+class _Subscriber:
+    # sse.Subscriber の asyncio 版（最新の1件だけ持つ）
+    __slots__ = ("location_id", "pending", "event")
+
+    def __init__(self, location_id):
+        self.location_id = location_id
+        self.pending = None
+        self.event = asyncio.Event()
+
+    def offer(self, message):
+        self.pending = message
+        self.event.set()
+
+    async def take(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.event.clear()
+        message, self.pending = self.pending, None
+        return message
+
+
+def _response(status, reason, body=""):
+    body = body.encode()
+    return (
+        f"HTTP/1.1 {status} {reason}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + body
+
+
+class SseServer:
+    """
+    ループ1本で全接続を持つ SSE サーバー
+    購読・配信はすべてループのスレッドから行うのでロックは要らない
+    """
+
+    def __init__(self, host=SSE_HOST, port=SSE_PORT, heartbeat=SSE_HEARTBEAT,
+                 poll_interval=SSE_POLL_INTERVAL, max_connections=SSE_MAX_CONNECTIONS, flask_app=None):
+        if flask_app is None:
+            import app as web
+            flask_app = web.app
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.max_connections = max_connections
+        self._serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self._cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+        self._max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        self._subs = {}        # location_id -> set(_Subscriber)
+        self._versions = {}    # location_id -> 最後に配った版
+        self._last_seen = None
+        self._server = None
+        self._poller = None
+        self._tasks = set()    # 接続中のハンドラー（止める時にまとめて閉じる）
+        self.connections = 0
+        self.rejected = 0
+        self.published = 0
+        self.delivered = 0
+
+    # ----------------------------
+    # 認証・読み出し（DB はループの外のスレッドで読む）
+    # ----------------------------
+    def user_id(self, cookie_header):
+        # Flask のセッション Cookie から flask_login のユーザーID（無効なら None）
+        cookie = SimpleCookie()
+        try:
+            cookie.load(cookie_header or "")
+        except Exception:
+            return None
+        morsel = cookie.get(self._cookie_name)
+        if morsel is None or self._serializer is None:
+            return None
+        try:
+            session = self._serializer.loads(morsel.value, max_age=self._max_age)
+        except Exception:
+            return None
+        return session.get("_user_id")
+
+    @staticmethod
+    def _load(user_id):
+        with db.connection() as conn:
+            return conn.execute("""
+                SELECT u.location_id, s.payload
+                FROM users u
+                LEFT JOIN dashboard_snapshots s ON s.location_id = u.location_id
+                WHERE u.id = ?
+            """, (user_id,)).fetchone()
+
+    @staticmethod
+    def _read_updates(location_ids, since):
+        with db.connection() as conn:
+            return read_updates(conn, location_ids, since)
+
+    # ----------------------------
+    # 購読・配信
+    # ----------------------------
+    def subscribe(self, location_id, version=None):
+        sub = _Subscriber(location_id)
+        self._subs.setdefault(location_id, set()).add(sub)
+        if version is not None:
+            self._versions.setdefault(location_id, version)
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self._subs.get(sub.location_id)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._subs[sub.location_id]
+
+    def publish(self, location_id, payload):
+        version = snapshot_version(payload)
+        if self._versions.get(location_id) == version:
+            return 0
+        self._versions[location_id] = version
+        subs = self._subs.get(location_id)
+        if not subs:
+            return 0
+        message = format_event(version, payload)
+        for sub in subs:
+            sub.offer(message)
+        self.published += 1
+        self.delivered += len(subs)
+        return len(subs)
+
+    async def poll(self):
+        location_ids = list(self._subs)
+        if not location_ids:
+            return
+        rows = await asyncio.to_thread(self._read_updates, location_ids, self._last_seen)
+        for r in rows:
+            self.publish(r["location_id"], r["payload"])
+            if self._last_seen is None or r["updated_at"] > self._last_seen:
+                self._last_seen = r["updated_at"]
+
+    async def _poll_forever(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"[WARN] sse poll: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    # ----------------------------
+    # 1接続
+    # ----------------------------
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.split()
+        if len(parts) < 2:
+            return None, None, headers
+        return parts[0], parts[1].split("?", 1)[0], headers
+
+    async def _send(self, writer, data):
+        writer.write(data.encode() if isinstance(data, str) else data)
+        await asyncio.wait_for(writer.drain(), SSE_WRITE_TIMEOUT)
+
+    async def handle(self, reader, writer):
+        sub = None
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            method, path, headers = await asyncio.wait_for(self._read_request(reader), SSE_HEADER_TIMEOUT)
+            if method != "GET" or path != SSE_PATH:
+                return await self._send(writer, _response(404, "Not Found", '{"error": "not found"}'))
+            if self.connections >= self.max_connections:
+                self.rejected += 1
+                return await self._send(writer, _response(503, "Service Unavailable", '{"error": "busy"}'))
+            user_id = self.user_id(headers.get("cookie"))
+            if user_id is None:
+                return await self._send(writer, _response(401, "Unauthorized", '{"error": "login required"}'))
+            row = await asyncio.to_thread(self._load, user_id)
+            if row is None or row["location_id"] is None:
+                return await self._send(writer, _response(404, "Not Found", '{"error": "no location"}'))
+
+            initial = version = None
+            if row["payload"] is not None:
+                version = snapshot_version(row["payload"])
+                initial = format_event(version, row["payload"])
+            sub = self.subscribe(row["location_id"], version)
+            self.connections += 1
+
+            await self._send(writer, (
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/event-stream; charset=utf-8\r\n"
+                "Cache-Control: no-cache\r\n"
+                "X-Accel-Buffering: no\r\n"
+                "Connection: close\r\n\r\n"
+                "retry: 5000\n\n"
+            ) + (initial or ""))
+            while True:
+                message = await sub.take(self.heartbeat)
+                await self._send(writer, message if message is not None else ": ping\n\n")
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if sub is not None:
+                self.unsubscribe(sub)
+                self.connections -= 1
+            self._tasks.discard(task)
+            writer.close()
+
+    # ----------------------------
+    # 起動・停止
+    # ----------------------------
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._poller = asyncio.create_task(self._poll_forever())
+        return self
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._server is not None:
+            self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "locations": len(self._subs),
+            "rejected": self.rejected,
+            "published": self.published,
+            "delivered": self.delivered,
+        }
+
+
+@click.command()
+@click.option("--host", default=SSE_HOST, show_default=True)
+@click.option("--port", default=SSE_PORT, show_default=True)
+def main(host, port):
+    """
+    SSE 専用サーバー（python -m sse_server）
+    """
+    async def run():
+        server = await SseServer(host, port).start()
+        metrics.stats_gauge(
+            "palert_sse_server", "SSE 専用サーバーの接続状況", server.stats,
+            ("connections", "locations", "rejected", "published", "delivered"),
+        )
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        print(f"[INFO] sse server on {host}:{server.port}{SSE_PATH}")
+        await server._server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
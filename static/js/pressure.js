@@ -1,114 +1,212 @@
 let chartInstance = null;
 
-async function drawPressureChart() {
-  try {
-    const res = await fetch("/api/pressure");
-    const data = await res.json();
+// 手元にある版と系列（since= の差分に使う）
+let current = { v: null, start: null, step: 3600, values: [] };
+
+const REFRESH_MS = 5 * 60 * 1000;
+
+/* =========================
+   系列ユーティリティ
+========================== */
+
+// エポック秒 → "MM/DD HH:MM"（日本時間）
+const labelFormatter = new Intl.DateTimeFormat("ja-JP", {
+  timeZone: "Asia/Tokyo",
+  month: "2-digit",
+  day: "2-digit",
+  hour: "2-digit",
+  minute: "2-digit",
+  hour12: false
+});
+
+function buildLabels(start, step, n) {
+  const labels = new Array(n);
+  for (let i = 0; i < n; i++) {
+    labels[i] = labelFormatter.format(new Date((start + i * step) * 1000));
+  }
+  return labels;
+}
 
-    const labels = Array.isArray(data.labels) ? data.labels : [];
-    const values = Array.isArray(data.values) ? data.values : [];
+// 差分（patch）を手元の系列に当てる
+function applyPatch(data) {
+  const shift = Math.round((data.start - current.start) / data.step);
+  const values = new Array(data.len);
+  for (let i = 0; i < data.len; i++) {
+    const j = i + shift;
+    values[i] = (j >= 0 && j < current.values.length) ? current.values[j] : null;
+  }
+  for (const [i, v] of data.patch) {
+    values[i] = v;
+  }
+  return values;
+}
 
-    const canvas = document.getElementById("pressureChart");
-    if (!canvas || labels.length < 2 || values.length < 2) return;
+/* =========================
+   画面の数値更新
+========================== */
+function updateText(data) {
+  document.getElementById("currentText").textContent =
+    data.current_hpa?.toFixed(1) ?? "--";
 
-    /* =========================
-       画面の数値更新
-    ========================== */
+  document.getElementById("currentTimeText").textContent =
+    data.current_time ?? "--";
 
-    document.getElementById("currentText").textContent =
-      data.current_hpa?.toFixed(1) ?? "--";
+  // 危険区間表示
+  let dangerLine = "要注意：--";
 
-    document.getElementById("currentTimeText").textContent =
-      data.current_time ?? "--";
+  if (data.danger_window?.start && data.danger_window?.end) {
+    const dh = data.danger_window.delta_hpa;
 
-    // 危険区間表示
-    let dangerLine = "要注意：--";
+    const dhTxt = dh != null
+      ? `（${(dh > 0 ? "+" : "") + Number(dh).toFixed(1)} hPa）`
+      : "";
 
-    if (data.danger_window?.start && data.danger_window?.end) {
-      const dh = data.danger_window.delta_hpa;
+    dangerLine =
+      `要注意：${data.danger_window.start} 〜 ${data.danger_window.end} ${dhTxt}`;
+  }
 
-      const dhTxt = dh != null
-        ? `（${(dh > 0 ? "+" : "") + Number(dh).toFixed(1)} hPa）`
-        : "";
+  document.getElementById("dangerText").textContent = dangerLine;
 
-      dangerLine =
-        `要注意：${data.danger_window.start} 〜 ${data.danger_window.end} ${dhTxt}`;
-    }
+  // バッジ更新
+  const badge = document.getElementById("riskBadge");
+  badge.textContent = data.risk ?? "---";
+
+  if (data.risk === "警戒") {
+    badge.style.background = "#ffcdd2";
+  } else if (data.risk === "注意") {
+    badge.style.background = "#ffe5b4";
+  } else {
+    badge.style.background = "#c8e6c9";
+  }
+}
+
+/* =========================
+   Chart.js グラフ描画
+========================== */
+function renderChart(canvas, labels, values) {
+
+  // 2回目以降は作り直さず、データだけ差し替える
+  if (chartInstance) {
+    chartInstance.data.labels = labels;
+    chartInstance.data.datasets[0].data = values;
+    chartInstance.update("none");
+    return;
+  }
 
-    document.getElementById("dangerText").textContent = dangerLine;
+  chartInstance = new Chart(canvas.getContext("2d"), {
+    type: "line",
+    data: {
+      labels: labels,
+      datasets: [{
+        label: "気圧 (hPa)",
+        data: values,
+        borderColor: "#2b6cb0",
+        borderWidth: 2,
+        tension: 0.3,
+        pointRadius: 0,
+        spanGaps: true,
+        fill: false
+      }]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+
+      animation: false, // 🔥 サイズ暴れ防止
+
+      layout: {
+        padding: 0
+      },
 
-    // バッジ更新
-    const badge = document.getElementById("riskBadge");
-    badge.textContent = data.risk ?? "---";
+      plugins: {
+        legend: {
+          display: true
+        }
+      },
 
-    if (data.risk === "警戒") {
-      badge.style.background = "#ffcdd2";
-    } else if (data.risk === "注意") {
-      badge.style.background = "#ffe5b4";
-    } else {
-      badge.style.background = "#c8e6c9";
+      scales: {
+        y: {
+          title: {
+            display: true,
+            text: "hPa"
+          }
+        },
+        x: {
+          ticks: {
+            maxTicksLimit: 6
+          }
+        }
+      }
     }
+  });
+}
 
-    /* =========================
-       Chart.js グラフ描画
-    ========================== */
+// 受け取った文書（全体 or 差分）を画面に反映する
+function handleData(data) {
+  if (data.v && data.v === current.v) return;
+
+  let values;
+  if (Array.isArray(data.patch) && data.base === current.v) {
+    values = applyPatch(data);
+  } else if (Array.isArray(data.values)) {
+    values = data.values;
+  } else {
+    return;
+  }
 
-    const ctx = canvas.getContext("2d");
+  current = { v: data.v, start: data.start, step: data.step, values: values };
 
-    // 既存グラフがあれば破棄（メモリ対策）
-    if (chartInstance) {
-      chartInstance.destroy();
-    }
+  const canvas = document.getElementById("pressureChart");
+  if (!canvas || values.length < 2) return;
 
-    chartInstance = new Chart(ctx, {
-      type: "line",
-      data: {
-        labels: labels,
-        datasets: [{
-          label: "気圧 (hPa)",
-          data: values,
-          borderColor: "#2b6cb0",
-          borderWidth: 2,
-          tension: 0.3,
-          pointRadius: 0,
-          fill: false
-        }]
-      },
-      options: {
-        responsive: true,
-        maintainAspectRatio: false,
+  updateText(data);
+  renderChart(canvas, buildLabels(data.start, data.step, values.length), values);
+}
 
-        animation: false, // 🔥 サイズ暴れ防止
+async function drawPressureChart() {
+  try {
+    const url = current.v
+      ? `/api/pressure?since=${encodeURIComponent(current.v)}`
+      : "/api/pressure";
 
-        layout: {
-          padding: 0
-        },
+    const res = await fetch(url);
 
-        plugins: {
-          legend: {
-            display: true
-          }
-        },
+    // 変化なし
+    if (res.status === 304) return;
 
-        scales: {
-          y: {
-            title: {
-              display: true,
-              text: "hPa"
-            }
-          },
-          x: {
-            ticks: {
-              maxTicksLimit: 6
-            }
-          }
-        }
-      }
-    });
+    handleData(await res.json());
 
   } catch (err) {
     console.error("グラフ描画エラー:", err);
   }
 }
 
-window.addEventListener("load", drawPressureChart);
\ No newline at end of file
+// サーバーからの配信（SSE）。使えない環境・断られた（503 など）ときは定期取得にする
+function startLiveUpdates() {
+  if (!window.EventSource) {
+    setInterval(drawPressureChart, REFRESH_MS);
+    return;
+  }
+
+  const source = new EventSource("/api/pressure/stream");
+
+  source.addEventListener("error", () => {
+    // 再接続中（CONNECTING）はブラウザに任せる。閉じられたら定期取得へ
+    if (source.readyState === EventSource.CLOSED) {
+      setInterval(drawPressureChart, REFRESH_MS);
+    }
+  });
+
+  source.addEventListener("snapshot", (ev) => {
+    try {
+      handleData(JSON.parse(ev.data));
+    } catch (err) {
+      console.error("配信データの処理エラー:", err);
+    }
+  });
+}
+
+window.addEventListener("load", () => {
+  drawPressureChart();
+  startLiveUpdates();
+});
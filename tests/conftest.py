@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# =========================
+# テスト共通
+# =========================
+# 設定はモジュールを読み込む時に環境変数から決まるので、import より先にテスト用の値を入れる
+# DB はテスト実行ごとの一時ファイル（マイグレーション済み）。上流はテストごとに bench.stubs を立てる
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="palert-test-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "test.db")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
+
+
+@pytest.fixture(scope="session")
+def web():
+    import app as web
+    web.init_db()
+    return web
+
+
+@pytest.fixture
+def conn(web):
+    import db
+    with db.connection() as conn:
+        yield conn
+
+
+def make_user(conn, email, lat=35.68, lon=139.76, location=True):
+    """
+    ユーザー（と地点）を1人作る。戻り値: (user_id, location_id)
+    """
+    location_id = None
+    if location:
+        cell = (round(lat * 1000), round(lon * 1000))
+        conn.execute(
+            "INSERT OR IGNORE INTO locations (cell_i, cell_j, lat, lon) VALUES (?, ?, ?, ?)", (*cell, lat, lon)
+        )
+        location_id = conn.execute(
+            "SELECT id FROM locations WHERE cell_i = ? AND cell_j = ?", cell
+        ).fetchone()[0]
+    cur = conn.execute(
+        "INSERT INTO users (email, pw_hash, created_at, lat, lon, location_id) VALUES (?, 'x', datetime('now'), ?, ?, ?)",
+        (email, lat, lon, location_id),
+    )
+    conn.commit()
+    return cur.lastrowid, location_id
+
+
+@pytest.fixture
+def meteo(web, monkeypatch):
+    # Open-Meteo のスタブを立て、共有の予報クライアントをそちらに向ける
+    import forecast
+    from bench.stubs import OpenMeteoStub
+
+    stub = OpenMeteoStub().start()
+    monkeypatch.setattr(forecast.client, "base_url", stub.url)
+    yield stub
+    stub.stop()
+
+
+class SmtpSink:
+    """
+    aiosmtpd の受け口。届いたメールと、どの接続（peer）で届いたかを持つ
+    fail_next に SMTP 応答（"421 ..." など）を積むと、次の DATA をその応答で断る
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.peers = []
+        self.fail_next = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.fail_next:
+            return self.fail_next.pop(0)
+        self.messages.append(envelope)
+        self.peers.append(session.peer)
+        return "250 OK"
+
+    @property
+    def connections(self):
+        return len(set(self.peers))
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    # ローカルの SMTP サーバー（STARTTLS・認証なし）を立て、mailer の既定値をそちらに向ける
+    import socket
+
+    import mailer
+    from aiosmtpd.controller import Controller
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    sink = SmtpSink()
+    controller = Controller(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+    monkeypatch.setattr(mailer, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(mailer, "SMTP_PORT", port)
+    monkeypatch.setattr(mailer, "SMTP_USER", "")
+    monkeypatch.setattr(mailer, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(mailer, "MAIL_FROM", "alert@p-alert.test")
+    yield sink
+    controller.stop()
@@ -0,0 +1,72 @@
+import pytest
+
+import analytics
+import pressure_store
+
+from conftest import make_user
+
+NOW = pressure_store.to_epochs(["2026-03-10T12:00"])[0]
+
+
+def _pressure(conn, location_id, values):
+    # {"YYYY-MM-DDTHH:MM": hPa}
+    pressure_store.write(conn, location_id, pressure_store.to_epochs(list(values)), list(values.values()))
+    conn.commit()
+
+
+def _log(conn, user_id, log_at, score):
+    cur = conn.execute("INSERT INTO logs (user_id, log_at, score, note) VALUES (?, ?, ?, '')", (user_id, log_at, score))
+    conn.commit()
+    return cur.lastrowid
+
+
+def _state(conn, user_id):
+    return analytics.load_state(conn, user_id)
+
+
+def test_update_waits_for_pressure_before_checkpointing(web, conn):
+    uid, loc = make_user(conn, "sensitivity-wait@test", lat=36.1, lon=140.1)
+    _pressure(conn, loc, {"2026-03-10T06:00": 1012.0, "2026-03-10T09:00": 1010.0, "2026-03-10T07:00": 1011.0})
+
+    first = _log(conn, uid, "2026-03-10T09:10:00", 2)
+    waiting = _log(conn, uid, "2026-03-10T11:05:00", 1)     # 11時・8時の気圧はまだ無い
+    later = _log(conn, uid, "2026-03-10T10:20:00", 3)       # 値はあるが、待っているログの後
+
+    assert analytics.update_user(conn, uid, now=NOW) == 1
+    state, last_log_id = _state(conn, uid)
+    assert last_log_id == first and state["n"] == 1
+
+    # 取り込まれた後の更新で、待っていたログとその後ろを拾う
+    _pressure(conn, loc, {"2026-03-10T08:00": 1011.0, "2026-03-10T11:00": 1008.0, "2026-03-10T10:00": 1009.5})
+    assert analytics.update_user(conn, uid, now=NOW) == 2
+    state, last_log_id = _state(conn, uid)
+    assert last_log_id == later and state["n"] == 3
+    assert state["mean_dp"] == pytest.approx((-2.0 - 3.0 - 1.5) / 3)
+
+
+def test_update_skips_logs_that_will_not_be_filled(web, conn):
+    uid, loc = make_user(conn, "sensitivity-old@test", lat=36.2, lon=140.2)
+    old = _log(conn, uid, "2026-03-01T09:00:00", 2)          # 48時間より前で、気圧が無い
+    assert analytics.update_user(conn, uid, now=NOW) == 0
+    state, last_log_id = _state(conn, uid)
+    assert last_log_id == old and state["n"] == 0
+
+    no_location, _ = make_user(conn, "sensitivity-nowhere@test", location=False)
+    log_id = _log(conn, no_location, "2026-03-10T11:00:00", 3)
+    assert analytics.update_user(conn, no_location, now=NOW) == 0
+    assert _state(conn, no_location)[1] == log_id
+
+
+def test_recompute_stops_at_the_same_checkpoint(web, conn):
+    uid, loc = make_user(conn, "sensitivity-recompute@test", lat=36.3, lon=140.3)
+    _pressure(conn, loc, {"2026-03-10T03:00": 1013.0, "2026-03-10T06:00": 1011.0})
+    done = _log(conn, uid, "2026-03-10T06:30:00", 2)
+    waiting = _log(conn, uid, "2026-03-10T11:00:00", 4)
+
+    analytics.recompute_all(conn, now=NOW)
+    state, last_log_id = _state(conn, uid)
+    assert state["n"] == 1 and done <= last_log_id < waiting
+
+    _pressure(conn, loc, {"2026-03-10T08:00": 1010.0, "2026-03-10T11:00": 1009.0})
+    assert analytics.update_user(conn, uid, now=NOW) == 1
+    assert _state(conn, uid)[0]["n"] == 2
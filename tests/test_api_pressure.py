@@ -0,0 +1,55 @@
+import json
+
+from conftest import make_user
+
+
+def _login(web, user_id):
+    client = web.app.test_client()
+    with client.session_transaction() as s:
+        s["_user_id"] = str(user_id)
+    return client
+
+
+def test_stale_snapshot_is_refreshed(web, conn, meteo):
+    uid, location_id = make_user(conn, "api-stale@test", lat=35.0, lon=135.0)
+    conn.execute("""
+        INSERT INTO dashboard_snapshots (location_id, payload, risk, updated_at)
+        VALUES (?, ?, '安定', datetime('now', '-1 day'))
+    """, (location_id, json.dumps({"start": 0, "step": 3600, "values": [1.0], "risk": "安定"})))
+    conn.commit()
+
+    r = _login(web, uid).get("/api/pressure")
+    assert r.status_code == 200
+    doc = r.get_json()
+    assert doc["start"] > 0 and len(doc["values"]) > 24
+    fresh = conn.execute(
+        "SELECT updated_at >= datetime('now', '-60 seconds') FROM dashboard_snapshots WHERE location_id = ?",
+        (location_id,),
+    ).fetchone()[0]
+    assert fresh
+
+
+def test_fresh_snapshot_is_served_without_fetching(web, conn, meteo):
+    uid, location_id = make_user(conn, "api-fresh@test", lat=35.1, lon=135.1)
+    payload = json.dumps({"start": 7200, "step": 3600, "values": [1.0, 2.0], "risk": "安定"})
+    conn.execute("""
+        INSERT INTO dashboard_snapshots (location_id, payload, risk, updated_at)
+        VALUES (?, ?, '安定', datetime('now'))
+    """, (location_id, payload))
+    conn.commit()
+
+    before = meteo.requests
+    doc = _login(web, uid).get("/api/pressure").get_json()
+    assert doc["values"] == [1.0, 2.0] and meteo.requests == before
+
+
+def test_unassigned_user_uses_own_coordinates(web, conn, meteo, monkeypatch):
+    import pressure
+
+    uid, _ = make_user(conn, "api-noloc@test", lat=43.06, lon=141.35, location=False)
+    seen = []
+    real = pressure.get_dashboard
+    monkeypatch.setattr(pressure, "get_dashboard", lambda lat, lon: seen.append((lat, lon)) or real(lat, lon))
+
+    r = _login(web, uid).get("/api/pressure")
+    assert r.status_code == 200 and seen == [(43.06, 141.35)]
@@ -0,0 +1,98 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import backfill
+import pressure_store
+from forecast import ForecastError
+
+from conftest import make_user
+
+START = date(2024, 1, 1)
+END = date(2024, 1, 10)
+DAYS = (END - START).days + 1
+
+
+def _locations(conn, tag):
+    # テストごとに別の地点（チェックポイント・ブロックが他のテストと混ざらないように）
+    base = {"chunks": 31.0, "resume": 32.0, "restart": 33.0}[tag]
+    ids = [make_user(conn, f"backfill-{tag}-{n}@test", lat=base + n * 0.1, lon=131.0)[1] for n in range(3)]
+    return conn.execute(
+        f"SELECT id, lat, lon FROM locations WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids
+    ).fetchall()
+
+
+def _run(conn, meteo, locations, **kwargs):
+    kwargs.setdefault("chunk_days", 4)
+    kwargs.setdefault("batch", 2)
+    return backfill.backfill(conn, locations, START, END, base_url=meteo.archive_url, **kwargs)
+
+
+def _stored(conn, locations):
+    start = pressure_store.day_epoch(START.isoformat())
+    epochs, matrix = pressure_store.read_matrix(
+        conn, [l["id"] for l in locations], start, start + DAYS * pressure_store.DAY
+    )
+    return matrix
+
+
+def _progress(conn, locations):
+    rows = conn.execute(
+        f"SELECT location_id, done_through FROM backfill_progress WHERE location_id IN ({','.join('?' * len(locations))})",
+        [l["id"] for l in locations],
+    )
+    return {r[0]: r[1] for r in rows}
+
+
+def test_backfill_chunks_and_counts_values(web, conn, meteo):
+    locations = _locations(conn, "chunks")
+    result = _run(conn, meteo, locations)
+
+    # 10日を 4日ずつ（4・4・2日）× 地点を 2つずつ（2・1地点）= 6リクエスト
+    assert result["requests"] == meteo.requests == 6
+    assert result["values"] == 3 * DAYS * 24
+    matrix = _stored(conn, locations)
+    assert matrix.shape == (3, DAYS * 24) and not np.isnan(matrix).any()
+    assert set(_progress(conn, locations).values()) == {END.isoformat()}
+
+    # もう一度回しても取りに行かない
+    assert _run(conn, meteo, locations)["requests"] == 0
+    assert meteo.requests == 6
+
+
+def test_backfill_resumes_without_refetching(web, conn, meteo):
+    locations = _locations(conn, "resume")
+    # 4件目で上流が恒久エラー（1件ごとにコミットしておく）
+    meteo.fail = [200, 200, 200, 404]
+    with pytest.raises(ForecastError):
+        _run(conn, meteo, locations, prefetch=1, commit_values=1)
+    assert meteo.requests == 4
+
+    # 1〜4日目は3地点とも、5〜8日目は先頭の2地点だけ済んでいる
+    progress = _progress(conn, locations)
+    first, second = START + timedelta(days=3), START + timedelta(days=7)
+    assert [progress[l["id"]] for l in locations] == [second.isoformat()] * 2 + [first.isoformat()]
+    assert np.count_nonzero(~np.isnan(_stored(conn, locations))) == 480
+
+    # 続きだけ: 3地点目の 5〜8日目（1件）と、3地点そろった 9〜10日目（2件）
+    result = _run(conn, meteo, locations, prefetch=1, commit_values=1)
+    assert result["requests"] == 3 and meteo.requests == 7
+    assert result["values"] == 3 * DAYS * 24 - 480
+    assert not np.isnan(_stored(conn, locations)).any()
+
+
+def test_backfill_restart_fetches_everything_again(web, conn, meteo):
+    locations = _locations(conn, "restart")
+    _run(conn, meteo, locations)
+    before = _stored(conn, locations)
+
+    result = _run(conn, meteo, locations, restart=True)
+    assert result["requests"] == 6 and meteo.requests == 12
+    assert result["values"] == 3 * DAYS * 24
+    # 同じ値を書き直すだけ（重複しない）
+    np.testing.assert_array_equal(_stored(conn, locations), before)
+    assert conn.execute(
+        f"SELECT COUNT(*) FROM pressure_blocks WHERE location_id IN ({','.join('?' * 3)})",
+        [l["id"] for l in locations],
+    ).fetchone()[0] == 3 * DAYS
@@ -0,0 +1,152 @@
+import concurrent.futures
+
+import pytest
+
+from forecast import ForecastClient, ForecastError
+
+COORDS = [(35.68, 139.76), (34.69, 135.5), (43.06, 141.35)]
+
+
+@pytest.fixture
+def stub():
+    from bench.stubs import OpenMeteoStub
+
+    stub = OpenMeteoStub().start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def make_client(stub):
+    clients = []
+
+    def make(**kwargs):
+        kwargs.setdefault("backoff", 0.0)
+        c = ForecastClient(base_url=stub.url, **kwargs)
+        clients.append(c)
+        return c
+
+    yield make
+    for c in clients:
+        c.close()
+
+
+def _expected(stub, coords, days=2):
+    q = {
+        "latitude": [",".join(str(lat) for lat, _ in coords)],
+        "longitude": [",".join(str(lon) for _, lon in coords)],
+        "forecast_days": [str(days)],
+    }
+    data = stub.respond(q)
+    data = [data] if isinstance(data, dict) else data
+    return [(d["hourly"]["time"], d["hourly"]["pressure_msl"]) for d in data]
+
+
+# ----------------------------
+# 応答の形
+# ----------------------------
+@pytest.mark.parametrize("chunked, gzipped", [(False, False), (True, False), (False, True), (True, True)])
+def test_reads_chunked_and_gzip_bodies(stub, make_client, chunked, gzipped):
+    stub.chunked, stub.gzip, stub.chunk_size = chunked, gzipped, 100
+    client = make_client()
+    got = client.run(client.fetch_many(COORDS, forecast_days=2))
+    assert got == _expected(stub, COORDS)
+
+    # 同じ接続で続けて読める（本文を読み残していない）
+    again = client.run(client.fetch_many(COORDS[:1], forecast_days=2))
+    assert again == _expected(stub, COORDS[:1])
+    assert client.stats()["connects"] == 1 and client.stats()["reused"] == 1
+
+
+# ----------------------------
+# 再試行
+# ----------------------------
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retries_rate_limit_and_server_errors(stub, make_client, status):
+    stub.fail = [status, status]
+    client = make_client(max_retries=3)
+    assert client.run(client.fetch_many(COORDS)) == _expected(stub, COORDS)
+    assert stub.requests == 3
+    assert client.stats()["retries"] == 2 and client.stats()["failures"] == 0
+
+
+def test_gives_up_after_max_retries(stub, make_client):
+    stub.fail = [503] * 10
+    client = make_client(max_retries=2)
+    with pytest.raises(ForecastError):
+        client.run(client.fetch_many(COORDS))
+    assert stub.requests == 3
+    assert client.stats()["failures"] == 1
+
+
+@pytest.mark.parametrize("body", [b'{"latitude": 35.6', b"<html>Bad Gateway</html>", b""])
+def test_retries_malformed_json_body(stub, make_client, body):
+    stub.malformed = [body]
+    client = make_client(max_retries=2)
+    assert client.run(client.fetch_many(COORDS)) == _expected(stub, COORDS)
+    assert stub.requests == 2 and client.stats()["retries"] == 1
+
+
+def test_retries_truncated_gzip_body(stub, make_client):
+    import gzip
+    import json
+
+    stub.gzip = True
+    stub.malformed = [gzip.compress(json.dumps(stub.respond({
+        "latitude": ["35.68"], "longitude": ["139.76"], "forecast_days": ["2"],
+    })).encode())[:-20]]
+    client = make_client(max_retries=2)
+    assert client.run(client.fetch_many(COORDS[:1])) == _expected(stub, COORDS[:1])
+    assert client.stats()["retries"] == 1
+
+
+def test_malformed_json_is_a_forecast_error(stub, make_client):
+    # 呼び出し側は ForecastError だけを捕まえる（ValueError が漏れると取り込み全体が止まる）
+    stub.malformed = [b'{"latitude": 35.6'] * 10
+    client = make_client(max_retries=2)
+    with pytest.raises(ForecastError, match="JSON ではありません"):
+        client.run(client.fetch_many(COORDS))
+    assert stub.requests == 3 and client.stats()["failures"] == 1
+
+
+def test_does_not_retry_client_errors(stub, make_client):
+    stub.fail = [404]
+    client = make_client(max_retries=3)
+    with pytest.raises(ForecastError) as e:
+        client.run(client.fetch_many(COORDS))
+    assert e.value.status == 404
+    assert stub.requests == 1 and client.stats()["retries"] == 0
+
+
+# ----------------------------
+# 同時数・タイムアウト
+# ----------------------------
+def test_semaphore_limits_concurrent_requests(stub, make_client):
+    stub.delay = 0.05
+    client = make_client(concurrency=2)
+    coords = [(30 + n * 0.5, 130 + n * 0.5) for n in range(12)]
+    got = client.run(client.fetch_many(coords, chunk_size=1))
+    assert got == _expected(stub, coords)
+    assert stub.requests == 12
+    assert stub.max_in_flight == 2
+
+
+def test_semaphore_is_shared_across_callers(stub, make_client):
+    # 別スレッドから同時に呼んでも、クライアント全体で concurrency 本まで
+    stub.delay = 0.05
+    client = make_client(concurrency=3)
+    with concurrent.futures.ThreadPoolExecutor(6) as pool:
+        list(pool.map(lambda n: client.run(client.fetch_many([(35 + n, 135)])), range(6)))
+    assert stub.max_in_flight == 3
+
+
+def test_timeout_is_retried_then_raised(stub, make_client):
+    stub.delay = 0.5
+    client = make_client(timeout=0.1, max_retries=1)
+    with pytest.raises(ForecastError):
+        client.run(client.fetch_many(COORDS[:1]))
+    assert client.stats()["retries"] == 1 and client.stats()["idle"] == 0
+
+    # タイムアウトした接続は使い回さない（次は新しい接続で普通に取れる）
+    stub.delay = 0.0
+    assert client.run(client.fetch_many(COORDS[:1])) == _expected(stub, COORDS[:1])
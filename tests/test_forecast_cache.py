@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import pressure
+from cache import ForecastCache
+
+
+def _wait(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def model_run(monkeypatch):
+    run = {"value": "2026031000"}
+    monkeypatch.setattr(pressure, "_model_run", lambda now=None: run["value"])
+    return run
+
+
+def test_same_grid_cell_shares_one_fetch(web, meteo, model_run):
+    # 0.05度の格子で同じセル（丸め2桁だと別キーになる組）
+    a = pressure.get_forecast(34.071, 132.991)
+    b = pressure.get_forecast(34.059, 133.009)
+    assert a == b and meteo.requests == 1
+
+    pressure.get_forecast(34.14, 132.99)    # 隣のセル
+    assert meteo.requests == 2
+
+
+def test_new_model_run_serves_stale_and_refreshes(web, meteo, model_run):
+    lat, lon = 35.0, 136.9
+    first = pressure.get_forecast(lat, lon)
+    misses = pressure.forecast_cache.stats()["misses"]
+
+    # 実行回が変わっても、その場では上流を待たずに前の値を返す
+    model_run["value"] = "2026031003"
+    assert pressure.get_forecast(lat, lon) == first
+    assert pressure.forecast_cache.stats()["misses"] == misses
+    _wait(lambda: meteo.requests == 2)
+
+    # 裏で取り直した後は新しい実行回の値（もう取りに行かない）
+    _wait(lambda: pressure.forecast_cache.stats()["inflight"] == 0)
+    pressure.get_forecast(lat, lon)
+    assert meteo.requests == 2
+
+
+def test_dashboard_is_keyed_by_cell(web, meteo, model_run):
+    doc = pressure.get_dashboard(33.59, 130.40)
+    assert pressure.get_dashboard(33.61, 130.41) == doc
+    assert meteo.requests == 1
+
+
+def test_memory_cache_treats_unfresh_values_as_stale():
+    cache = ForecastCache(ttl=60, stale_ttl=3600)
+    calls = []
+
+    def loader(tag):
+        def load():
+            calls.append(tag)
+            return {"run": tag}
+        return load
+
+    assert cache.get_or_fetch("k", loader("a"), fresh=lambda v: v["run"] == "a") == {"run": "a"}
+    # 鮮度外なら前の値を返し、裏で1回だけ取り直す
+    assert cache.get_or_fetch("k", loader("b"), fresh=lambda v: v["run"] == "b") == {"run": "a"}
+    _wait(lambda: cache.get("k") == {"run": "b"})
+    assert cache.get_or_fetch("k", loader("c"), fresh=lambda v: v["run"] == "b") == {"run": "b"}
+    assert calls == ["a", "b"] and cache.stats()["stale_hits"] == 1
+
+
+@pytest.mark.parametrize("backend", ["memory", "shared"])
+def test_gauge_exports_every_stat(web, backend):
+    import metrics
+    from cache import CACHE_STATS, SharedCache
+
+    cache = ForecastCache(maxsize=4) if backend == "memory" else SharedCache(f"gauge-{backend}")
+    cache.get_or_fetch("k", lambda: 1)
+    gauge = metrics.stats_gauge(f"palert_test_cache_{backend}", "テスト", cache.stats, CACHE_STATS)
+    lines = gauge.expose()
+    # どちらの実装でも、並べた項目が全部（数値で）出る
+    for stat in CACHE_STATS:
+        assert any(line.startswith(f'palert_test_cache_{backend}{{stat="{stat}"') for line in lines), stat
+
+
+def test_forecast_cache_gauge_lists_every_stat(web):
+    import metrics
+    from cache import CACHE_STATS
+
+    body = metrics.registry.expose()
+    for stat in CACHE_STATS:
+        assert f'palert_forecast_cache{{stat="{stat}"}}' in body, stat
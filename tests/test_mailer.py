@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+import mailer
+from mailer import Mail, SmtpDispatcher
+
+
+def _mails(n, tag="m"):
+    return [Mail(f"{tag}{k}@test", f"件名 {k}", "本文", tag=k) for k in range(n)]
+
+
+def _smtp_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("smtp-worker-")]
+
+
+@pytest.fixture
+def dispatcher(smtp):
+    made = []
+
+    def make(**kwargs):
+        d = SmtpDispatcher(**kwargs)
+        made.append(d)
+        return d
+
+    yield make
+    for d in made:
+        d.close()
+
+
+def test_pool_and_sessions_outlive_send_many(smtp, dispatcher):
+    d = dispatcher(workers=3)
+    before = len(_smtp_threads())
+    first = d.send_many(_mails(9, "a"))
+    threads = _smtp_threads()
+    second = d.send_many(_mails(9, "b"))
+
+    assert [r.mail.tag for r in first] == list(range(9)) and all(r.ok for r in first + second)
+    assert len(smtp.messages) == 18
+    # スレッドも接続も1回目の分をそのまま使う
+    assert len(threads) - before == 3 and _smtp_threads() == threads
+    assert d.stats()["connects"] == smtp.connections <= 3
+
+    d.close()
+    assert len(_smtp_threads()) == before
+
+
+def test_retries_transient_errors_with_full_jitter(smtp, dispatcher, monkeypatch):
+    caps, sleeps = [], []
+    monkeypatch.setattr(mailer.random, "uniform", lambda a, b: caps.append((a, b)) or b / 2)
+    monkeypatch.setattr(mailer.time, "sleep", sleeps.append)
+    smtp.fail_next = ["451 try again later"] * 3
+
+    d = dispatcher(workers=1, max_retries=3)
+    [result] = d.send_many(_mails(1))
+    assert result.ok and len(smtp.messages) == 1
+    # 待ちは 0 〜 base * 2^attempt の一様乱数（上限 SMTP_BACKOFF_MAX）
+    assert caps == [(0, mailer.SMTP_BACKOFF * 2 ** k) for k in range(3)]
+    assert sleeps == [b / 2 for _, b in caps]
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(mailer.random, "uniform", lambda a, b: b)
+    assert SmtpDispatcher._delay(30) == mailer.SMTP_BACKOFF_MAX
+    monkeypatch.undo()
+    delays = {SmtpDispatcher._delay(3) for _ in range(50)}
+    assert len(delays) > 1 and all(0 <= x <= mailer.SMTP_BACKOFF * 8 for x in delays)
+
+
+def test_permanent_errors_are_not_retried(smtp, dispatcher, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(mailer.time, "sleep", sleeps.append)
+    smtp.fail_next = ["550 no such user"]
+
+    d = dispatcher(workers=2, max_retries=3)
+    results = d.send_many(_mails(3))
+    failed = [r for r in results if not r.ok]
+    assert len(failed) == 1 and failed[0].error.smtp_code == 550
+    assert not sleeps and len(smtp.messages) == 2
+    assert d.stats()["sent"] == 2 and d.stats()["failed"] == 1
@@ -0,0 +1,92 @@
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+import metrics
+import thresholds
+
+
+def test_web_metrics_need_a_token(web, monkeypatch):
+    client = web.app.test_client()
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    r = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert r.status_code == 200 and b"palert_alerts_evaluated_total" in r.data
+
+
+def test_metrics_port_listens_on_localhost(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    server = metrics.serve(0)
+    try:
+        host, port = server.server_address
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+            assert r.status == 200
+
+        monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5)
+        assert e.value.code == 401
+    finally:
+        server.shutdown()
+
+
+def test_alert_counters_count_users():
+    kind = "test_units"
+    # 5人: 地点1に2人・地点2に1人・地点3（データ無し）に2人。地点1の1人だけしきい値を超えた
+    users = {
+        "user_id": np.array([1, 2, 3, 4, 5]),
+        "location_id": np.array([1, 1, 2, 3, 3]),
+        "threshold": np.full(5, 4.0),
+    }
+    hits = {1: (-5.0, 1, 4.0, 1)}
+    thresholds.record(kind, users, [1, 2], hits)
+
+    evaluated = metrics.alerts_evaluated.value(kind=kind)
+    no_data = metrics.alerts_skipped.value(kind=kind, reason="no_data")
+    below = metrics.alerts_skipped.value(kind=kind, reason="below_threshold")
+    assert (evaluated, no_data, below) == (3, 2, 2)
+    # 判定したユーザー = 通知 + しきい値未満（同じ単位なので足し引きできる）
+    assert evaluated == len(hits) + below
+    assert evaluated + no_data == len(users["user_id"])
+
+
+def test_each_worker_serves_its_own_labelled_metrics(web, monkeypatch):
+    import socket
+
+    import wsgi
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        base = s.getsockname()[1] - 2
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "s3cret")
+    monkeypatch.setattr(wsgi, "WEB_METRICS_PORT", base)
+    monkeypatch.setattr(wsgi, "PROCESS_LOCAL_CACHES", ())
+    metrics.upstream_retries.inc(upstream="worker-test")
+    try:
+        wsgi.post_fork(workers=4, index=2)
+        req = urllib.request.Request(f"http://127.0.0.1:{base + 2}/metrics", headers={"Authorization": "Bearer s3cret"})
+        with urllib.request.urlopen(req, timeout=5) as r:
+            body = r.read().decode()
+        # カウンター・ヒストグラム（le 付き）・ゲージのどれにも worker が付く
+        assert 'palert_upstream_retries_total{upstream="worker-test",worker="2"} 1' in body
+        assert any(line.startswith("palert_") and 'le="+Inf",worker="2"}' in line for line in body.splitlines())
+        assert 'palert_db_pool{stat="size",worker="2"}' in body
+        samples = [line for line in body.splitlines() if line and not line.startswith("#")]
+        assert all('worker="2"' in line for line in samples)
+
+        # 共有ポートの /metrics は、どのワーカーが答えるか決まらないので出さない
+        r = web.app.test_client().get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        assert r.status_code == 404
+    finally:
+        metrics.set_worker(None)
+        if wsgi.metrics_server is not None:
+            wsgi.metrics_server.shutdown()
+            wsgi.metrics_server.server_close()
+            wsgi.metrics_server = None
@@ -0,0 +1,139 @@
+import pytest
+
+import db
+import outbox
+from mailer import Mail
+
+from conftest import make_user
+
+
+def _queue(conn, n, kind):
+    mails = []
+    for k in range(n):
+        uid, _ = make_user(conn, f"{kind}-{k}@test", location=False)
+        mails.append(Mail(f"{kind}-{k}@test", "件名", "本文", tag=uid))
+    queued = outbox.enqueue(conn.cursor(), mails, "2026-01-01", kind)
+    conn.commit()
+    return queued
+
+
+def _statuses(conn, kind):
+    return [r[0] for r in conn.execute("SELECT status FROM alert_outbox WHERE kind = ? ORDER BY id", (kind,))]
+
+
+def test_worker_keeps_one_smtp_session(web, conn, smtp):
+    assert _queue(conn, 5, "session") == 5
+    worker = outbox.DeliveryWorker(batch=2, until_empty=True)
+    worker.run()
+
+    # 3バッチとも同じ接続で送る（バッチごとに接続・認証し直さない）
+    assert worker.sent == 5 and len(smtp.messages) == 5
+    assert smtp.connections == 1
+    assert worker.dispatcher.stats()["connects"] == 1
+    assert _statuses(conn, "session") == ["sent"] * 5
+
+
+def test_worker_reconnects_when_the_session_was_dropped(web, conn, smtp):
+    _queue(conn, 2, "dropped")
+    worker = outbox.DeliveryWorker(batch=1, until_empty=True)
+    with db.connection() as c:
+        assert worker.run_once(c) == 1
+        # 置いてある接続がサーバー側で閉じられた → 張り直して同じ周期で送る（再試行に回さない）
+        smtp.fail_next.append("421 closing idle connection")
+        assert worker.run_once(c) == 1
+    worker.dispatcher.close()
+
+    assert worker.sent == 2 and worker.retried == 0
+    assert worker.dispatcher.stats()["connects"] == 2
+    assert _statuses(conn, "dropped") == ["sent", "sent"]
+
+
+def test_deliver_uses_only_free_connections(web, conn, smtp, monkeypatch):
+    _queue(conn, 6, "capped")
+    monkeypatch.setattr(db, "pool", db.ConnectionPool(size=3, timeout=5))
+    started = []
+
+    class Worker(outbox.DeliveryWorker):
+        def run(self):
+            started.append(self.name)
+            super().run()
+
+    monkeypatch.setattr(outbox, "DeliveryWorker", Worker)
+    # 別のジョブが1本借りている間に --workers 8 で送る → 立てるのは空きの2本まで
+    with db.connection():
+        assert outbox.deliver(workers=8) == 6
+    assert len(started) == 2
+    assert _statuses(conn, "capped") == ["sent"] * 6
+    db.pool.close_all()
+
+
+def test_worker_backs_off_when_the_pool_is_exhausted(web, conn, smtp, monkeypatch):
+    _queue(conn, 2, "pool-busy")
+    monkeypatch.setattr(db, "pool", db.ConnectionPool(size=1, timeout=0.05))
+    worker = outbox.DeliveryWorker(until_empty=True, poll_interval=0.01)
+    with db.connection():
+        # 接続が借りられない → 例外でスレッドを落とさず、借り直しを諦めたら残して戻る
+        worker.run()
+    assert worker.pool_timeouts == outbox.OUTBOX_POOL_RETRIES + 1
+    assert worker.sent == 0 and _statuses(conn, "pool-busy") == ["pending"] * 2
+
+    worker = outbox.DeliveryWorker(until_empty=True, poll_interval=0.01)
+    worker.run()
+    assert worker.sent == 2 and worker.pool_timeouts == 0
+    db.pool.close_all()
+
+
+def _expire(conn, kind):
+    # 貸出期限を過ぎたことにする（取ったワーカーが落ちた）
+    conn.execute("""
+        UPDATE alert_outbox SET next_attempt_at = datetime('now', '-1 seconds')
+        WHERE kind = ? AND status = 'sending'
+    """, (kind,))
+    conn.commit()
+
+
+def test_expired_lease_is_dead_lettered_at_max_attempts(web, conn):
+    import metrics
+
+    _queue(conn, 1, "crashing")
+    dead_before = metrics.alerts_failed.value(kind="crashing", outcome="dead")
+    # 取ったワーカーが ack の前に落ち続ける → 期限切れのたびに取り直され、attempts が増える
+    for attempt in (1, 2):
+        rows = outbox.claim(conn, f"w{attempt}", max_attempts=2)
+        assert [r["attempts"] for r in rows] == [attempt]
+        _expire(conn, "crashing")
+
+    # 上限に達した行は取り直さずに dead
+    assert outbox.claim(conn, "w3", max_attempts=2) == []
+    assert _statuses(conn, "crashing") == ["dead"]
+    error = conn.execute("SELECT last_error FROM alert_outbox WHERE kind = 'crashing'").fetchone()[0]
+    assert "lease expired" in error
+    assert metrics.alerts_failed.value(kind="crashing", outcome="dead") == dead_before + 1
+
+
+def test_crash_mid_batch_does_not_resend_delivered_mail(web, conn, smtp):
+    _queue(conn, 3, "mid-batch")
+    worker = outbox.DeliveryWorker(batch=3, until_empty=True)
+    real = worker.dispatcher.send_many
+    calls = []
+
+    def crash_on_third(mails):
+        calls.append(mails)
+        if len(calls) == 3:
+            raise RuntimeError("worker crashed")
+        return real(mails)
+
+    worker.dispatcher.send_many = crash_on_third
+    with db.connection() as c:
+        with pytest.raises(RuntimeError):
+            worker.run_once(c)
+    worker.dispatcher.close()
+    # 送れた2通はもう記録済み
+    assert _statuses(conn, "mid-batch") == ["sent", "sent", "sending"]
+
+    _expire(conn, "mid-batch")
+    worker = outbox.DeliveryWorker(until_empty=True)
+    worker.run()
+    assert worker.sent == 1
+    assert _statuses(conn, "mid-batch") == ["sent"] * 3
+    assert len([m for m in smtp.messages if "mid-batch" in m.rcpt_tos[0]]) == 3
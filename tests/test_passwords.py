@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+import passwords
+
+
+def _slow(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_pool_hashes_in_clean_processes():
+    pool = passwords.HashPool(workers=1, max_pending=2, timeout=30)
+    try:
+        # 他のスレッドがロックを持ったままでも、子は fork で引き継がないので固まらない
+        held = threading.Lock()
+        held.acquire()
+        h = pool.run(passwords.generate_password_hash, "pw", "pbkdf2:sha256:1000")
+        assert pool.run(passwords.check_password_hash, h, "pw")
+        assert pool._executor._mp_context.get_start_method() == passwords.START_METHOD != "fork"
+        held.release()
+    finally:
+        pool.close()
+
+
+def test_timed_out_work_counts_against_the_limit():
+    pool = passwords.HashPool(workers=1, max_pending=1, timeout=0.2)
+    try:
+        # 子プロセスを温めておく（このモジュールの読み込みは timeout に数えない）
+        pool._get_executor().submit(_slow, 0).result(30)
+        with pytest.raises(passwords.HashBusy):
+            pool.run(_slow, 2)
+        # 諦めた計算はまだ走っているので、次は計算せずに断る
+        with pytest.raises(passwords.HashBusy, match="queue is full"):
+            pool.run(_slow, 0)
+        assert pool.stats()["timeouts"] == 1 and pool.stats()["rejected"] == 1
+        deadline = time.monotonic() + 10
+        while pool.stats()["pending"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.run(_slow, 0) == 0
+    finally:
+        pool.close()
+
+
+def test_login_does_not_hold_a_connection_while_hashing(web, conn, monkeypatch):
+    import json
+
+    import db
+    from conftest import make_user
+
+    uid, location_id = make_user(conn, "login-pool@test")
+    conn.execute("UPDATE users SET pw_hash = ? WHERE id = ?",
+                 (passwords.generate_password_hash("pw", "pbkdf2:sha256:1000"), uid))
+    conn.execute("""
+        INSERT INTO dashboard_snapshots (location_id, payload, risk, updated_at)
+        VALUES (?, ?, '安定', datetime('now'))
+    """, (location_id, json.dumps({"start": 0, "step": 3600, "values": [1.0], "risk": "安定"})))
+    conn.commit()
+
+    # 接続1本のプールで、ハッシュの照合が終わらないログインを1本走らせる
+    monkeypatch.setattr(db, "pool", db.ConnectionPool(size=1, timeout=2))
+    hashing, finish = threading.Event(), threading.Event()
+    real = passwords.verify_password
+
+    def slow_verify(pw_hash, password):
+        hashing.set()
+        finish.wait(10)
+        return real(pw_hash, password)
+
+    monkeypatch.setattr(passwords, "verify_password", slow_verify)
+    logins = []
+    t = threading.Thread(target=lambda: logins.append(
+        web.app.test_client().post("/login", data={"email": "login-pool@test", "password": "pw"}).status_code
+    ))
+    t.start()
+    try:
+        assert hashing.wait(10)
+        # ログインがハッシュを待っている間も、ダッシュボードは接続を借りて返せる
+        client = web.app.test_client()
+        with client.session_transaction() as s:
+            s["_user_id"] = str(uid)
+        r = client.get("/api/pressure")
+        assert r.status_code == 200 and r.get_json()["values"] == [1.0]
+    finally:
+        finish.set()
+        t.join(10)
+    assert logins == [302]
+    db.pool.close_all()
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import pressure_store as ps
+
+from conftest import make_user
+
+
+def _epochs(*labels):
+    return ps.to_epochs(list(labels))
+
+
+@pytest.fixture
+def location(conn, request):
+    # テストごとに別の地点
+    n = abs(hash(request.node.name)) % 1000
+    return make_user(conn, f"store-{request.node.name}@test", lat=25.0 + n * 0.01, lon=125.0)[1]
+
+
+def test_write_splits_blocks_at_jst_midnight(conn, location):
+    # 日本時間の 22時〜翌2時（UTC では同じ日の 13時〜17時）
+    epochs = _epochs("2026-03-01T22:00", "2026-03-01T23:00", "2026-03-02T00:00", "2026-03-02T01:00", "2026-03-02T02:00")
+    assert ps.write(conn, location, epochs, [1010.1, 1010.2, 1010.3, 1010.4, 1010.5]) == 5
+    conn.commit()
+
+    rows = conn.execute(
+        "SELECT base_epoch, data FROM pressure_blocks WHERE location_id = ? ORDER BY base_epoch", (location,)
+    ).fetchall()
+    assert [r[0] for r in rows] == [ps.day_epoch("2026-03-01"), ps.day_epoch("2026-03-02")]
+    day1, day2 = (np.frombuffer(r[1], dtype=ps.DTYPE).astype(np.float64) for r in rows)
+    assert np.isnan(day1[:22]).all() and day1[22:].round(1).tolist() == [1010.1, 1010.2]
+    assert day2[:3].round(1).tolist() == [1010.3, 1010.4, 1010.5] and np.isnan(day2[3:]).all()
+
+    # 読み出しは日をまたいでも時刻順につながる（前後の無い時刻は NaN）
+    got_epochs, matrix = ps.read_matrix(conn, [location], epochs[0] - 3600, epochs[-1] + 2 * 3600)
+    assert got_epochs.tolist() == list(range(epochs[0] - 3600, epochs[-1] + 2 * 3600, 3600))
+    assert np.isnan(matrix[0, 0]) and np.isnan(matrix[0, -1])
+    assert matrix[0, 1:-1].tolist() == [1010.1, 1010.2, 1010.3, 1010.4, 1010.5]
+
+
+def test_write_merges_without_overwriting_with_nan(conn, location):
+    epochs = _epochs("2026-04-01T09:00", "2026-04-01T10:00", "2026-04-01T11:00")
+    ps.write(conn, location, epochs, [1000.0, 1001.0, 1002.0])
+    # 新しい側が NaN / None の時刻は元の値を残し、値のある時刻だけ上書き・追加する
+    later = _epochs("2026-04-01T10:00", "2026-04-01T11:00", "2026-04-01T12:00", "2026-04-02T00:00")
+    assert ps.write(conn, location, later, [float("nan"), 1012.0, None, 1020.0]) == 2
+    assert ps.write(conn, location, later, [None, None, None, None]) == 0
+    conn.commit()
+
+    _, values = ps.read_series(conn, location, epochs[0], epochs[0] + 16 * 3600)
+    assert values[:3].tolist() == [1000.0, 1001.0, 1012.0]
+    assert np.isnan(values[3:15]).all() and values[15] == 1020.0
+
+
+@pytest.mark.parametrize("inline", [True, False])
+def test_read_matrix_orders_rows_by_location_ids(conn, request, inline, monkeypatch):
+    # 地点数が多い時の一時テーブル経由でも同じ結果
+    monkeypatch.setattr(ps, "INLINE_IDS", 500 if inline else 0)
+    ids = [make_user(conn, f"store-order-{inline}-{n}@test", lat=26.0 + n * 0.1 + inline, lon=126.0)[1]
+           for n in range(3)]
+    base = ps.day_epoch("2026-05-10")
+    for n, location_id in enumerate(ids):
+        ps.write(conn, location_id, [base + 23 * 3600, base + 24 * 3600], [1000.0 + n, 1100.0 + n])
+    conn.commit()
+
+    order = [ids[2], 999999, ids[0]]
+    _, matrix = ps.read_matrix(conn, order, base + 23 * 3600, base + 25 * 3600)
+    assert matrix[0].tolist() == [1002.0, 1102.0]
+    assert np.isnan(matrix[1]).all()
+    assert matrix[2].tolist() == [1000.0, 1100.0]
+
+
+def test_values_at_picks_pairs_across_days(conn, location):
+    epochs = _epochs("2026-06-01T23:00", "2026-06-02T00:00", "2026-06-02T05:00")
+    ps.write(conn, location, epochs, [1005.5, 1006.5, 1007.5])
+    conn.commit()
+
+    asked = np.concatenate([epochs + 1800, _epochs("2026-06-02T03:00"), epochs[:1]])
+    got = ps.values_at(conn, [location, location, location, location, 999999], asked)
+    assert got[:3].tolist() == [1005.5, 1006.5, 1007.5]   # 正時に切り捨て
+    assert np.isnan(got[3]) and np.isnan(got[4])
+    assert ps.values_at(conn, [], []).tolist() == []
@@ -0,0 +1,59 @@
+import threading
+from datetime import datetime
+
+import db
+import scheduler
+
+
+def _lock_row(name):
+    with db.connection() as conn:
+        return conn.execute("SELECT owner, expires_at FROM job_locks WHERE job = ?", (name,)).fetchone()
+
+
+def test_job_can_use_the_whole_pool(web, monkeypatch):
+    # 実行中のジョブがプールの接続を全部借りても PoolTimeout にならない（スケジューラーは借りたままにしない）
+    monkeypatch.setattr(db.pool, "timeout", 0.5)
+    seen = {}
+
+    def job():
+        seen["lock"] = _lock_row("pool-hungry")
+        held = [db.pool.acquire() for _ in range(db.pool.size)]
+        for c in held:
+            db.pool.release(c)
+
+    sched = scheduler.Scheduler([scheduler.Job("pool-hungry", "* * * * *", job)])
+    at = datetime.now().replace(second=0, microsecond=0)
+    assert sched.run_job(sched.jobs["pool-hungry"], at) == "ok"
+    assert seen["lock"]["owner"] == sched.owner
+    assert _lock_row("pool-hungry") is None
+    with db.connection() as conn:
+        row = conn.execute("SELECT status FROM job_runs WHERE job = 'pool-hungry'").fetchone()
+    assert row["status"] == "ok"
+
+
+def test_lock_is_renewed_while_running(web, monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_LOCK_RENEW", 0.05)
+    sched = scheduler.Scheduler([])
+    with db.connection() as conn:
+        assert scheduler.acquire_lock(conn, "long-job", sched.owner, ttl=1)
+        conn.execute("UPDATE job_locks SET expires_at = datetime('now', '-1 seconds') WHERE job = 'long-job'")
+        conn.commit()
+
+    done = threading.Event()
+    renewer = threading.Thread(target=sched._keep_lock, args=(scheduler.Job("long-job", "* * * * *", None), done))
+    renewer.start()
+    try:
+        # 期限切れにしておいても、延長で先に延びるので別プロセスは取れない
+        with db.connection() as conn:
+            for _ in range(100):
+                if conn.execute(
+                    "SELECT expires_at > datetime('now') FROM job_locks WHERE job = 'long-job'"
+                ).fetchone()[0]:
+                    break
+                threading.Event().wait(0.02)
+            assert not scheduler.acquire_lock(conn, "long-job", "other:1")
+    finally:
+        done.set()
+        renewer.join()
+    with db.connection() as conn:
+        scheduler.release_lock(conn, "long-job", sched.owner)
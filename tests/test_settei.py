@@ -0,0 +1,96 @@
+import pytest
+
+import db
+import settei
+
+from conftest import make_user
+
+
+def _client(web, uid):
+    client = web.app.test_client()
+    with client.session_transaction() as s:
+        s["_user_id"] = str(uid)
+    return client
+
+
+def _stored(conn, uid):
+    row = conn.execute("SELECT base_threshold FROM user_settings WHERE user_id = ?", (uid,)).fetchone()
+    return None if row is None else row[0]
+
+
+def test_reading_settings_does_not_write(web, conn, monkeypatch):
+    uid, _ = make_user(conn, "settei-read@test")
+    client = _client(web, uid)
+    assert client.get("/settei/").status_code == 200   # 無ければ1回だけ作る
+    assert _stored(conn, uid) == 4.0
+
+    # 2回目以降のキャッシュミスは SELECT だけ
+    statements = []
+    monkeypatch.setattr(db, "_observe_query", lambda sql, elapsed: statements.append(sql.split()[0].upper()))
+    settei.settings_cache.clear()
+    assert client.get("/settei/").status_code == 200
+    assert "INSERT" not in statements
+    assert "SELECT" in statements
+
+
+@pytest.mark.parametrize("text", ["nan", "inf", "-inf", "-1", "0", "0.4", "20.1", "1e9", "abc"])
+def test_rejects_bad_base_threshold(web, conn, text):
+    uid, _ = make_user(conn, f"settei-bad-{text}@test")
+    client = _client(web, uid)
+    r = client.post("/settei/", data={"base_threshold": text, "drink_choice": "none"})
+    assert r.status_code == 302
+    assert _stored(conn, uid) is None
+
+
+@pytest.mark.parametrize("text, value", [("0.5", 0.5), ("6.5", 6.5), ("20", 20.0)])
+def test_accepts_base_threshold_in_range(web, conn, text, value):
+    uid, _ = make_user(conn, f"settei-ok-{text}@test")
+    client = _client(web, uid)
+    client.post("/settei/", data={"base_threshold": text, "drink_choice": "none"})
+    assert _stored(conn, uid) == value
+
+
+# 別のワーカー（プロセス）。1行読むたびに、そのユーザーの基本アラート値を "= 値" の1行で返す
+_WORKER = """
+import sys
+import wsgi
+import settei
+
+wsgi.post_fork(int(sys.argv[1]))
+for line in sys.stdin:
+    with wsgi.app.test_request_context():
+        print("=", settei.get_user_settings(int(line))["base_threshold"], flush=True)
+"""
+
+
+@pytest.mark.parametrize("workers, expected", [(2, 7.5), (1, 4.0)])
+def test_save_is_seen_by_another_worker(web, conn, workers, expected):
+    import os
+    import subprocess
+    import sys
+
+    from conftest import ROOT
+
+    uid, _ = make_user(conn, f"settei-workers-{workers}@test")
+    other = subprocess.Popen(
+        [sys.executable, "-c", _WORKER, str(workers)], cwd=ROOT, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    try:
+        def read():
+            other.stdin.write(f"{uid}\n")
+            other.stdin.flush()
+            # 起動時のログは読み飛ばす
+            line = other.stdout.readline()
+            while line and not line.startswith("= "):
+                line = other.stdout.readline()
+            return float(line[2:])
+
+        assert read() == 4.0
+        # このワーカーで保存 → 別のワーカーが次に読むと新しい値（1ワーカーの設定なら古い値が残る）
+        _client(web, uid).post("/settei/", data={"base_threshold": "7.5", "drink_choice": "none"})
+        assert read() == expected
+    finally:
+        other.stdin.close()
+        other.wait(10)
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import threading
+import tracemalloc
+
+import pytest
+
+from conftest import make_user
+
+
+def _doc(value):
+    return json.dumps({"start": 0, "step": 3600, "values": [value], "risk": "安定"})
+
+
+def _snapshot(conn, location_id, payload):
+    conn.execute("""
+        INSERT INTO dashboard_snapshots (location_id, payload, risk, updated_at)
+        VALUES (?, ?, '安定', datetime('now'))
+        ON CONFLICT(location_id) DO UPDATE SET payload = excluded.payload, updated_at = excluded.updated_at
+    """, (location_id, payload))
+    conn.commit()
+
+
+# ----------------------------
+# プロセス内のハブ
+# ----------------------------
+def test_hub_fans_out_latest_only(web):
+    from sse import BroadcastHub
+
+    hub = BroadcastHub(heartbeat=0.01, poll_interval=3600)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    subs = [hub.subscribe(900000 + n % 20) for n in range(2000)]
+    per_sub = (tracemalloc.get_traced_memory()[0] - before) / len(subs)
+    tracemalloc.stop()
+    assert per_sub < 4096
+
+    assert hub.publish(900003, _doc(1)) == 100
+    assert hub.publish(900003, _doc(1)) == 0          # 同じ版は配らない
+    got = [s for s in subs if s.location_id == 900003]
+    assert all("data:" in s.take(0) for s in got)
+    assert all(s.take(0) is None for s in subs if s.location_id == 900004)
+
+    # 遅いクライアントは最新の1件だけ持つ
+    hub.publish(900003, _doc(2))
+    hub.publish(900003, _doc(3))
+    message = got[0].take(0)
+    assert '"values":[3]' in message and got[0].dropped == 1
+
+    for s in subs:
+        hub.unsubscribe(s)
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_flask_stream_is_capped(web, conn, monkeypatch):
+    import pressure
+
+    uid, location_id = make_user(conn, "sse-cap@test")
+    _snapshot(conn, location_id, _doc(1))
+    monkeypatch.setattr(pressure, "SSE_MAX_STREAMS", 0)
+    client = web.app.test_client()
+    with client.session_transaction() as s:
+        s["_user_id"] = str(uid)
+    r = client.get("/api/pressure/stream")
+    assert r.status_code == 503 and r.headers["Retry-After"]
+
+
+# ----------------------------
+# asyncio の SSE サーバー
+# ----------------------------
+@pytest.fixture
+def sse_server(web):
+    from sse_server import SseServer
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    server = asyncio.run_coroutine_threadsafe(
+        SseServer("127.0.0.1", 0, heartbeat=30, poll_interval=0.2, flask_app=web.app).start(), loop
+    ).result()
+    yield server
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+def _cookie(web, user_id):
+    serializer = web.app.session_interface.get_signing_serializer(web.app)
+    return f"{web.app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': str(user_id)})}"
+
+
+async def _open(port, cookie=None, path="/api/pressure/stream"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((f"GET {path} HTTP/1.1\r\nHost: test\r\n" + (f"Cookie: {cookie}\r\n" if cookie else "") + "\r\n").encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    return status, reader, writer
+
+
+async def _next_event(reader):
+    # 次の "event: snapshot" の data 行
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("closed")
+        if line.startswith(b"data: "):
+            return json.loads(line[6:])
+
+
+def test_sse_server_rejects_without_login(web, sse_server):
+    async def run():
+        status, _, writer = await _open(sse_server.port)
+        writer.close()
+        status2, _, writer = await _open(sse_server.port, path="/other")
+        writer.close()
+        return status, status2
+
+    assert asyncio.run(run()) == (401, 404)
+
+
+def test_sse_server_fans_out_without_threads(web, conn, sse_server):
+    clients = 300
+    uid, location_id = make_user(conn, "sse-fanout@test", lat=33.5, lon=130.4)
+    _snapshot(conn, location_id, _doc(1000.0))
+    cookie = _cookie(web, uid)
+
+    async def run():
+        threads_before = threading.active_count()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        conns = [await _open(sse_server.port, cookie) for _ in range(clients)]
+        assert all(status == 200 for status, _, _ in conns)
+        first = await asyncio.gather(*(_next_event(r) for _, r, _ in conns))
+        per_conn = (tracemalloc.get_traced_memory()[0] - before) / clients
+        tracemalloc.stop()
+        # 接続ごとのスレッドは無い（増えるのは DB 読み出し用の既定スレッドプールの分だけ）
+        grown = threading.active_count() - threads_before
+
+        assert sse_server.stats()["connections"] == clients
+        _snapshot(conn, location_id, _doc(1001.0))
+        second = await asyncio.wait_for(asyncio.gather(*(_next_event(r) for _, r, _ in conns)), 10)
+        for _, _, w in conns:
+            w.close()
+        return first, second, per_conn, grown
+
+    first, second, per_conn, grown = asyncio.run(run())
+    assert all(d["values"] == [1000.0] for d in first)
+    assert all(d["values"] == [1001.0] for d in second)
+    assert len({d["v"] for d in second}) == 1
+    assert grown <= 8
+    # クライアント側のソケットも含めて 1接続あたり数十KB まで（スレッドならスタックだけで MB 単位）
+    assert per_conn < 64 * 1024
+    assert sse_server.stats()["published"] == 1
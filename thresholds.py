@@ -0,0 +1,100 @@
+import numpy as np
+
+import metrics
+import risk
+
+# =========================
+# ユーザー別しきい値（アラートジョブ・テストアラート共通）
+# =========================
+# user_settings を1回のクエリで配列に読み、risk.personal_levels で
+# 地点ごとの変化量と全ユーザー分まとめて突き合わせる（ユーザーごとの Python ループなし）
+
+# 設定行が無いユーザーの基本しきい値（user_settings の既定値と同じ）
+DEFAULT_BASE_HPA = risk.CAUTION_HPA
+# 一度に配列にする行数（数百万ユーザーでも Row オブジェクトを溜め込まない）
+FETCH_CHUNK = 100_000
+
+
+def load(conn, user_id=None, default_base=DEFAULT_BASE_HPA):
+    """
+    地点のあるユーザーのしきい値を読む（user_id を渡すとその人だけ）
+    戻り値: {"user_id", "location_id", "threshold"} の NumPy 配列
+    """
+    sql = """
+        SELECT u.id, u.location_id,
+               s.base_threshold, s.drink_offset, s.pollen_offset, s.pollen_enabled
+        FROM users u
+        LEFT JOIN user_settings s ON s.user_id = u.id
+        WHERE u.location_id IS NOT NULL
+    """
+    params = ()
+    if user_id is not None:
+        sql += " AND u.id = ?"
+        params = (user_id,)
+
+    cur = conn.cursor()
+    cur.row_factory = None   # タプルのまま受け取る
+    cur.execute(sql, params)
+    parts = []
+    while True:
+        rows = cur.fetchmany(FETCH_CHUNK)
+        if not rows:
+            break
+        parts.append(np.array(rows, dtype=np.float64))   # NULL -> NaN
+    data = np.concatenate(parts) if parts else np.empty((0, 6))
+
+    base = np.where(np.isnan(data[:, 2]), default_base, data[:, 2])
+    drink = np.nan_to_num(data[:, 3])
+    pollen = np.nan_to_num(data[:, 4])
+    enabled = np.nan_to_num(data[:, 5])
+    return {
+        "user_id": data[:, 0].astype(np.int64),
+        "location_id": data[:, 1].astype(np.int64),
+        "threshold": risk.effective_thresholds(base, drink, pollen, enabled),
+    }
+
+
+def evaluate(users, location_ids, deltas, direction="drop"):
+    """
+    load() の結果と地点ごとの変化量から、通知するユーザーを選ぶ
+    戻り値: {user_id: (変化量, レベル, しきい値, 判定した地点)}（レベル 1 以上の人だけ）
+    """
+    user_delta, level = risk.personal_levels(
+        users["location_id"], users["threshold"], location_ids, deltas, direction
+    )
+    hit = np.flatnonzero(level > 0)
+    return {
+        int(users["user_id"][i]): (
+            float(user_delta[i]), int(level[i]), float(users["threshold"][i]), int(users["location_id"][i])
+        )
+        for i in hit
+    }
+
+
+def record(kind, users, location_ids, hits):
+    """
+    evaluate() の結果をユーザー数でメトリクスに記録する
+    location_ids（判定できた地点）に居ない人は no_data、居てもしきい値に届かない人は below_threshold
+    """
+    evaluated = int(np.isin(users["location_id"], np.asarray(location_ids, dtype=np.int64)).sum())
+    metrics.alerts_evaluated.inc(evaluated, kind=kind)
+    metrics.alerts_skipped.inc(len(users["user_id"]) - evaluated, kind=kind, reason="no_data")
+    metrics.alerts_skipped.inc(evaluated - len(hits), kind=kind, reason="below_threshold")
+
+
+def unsent_users(cur, user_ids, yyyy_mm_dd, kind):
+    """
+    user_ids のうち (date, kind) がまだ送られていない人を1回のアンチジョインで返す
+    ユーザーIDを一時テーブルに流し込んでから users / alerts_sent と突き合わせる
+    """
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS alert_users (user_id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM alert_users")
+    cur.executemany("INSERT OR IGNORE INTO alert_users (user_id) VALUES (?)", ((int(i),) for i in user_ids))
+    return cur.execute("""
+        SELECT u.id, u.email, u.location_id
+        FROM alert_users t
+        JOIN users u ON u.id = t.user_id
+        LEFT JOIN alerts_sent a
+          ON a.user_id = u.id AND a.date = ? AND a.kind = ?
+        WHERE a.id IS NULL
+    """, (yyyy_mm_dd, kind)).fetchall()
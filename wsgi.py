@@ -0,0 +1,67 @@
+import os
+
+import app as web
+import db
+import metrics
+import settei
+
+# =========================
+# 本番用の入口（複数ワーカープロセス）
+# =========================
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# gunicorn が無い環境では python wsgi.py（1プロセス・スレッド。開発・小規模用）
+# SSE（/api/pressure/stream）はリバースプロキシで sse_server.py へ回す
+#
+# プロセスをまたいで同じ値を配る必要があるものは DB に置く
+# - 予報・判定結果: shared_cache（pressure.forecast_cache / dashboard_cache）
+# - ダッシュボード文書: dashboard_snapshots（取り込みはスケジューラー側）
+# プロセス内に残るのは、どのワーカーが持っていても結果が変わらないものだけ
+# （接続プール・予報クライアント・SSE の購読・パスワードハッシュのプール）
+# ユーザー・ユーザー設定のキャッシュは、保存したワーカーでしか無効化できないので
+# ワーカーが2つ以上なら各ワーカーで切る（毎回 DB を主キーで読む。1プロセスなら使う）
+# パスワードハッシュのプールは、各ワーカーで最初のログイン時に forkserver で作られる（passwords.py）
+# /metrics の値はワーカーごと。ワーカーが2つ以上なら、各ワーカーが WEB_METRICS_PORT + ワーカー番号
+# （0 から。gunicorn.conf.py の pre_fork で振る）で worker ラベル付きで出す
+# → Prometheus にはワーカーの数だけターゲットを登録し、sum without (worker) で足し合わせる
+# （共有ポートの /metrics は、どのワーカーが答えるか決まらないので 404）
+
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8000"))
+# ワーカーごとの /metrics の先頭ポート（0 なら出さない）
+WEB_METRICS_PORT = int(os.getenv("WEB_METRICS_PORT", "0"))
+
+# マイグレーションは親プロセスで1回だけ
+web.init_db()
+# fork 前に作った SQLite 接続を子に持ち越さない（子は必要になった時に自分で開く）
+db.pool.close_all()
+
+app = web.app
+
+# 書き込みがそのプロセスの中でしか無効化されないキャッシュ
+PROCESS_LOCAL_CACHES = (web.user_cache, settei.settings_cache)
+# このワーカーの /metrics サーバー（WEB_METRICS_PORT を設定した時）
+metrics_server = None
+
+
+def post_fork(workers=1, index=0):
+    # ワーカーが起動した直後に呼ぶ（gunicorn.conf.py の post_fork から）
+    global metrics_server
+    db.pool.close_all()
+    if workers > 1:
+        for cache in PROCESS_LOCAL_CACHES:
+            cache.disable()
+        metrics.set_worker(index)
+    if WEB_METRICS_PORT:
+        metrics_server = metrics.serve(WEB_METRICS_PORT + index)
+    elif workers > 1:
+        print(f"[WARN] worker {index}: WEB_METRICS_PORT が未設定なので /metrics は出しません")
+
+
+if __name__ == "__main__":
+    from werkzeug.serving import run_simple
+
+    # 1プロセス・スレッドで受ける（werkzeug はプロセスとスレッドを併用できない。
+    # processes= だとプロセス数の件数しか同時に受けられず、SSE の接続だけで埋まる）
+    # 複数プロセスは gunicorn で
+    print(f"[INFO] serving on {WEB_HOST}:{WEB_PORT} threaded")
+    run_simple(WEB_HOST, WEB_PORT, app, threaded=True)